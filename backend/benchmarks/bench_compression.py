@@ -0,0 +1,89 @@
+'''
+CPU cost of compressing the responses against the bytes it saves, for every
+endpoint with gzip and brotli at a few levels. Then the same cached responses
+fetched through the app with and without Accept-Encoding, the cache keeps them
+compressed so a hit costs about as much as without compression.
+
+  python -m benchmarks.bench_compression --size 10000
+'''
+import time
+import argparse
+
+from flaskr import create_app
+from flaskr.compression import Compressor, brotli
+from .seed import seed_app, percentile
+
+SETTINGS = [('gzip', 1), ('gzip', 6), ('gzip', 9), ('br', 1), ('br', 5), ('br', 9), ('br', 11)]
+
+
+def endpoints(size):
+  return [
+    ('GET /questions', 'GET', '/questions?page=%d' % (size // 20), None),
+    ('GET /categories/1/questions', 'GET', '/categories/1/questions', None),
+    ('POST /questions/search', 'POST', '/questions/search', {'searchTerm': 'river'}),
+    ('POST /quizzes count=50', 'POST', '/quizzes',
+      {'previous_questions': [], 'quiz_category': {'id': 0}, 'count': 50}),
+    ('GET /changes', 'GET', '/changes?since=0', None),
+    ('GET /categories', 'GET', '/categories', None),
+  ]
+
+
+def timed(compress, repeat):
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    compressed = compress()
+    timings.append(time.perf_counter() - start)
+  return compressed, percentile(timings, 50)
+
+
+def cached_latency(client, path, headers, repeat):
+  client.get(path, headers=headers)
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    client.get(path, headers=headers)
+    timings.append(time.perf_counter() - start)
+  return percentile(timings, 50)
+
+
+def run(size, repeat, database_path=None):
+  app = seed_app(database_path, questions=size)
+  database_path = app.config['SQLALCHEMY_DATABASE_URI']
+  client = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'COMPRESSION': 'off'}).test_client()
+  settings = [setting for setting in SETTINGS if setting[0] == 'gzip' or brotli is not None]
+  if brotli is None:
+    print('brotli is not installed, only gzip (pip install brotli)')
+
+  print('%-28s %-8s %10s %10s %7s %10s %14s' % ('endpoint', 'encoding', 'bytes', 'compressed',
+    'saved', 'cpu ms', 'us per KB saved'))
+  for name, method, path, body in endpoints(size):
+    res = client.open(path, method=method, json=body)
+    data = res.get_data()
+    print('%-28s %-8s %10d' % (name, 'none', len(data)))
+    for encoding, level in settings:
+      compressor = Compressor(0, gzip_level=level, brotli_quality=level)
+      compressed, seconds = timed(lambda: compressor.compress(data, encoding), repeat)
+      saved = len(data) - len(compressed)
+      print('%-28s %-8s %10d %10d %6.1f%% %10.3f %14.1f' % ('', '%s-%d' % (encoding, level), len(data),
+        len(compressed), 100.0 * saved / len(data), seconds * 1000,
+        seconds * 1e6 / (saved / 1024) if saved > 0 else float('inf')))
+
+  # cached responses: compressed once, every hit sends the kept bytes
+  print()
+  compressed_app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+  for path in ('/questions?page=%d' % (size // 20), '/categories/1/questions'):
+    for accept in ('identity', 'gzip', 'br' if brotli is not None else 'gzip'):
+      seconds = cached_latency(compressed_app.test_client(), path, {'Accept-Encoding': accept}, repeat)
+      print('cache hit %-30s %-8s p50 %7.3f ms' % (path, accept, seconds * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=10000)
+  parser.add_argument('--repeat', type=int, default=20, help='times every body is compressed')
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  run(args.size, args.repeat, args.database)
@@ -0,0 +1,66 @@
+'''
+Time to look for duplicates of a new question with the MinHash/LSH index at
+growing sizes of the bank (it should stay the same), how long the index takes to
+build, and how many near-duplicates (a word changed or dropped) it finds.
+
+  python -m benchmarks.bench_duplicates --sizes 10000 100000 1000000
+'''
+import time
+import random
+import argparse
+
+from models import Question
+from flaskr.duplicates import DuplicateIndex
+from .seed import seed_app, percentile, WORDS
+
+
+# the question with one word replaced or dropped
+def reworded(question, rng):
+  words = question.split()
+  i = rng.randrange(2, len(words))
+  if rng.random() < 0.5:
+    words[i] = rng.choice(WORDS)
+  else:
+    del words[i]
+  return ' '.join(words)
+
+
+def run(size, lookups, database_path=None):
+  app = seed_app(database_path, questions=size)
+  rng = random.Random(4)
+  index = DuplicateIndex(app)
+
+  start = time.perf_counter()
+  index.build()
+  built_in = time.perf_counter() - start
+
+  with app.app_context():
+    originals = [(question_id, Question.query.get(question_id).question)
+      for question_id in rng.sample(range(1, size + 1), lookups)]
+    timings, found = [], 0
+    for question_id, question in originals:
+      text = reworded(question, rng)
+      start = time.perf_counter()
+      duplicates = index.find(text, threshold=0.7)
+      timings.append(time.perf_counter() - start)
+      found += question_id in [duplicate[0] for duplicate in duplicates]
+
+    start = time.perf_counter()
+    clusters = index.clusters()
+    clustered_in = time.perf_counter() - start
+
+  print('%8d questions  built in %6.2f s  find p50 %6.3f ms  p95 %6.3f ms  found %5.1f%% of reworded  '
+    'clusters %d in %.2f s' % (size, built_in, percentile(timings, 50) * 1000,
+    percentile(timings, 95) * 1000, found * 100 / lookups, len(clusters), clustered_in))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+  parser.add_argument('--lookups', type=int, default=500)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  for size in args.sizes:
+    run(size, args.lookups, args.database)
@@ -0,0 +1,50 @@
+'''
+Streams GET /questions/export and checks that the memory it needs doesn't
+grow with the number of questions.
+
+  python -m benchmarks.bench_export --sizes 100000 3000000 --ceiling 50
+'''
+import sys
+import argparse
+import time
+import resource
+
+from .seed import seed_app
+
+
+def run(size, export_format, database_path=None):
+  app = seed_app(database_path, questions=size)
+  client = app.test_client()
+
+  # peak resident memory only grows, so the growth during the export is what it needed above seeding
+  before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+  res = client.get('/questions/export?format=' + export_format, buffered=False)
+  exported = 0
+  lines = 0
+  for chunk in res.response:
+    exported += len(chunk)
+    lines += chunk.count(b'\n')
+  res.close()
+  seconds = time.perf_counter() - start
+  peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+  print('%8d questions  %-6s  %7.1f MB in %5.1f s (%6d rows/sec)  memory growth %6.2f MB' % (
+    size, export_format, exported / 2 ** 20, seconds, lines / seconds, peak / 2 ** 20))
+  return peak
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 3000000])
+  parser.add_argument('--format', default='ndjson', choices=['ndjson', 'csv'])
+  parser.add_argument('--ceiling', type=float, default=50,
+    help='fail if the export needs more than this many MB')
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  peaks = [run(size, args.format, args.database) for size in args.sizes]
+  if max(peaks) > args.ceiling * 2 ** 20:
+    print('export needed more than %.0f MB' % args.ceiling)
+    sys.exit(1)
@@ -0,0 +1,89 @@
+'''
+Compares picking a quiz question by loading every candidate row (the old
+get_quizzes) with the id pool behind POST /quizzes, at growing bank sizes.
+Then times a quiz round of --count questions asked one at a time
+against one request for all of them (count in the body).
+
+  python -m benchmarks.bench_quizzes --sizes 1000 10000 100000 --count 10
+'''
+import argparse
+import random
+import time
+
+from models import Question
+from .seed import seed_app, percentile
+
+
+def legacy_pick(category_id, previous_questions):
+  if category_id == 0:
+    questions = Question.query.filter(Question.id.notin_(previous_questions)).all()
+  else:
+    questions = Question.query.filter(
+      Question.category == str(category_id),
+      Question.id.notin_(previous_questions)).all()
+  return random.choice(questions).format() if questions else None
+
+
+# one quiz round, returns its time and the number of requests it took
+def play_round(client, category_id, count, batch):
+  start = time.perf_counter()
+  if batch:
+    client.post('/quizzes', json={'quiz_category': {'id': category_id}, 'previous_questions': [],
+      'count': count})
+    return time.perf_counter() - start, 1
+
+  previous = []
+  for _ in range(count):
+    res = client.post('/quizzes', json={'quiz_category': {'id': category_id}, 'previous_questions': previous})
+    previous.append(res.get_json()['question']['id'])
+  return time.perf_counter() - start, count
+
+
+def run(size, requests, count, database_path=None):
+  app = seed_app(database_path, questions=size)
+  client = app.test_client()
+  previous = list(range(1, 6))
+
+  for category_id in (0, 1):
+    body = {'quiz_category': {'id': category_id}, 'previous_questions': previous}
+    # first request loads the pool
+    client.post('/quizzes', json=body)
+
+    endpoint = []
+    for _ in range(requests):
+      start = time.perf_counter()
+      client.post('/quizzes', json=body)
+      endpoint.append(time.perf_counter() - start)
+
+    legacy = []
+    with app.app_context():
+      for _ in range(max(1, requests // 10)):
+        start = time.perf_counter()
+        legacy_pick(category_id, previous)
+        legacy.append(time.perf_counter() - start)
+
+    print('%8d  category %d  pool p50 %7.2f ms  p95 %7.2f ms  |  load all p50 %8.2f ms' % (
+      size, category_id,
+      percentile(endpoint, 50) * 1000, percentile(endpoint, 95) * 1000,
+      percentile(legacy, 50) * 1000))
+
+    rounds = max(1, requests // count)
+    one_at_a_time = [play_round(client, category_id, count, False)[0] for _ in range(rounds)]
+    batched = [play_round(client, category_id, count, True)[0] for _ in range(rounds)]
+    print('%8d  category %d  round of %d  one at a time p50 %7.2f ms (%d requests)  |  '
+      'batch p50 %7.2f ms (1 request)' % (
+      size, category_id, count, percentile(one_at_a_time, 50) * 1000, count,
+      percentile(batched, 50) * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+  parser.add_argument('--requests', type=int, default=200)
+  parser.add_argument('--count', type=int, default=10, help='questions in a quiz round')
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  for size in args.sizes:
+    run(size, args.requests, args.count, args.database)
@@ -0,0 +1,81 @@
+'''
+A burst of quiz results (a classroom finishing a quiz at once) posted to
+POST /quizzes/results by concurrent clients, with every result in its own
+transaction (group commit off) and written in batches (group commit on).
+Prints the transactions the burst committed, its throughput and latency.
+
+  python -m benchmarks.bench_results --concurrency 200 --results 2000
+'''
+import time
+import random
+import argparse
+import threading
+
+from sqlalchemy import event
+
+from models import db
+from flaskr import create_app
+from .seed import seed_app, percentile
+
+
+def burst(app, results, concurrency, answers, size):
+  rng = random.Random(5)
+  bodies = [{
+    'quiz_category': {'id': 0},
+    'player': 'Player %d' % i,
+    'answers': [{'question': question_id, 'correct': rng.random() < 0.6}
+      for question_id in rng.sample(range(1, size + 1), answers)]
+  } for i in range(results)]
+  barrier = threading.Barrier(concurrency)
+  timings = []
+  statuses = []
+
+  def send(worker):
+    client = app.test_client()
+    barrier.wait()
+    for body in bodies[worker::concurrency]:
+      start = time.perf_counter()
+      res = client.post('/quizzes/results', json=body)
+      timings.append(time.perf_counter() - start)
+      statuses.append(res.status_code)
+
+  threads = [threading.Thread(target=send, args=(worker, )) for worker in range(concurrency)]
+  start = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return time.perf_counter() - start, timings, statuses
+
+
+def run(size, results, concurrency, answers, database_path=None):
+  app = seed_app(database_path, questions=size)
+  database_path = app.config['SQLALCHEMY_DATABASE_URI']
+
+  for setting in ('off', 'on'):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'RESULTS_GROUP_COMMIT': setting})
+    commits = []
+    with app.app_context():
+      engine = db.get_engine(app)
+    listener = lambda *args: commits.append(1)
+    event.listen(engine, 'commit', listener)
+    seconds, timings, statuses = burst(app, results, concurrency, answers, size)
+    event.remove(engine, 'commit', listener)
+
+    failed = len([status for status in statuses if status != 201])
+    print('group commit %-3s  %6d results  %5d transactions  %4d failed  %8.0f results/s  '
+      'p50 %8.2f ms  p95 %8.2f ms' % (setting, results, len(commits), failed, results / seconds,
+      percentile(timings, 50) * 1000, percentile(timings, 95) * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=10000)
+  parser.add_argument('--results', type=int, default=1000)
+  parser.add_argument('--concurrency', type=int, default=50)
+  parser.add_argument('--answers', type=int, default=10, help='answers in every result')
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  run(args.size, args.results, args.concurrency, args.answers, args.database)
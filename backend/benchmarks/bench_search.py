@@ -0,0 +1,52 @@
+'''
+Compares the substring search (POST /questions/search, ILIKE over the whole table)
+with the word index (GET /questions/search) on a synthetic question bank.
+
+  python -m benchmarks.bench_search --size 1000000
+'''
+import argparse
+import time
+from urllib.parse import quote
+
+from .seed import seed_app, percentile
+
+TERMS = ['volcano', 'glacier harbor', 'olympic medal poet', 'comet', 'zzz']
+
+
+def timed(call, requests):
+  timings = []
+  for _ in range(requests):
+    start = time.perf_counter()
+    call()
+    timings.append(time.perf_counter() - start)
+  return timings
+
+
+def run(size, requests, database_path=None):
+  start = time.perf_counter()
+  app = seed_app(database_path, questions=size)
+  print('seeded %d questions in %.1f s' % (size, time.perf_counter() - start))
+  client = app.test_client()
+
+  start = time.perf_counter()
+  client.get('/questions/search?q=warmup')
+  print('index built in %.1f s' % (time.perf_counter() - start))
+
+  for term in TERMS:
+    substring = timed(lambda: client.post('/questions/search', json={'searchTerm': term}),
+      max(1, requests // 10))
+    indexed = timed(lambda: client.get('/questions/search?q=' + quote(term)), requests)
+    print('%-20s  substring p50 %9.2f ms  |  index p50 %7.2f ms  p95 %7.2f ms' % (
+      term, percentile(substring, 50) * 1000,
+      percentile(indexed, 50) * 1000, percentile(indexed, 95) * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=1000000)
+  parser.add_argument('--requests', type=int, default=50)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  run(args.size, args.requests, args.database)
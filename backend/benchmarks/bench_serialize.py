@@ -0,0 +1,61 @@
+'''
+Rows per second of the ways a list of questions can become a JSON response:
+Question objects + format() + standard json (how every endpoint did it), plain
+column tuples (question_rows) + standard json, and tuples + orjson (FastJSONEncoder).
+
+  python -m benchmarks.bench_serialize --rows 50000
+'''
+import argparse
+import time
+
+from flask import jsonify
+
+from models import Question
+from flaskr.serialize import question_rows, StandardJSONEncoder, FastJSONEncoder, orjson
+from .seed import seed_app
+
+
+def objects(query):
+  return [question.format() for question in query.all()]
+
+
+def run(rows, repeat, database_path=None):
+  app = seed_app(database_path, questions=rows)
+  ways = [
+    ('objects + format() + json', objects, StandardJSONEncoder),
+    ('question_rows + json', question_rows, StandardJSONEncoder),
+  ]
+  if orjson is not None:
+    ways.append(('question_rows + orjson', question_rows, FastJSONEncoder))
+  else:
+    print('orjson is not installed, skipping it')
+
+  outputs = set()
+  with app.test_request_context():
+    for name, load, encoder in ways:
+      app.json_encoder = encoder
+      best_load = best_encode = None
+      for _ in range(repeat):
+        start = time.perf_counter()
+        questions = load(Question.query.order_by(Question.id))
+        loaded = time.perf_counter()
+        res = jsonify({'success': True, 'questions': questions})
+        encoded = time.perf_counter()
+        best_load = min(best_load or loaded - start, loaded - start)
+        best_encode = min(best_encode or encoded - loaded, encoded - loaded)
+      outputs.add(res.get_data())
+      print('%-28s load %8.0f rows/sec  encode %8.0f rows/sec  together %8.0f rows/sec' % (
+        name, rows / best_load, rows / best_encode, rows / (best_load + best_encode)))
+
+  print('responses are the same' if len(outputs) == 1 else 'RESPONSES ARE DIFFERENT')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--rows', type=int, default=50000)
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  run(args.rows, args.repeat, args.database)
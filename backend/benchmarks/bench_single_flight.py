@@ -0,0 +1,72 @@
+'''
+A burst of identical concurrent requests (a classroom opening the app at once)
+on a freshly started app, with single-flight off and on and the response cache off.
+Prints the SQL queries the burst ran and the latency of its requests.
+
+  python -m benchmarks.bench_single_flight --concurrency 200 --size 100000
+'''
+import time
+import argparse
+import threading
+
+from sqlalchemy import event
+
+from models import db
+from flaskr import create_app
+from .seed import seed_app, percentile
+
+PATHS = ('/categories', '/questions?page=1', '/categories/1/questions')
+
+
+def burst(app, path, concurrency):
+  barrier = threading.Barrier(concurrency)
+  timings = []
+  shared = []
+
+  def send():
+    client = app.test_client()
+    barrier.wait()
+    start = time.perf_counter()
+    res = client.get(path)
+    timings.append(time.perf_counter() - start)
+    shared.append(res.headers.get('X-Coalesced') == 'true')
+
+  threads = [threading.Thread(target=send) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return timings, sum(shared)
+
+
+def run(size, concurrency, database_path=None):
+  app = seed_app(database_path, questions=size)
+  database_path = app.config['SQLALCHEMY_DATABASE_URI']
+
+  for path in PATHS:
+    for setting in ('off', 'on'):
+      # a new app for every burst, so its caches are cold like after a deploy
+      app = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'RESPONSE_CACHE': 'off',
+        'SINGLE_FLIGHT': setting})
+      queries = []
+      with app.app_context():
+        engine = db.get_engine(app)
+      listener = lambda *args: queries.append(1)
+      event.listen(engine, 'before_cursor_execute', listener)
+      timings, shared = burst(app, path, concurrency)
+      event.remove(engine, 'before_cursor_execute', listener)
+
+      print('%-26s single-flight %-3s  %5d queries  %4d shared  p50 %8.2f ms  p95 %8.2f ms' % (
+        path, setting, len(queries), shared, percentile(timings, 50) * 1000,
+        percentile(timings, 95) * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=100000)
+  parser.add_argument('--concurrency', type=int, default=100)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  run(args.size, args.concurrency, args.database)
@@ -0,0 +1,86 @@
+'''
+Measures the read-only snapshot mode: how long it takes to load the question
+bank at startup, how much memory it takes per question, and the latency of the
+read endpoints served from it compared with the database (response cache off).
+
+  python -m benchmarks.bench_snapshot --sizes 10000 100000 1000000
+'''
+import time
+import random
+import argparse
+import tracemalloc
+
+from flaskr import create_app
+from flaskr.snapshot import QuestionSnapshot
+from .seed import seed_app, percentile
+
+
+def requests_for(size, categories):
+  rng = random.Random(2)
+  return [
+    ('GET /questions?page', lambda client: client.get('/questions?page=%d' % rng.randint(1, size // 10))),
+    ('GET /questions/<id>', lambda client: client.get('/questions/%d' % rng.randint(1, size))),
+    ('GET /categories/<id>/questions', lambda client: client.get(
+      '/categories/%d/questions' % rng.randint(1, categories))),
+    ('POST /quizzes', lambda client: client.post('/quizzes', json={
+      'quiz_category': {'id': rng.randint(0, categories)}, 'previous_questions': []})),
+  ]
+
+
+def timed(client, send, requests):
+  timings = []
+  for _ in range(requests):
+    start = time.perf_counter()
+    send(client)
+    timings.append(time.perf_counter() - start)
+  return timings
+
+
+def run(size, categories, requests, database_path=None):
+  app = seed_app(database_path, questions=size, categories=categories)
+  database_path = app.config['SQLALCHEMY_DATABASE_URI']
+
+  snapshot = QuestionSnapshot(app)
+  snapshot.load()
+  loaded_in, memory = snapshot.loaded_in, snapshot.memory()
+  del snapshot
+  # loaded again to check memory() against what was allocated, tracing makes it slower
+  tracemalloc.start()
+  snapshot = QuestionSnapshot(app)
+  snapshot.load()
+  allocated = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del snapshot
+  print('%8d questions  loaded in %.2f s  %.1f bytes per question (%.1f MB, %.1f MB allocated)' % (
+    size, loaded_in, memory['bytes_per_question'], memory['bytes'] / 2 ** 20, allocated / 2 ** 20))
+
+  start = time.perf_counter()
+  snapshot_app = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'SNAPSHOT_MODE': True,
+    'RESPONSE_CACHE': 'off'})
+  print('          create_app in snapshot mode %.2f s' % (time.perf_counter() - start))
+  database_app = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'RESPONSE_CACHE': 'off'})
+
+  # the category page has a sixth of all questions, fewer of them are sent
+  for name, send in requests_for(size, categories):
+    count = requests if 'categories' not in name else max(1, requests // 20)
+    clients = snapshot_app.test_client(), database_app.test_client()
+    # first requests load the id pools
+    for client in clients:
+      send(client)
+    in_memory, database = (timed(client, send, count) for client in clients)
+    print('          %-32s snapshot p50 %8.2f ms  p95 %8.2f ms  |  database p50 %8.2f ms  p95 %8.2f ms' % (
+      name, percentile(in_memory, 50) * 1000, percentile(in_memory, 95) * 1000,
+      percentile(database, 50) * 1000, percentile(database, 95) * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+  parser.add_argument('--categories', type=int, default=6)
+  parser.add_argument('--requests', type=int, default=200)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  for size in args.sizes:
+    run(size, args.categories, args.requests, args.database)
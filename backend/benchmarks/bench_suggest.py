@@ -0,0 +1,92 @@
+'''
+Latency of the autocomplete (GET /questions/suggest) served from the in-memory
+prefix index, compared with the substring search the search box had before
+(POST /questions/search). Also prints how long the index takes to build and its size.
+Terms are beginnings (1 to 12 characters) of random questions and words.
+
+  python -m benchmarks.bench_suggest --sizes 100000 1000000
+'''
+import time
+import random
+import argparse
+from urllib.parse import quote
+
+from models import Question
+from flaskr import create_app
+from flaskr.suggest import SuggestIndex
+from .seed import seed_app, percentile, WORDS
+
+
+def terms(app, count, size):
+  rng = random.Random(3)
+  result = []
+  with app.app_context():
+    for question_id in rng.sample(range(1, size + 1), count // 2):
+      text = Question.query.get(question_id).question
+      result.append(text[:rng.randint(1, 12)])
+  for _ in range(count - len(result)):
+    word = rng.choice(WORDS)
+    result.append('which ' + word[:rng.randint(1, len(word))])
+  rng.shuffle(result)
+  return result
+
+
+def timed(send, terms):
+  timings = []
+  for term in terms:
+    start = time.perf_counter()
+    res = send(term)
+    timings.append(time.perf_counter() - start)
+    assert res.status_code in (200, 422), res.status_code
+  return timings
+
+
+def run(size, requests, database_path=None):
+  app = seed_app(database_path, questions=size)
+  database_path = app.config['SQLALCHEMY_DATABASE_URI']
+
+  index = SuggestIndex(app)
+  start = time.perf_counter()
+  index.build()
+  memory = index.memory()
+  print('%8d questions  index built in %.2f s  %d prefixes  %d words  %.1f MB (%.1f bytes per question)' % (
+    size, time.perf_counter() - start, len(index._prefixes), memory['words'],
+    memory['bytes'] / 2 ** 20, memory['bytes'] / size))
+  del index
+
+  app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+  client = app.test_client()
+  sample = terms(app, requests, size)
+  # the first request builds the index
+  client.get('/questions/suggest?q=a')
+
+  suggest = timed(lambda term: client.get('/questions/suggest?q=' + quote(term)), sample)
+  search = timed(lambda term: client.post('/questions/search', json={'searchTerm': term}),
+    sample[:max(1, requests // 20)])
+  print('          GET /questions/suggest   p50 %8.3f ms  p95 %8.3f ms' % (
+    percentile(suggest, 50) * 1000, percentile(suggest, 95) * 1000))
+  print('          POST /questions/search   p50 %8.3f ms  p95 %8.3f ms' % (
+    percentile(search, 50) * 1000, percentile(search, 95) * 1000))
+
+  # the index alone, without the request
+  index = SuggestIndex(app)
+  index.build()
+  lookups = []
+  for term in sample:
+    start = time.perf_counter()
+    index.suggest(term)
+    lookups.append(time.perf_counter() - start)
+  print('          SuggestIndex.suggest     p50 %8.3f ms  p95 %8.3f ms' % (
+    percentile(lookups, 50) * 1000, percentile(lookups, 95) * 1000))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+  parser.add_argument('--requests', type=int, default=1000)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  args = parser.parse_args()
+
+  for size in args.sizes:
+    run(size, args.requests, args.database)
@@ -0,0 +1,287 @@
+'''
+Load test for every endpoint of the app. Seeds a synthetic question bank, runs
+mixes of requests (browse, search, quiz, write, admin or all of them together)
+from a number of threads and reports throughput and p50/p95/p99 latency.
+
+  python -m benchmarks.load --size 100000 --save baseline.json
+  python -m benchmarks.load --size 100000 --compare baseline.json
+
+With --compare it exits with 1 when an operation got slower (p95) or the
+throughput of a mix got lower than --tolerance allows, so it can run in CI.
+With --url it sends the requests to a running server instead
+(seed it first with the same --size, e.g. by running without --url).
+'''
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import quote
+
+from .seed import seed_app, percentile, WORDS
+
+'''
+clients
+    request(method, path, json=None, data=None, headers=None) returns (status, body, headers)
+'''
+class AppClient:
+
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def request(self, method, path, json=None, data=None, headers=None):
+    res = self.client.open(path, method=method, json=json, data=data, headers=headers)
+    return res.status_code, res.data, res.headers
+
+
+class HttpClient:
+
+  def __init__(self, url):
+    self.url = url.rstrip('/')
+
+  def request(self, method, path, json=None, data=None, headers=None):
+    headers = dict(headers or {})
+    if json is not None:
+      data = globals()['json'].dumps(json).encode('utf-8')
+      headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+    try:
+      with urllib.request.urlopen(req) as res:
+        return res.status, res.read(), res.headers
+    except urllib.error.HTTPError as error:
+      return error.code, error.read(), error.headers
+
+
+'''
+operations
+    each one sends requests to one endpoint, state has the size of the bank,
+    a random generator and the tag of the thread, it marks what the thread created
+'''
+def browse_categories(client, state):
+  return client.request('GET', '/categories')
+
+def browse_page(client, state):
+  pages = max(1, state['size'] // 10)
+  return client.request('GET', '/questions?page=%d' % state['rng'].randint(1, min(pages, 100)))
+
+def browse_after(client, state):
+  return client.request('GET', '/questions?after=%d' % state['rng'].randint(0, state['size']))
+
+def browse_category(client, state):
+  return client.request('GET', '/categories/%d/questions' % state['rng'].randint(1, state['categories']))
+
+def browse_question(client, state):
+  return client.request('GET', '/questions/%d' % state['rng'].randint(1, state['size']))
+
+# conditional request with the ETag this thread got before
+def browse_not_modified(client, state):
+  if 'etag' not in state:
+    state['etag'] = client.request('GET', '/categories')[2].get('ETag')
+  return client.request('GET', '/categories', headers={'If-None-Match': state['etag']})
+
+def search_substring(client, state):
+  return client.request('POST', '/questions/search',
+    json={'searchTerm': state['rng'].choice(WORDS)})
+
+def search_index(client, state):
+  words = state['rng'].sample(WORDS, state['rng'].randint(1, 2))
+  return client.request('GET', '/questions/search?q=' + quote(' '.join(words)))
+
+def quiz_question(client, state):
+  rng = state['rng']
+  previous = [rng.randint(1, state['size']) for _ in range(rng.randint(0, 5))]
+  return client.request('POST', '/quizzes', json={
+    'quiz_category': {'id': rng.randint(0, state['categories'])},
+    'previous_questions': previous})
+
+def quiz_session(client, state):
+  res = client.request('POST', '/quizzes/sessions', json={
+    'quiz_category': {'id': state['rng'].randint(0, state['categories'])}})
+  if res[0] != 200:
+    return res
+  session_id = json.loads(res[1])['session_id']
+  for _ in range(5):
+    res = client.request('POST', '/quizzes/sessions/%s/next' % session_id)
+  client.request('DELETE', '/quizzes/sessions/%s' % session_id)
+  return res
+
+def write_create(client, state):
+  rng = state['rng']
+  words = rng.sample(WORDS, 4)
+  return client.request('POST', '/questions', json={
+    'question': 'Load test %s: which %s is %s %s?' % ((state['tag'], ) + tuple(words[:3])),
+    'answer': words[3],
+    'difficulty': rng.randint(1, 5),
+    'category': rng.randint(1, state['categories'])})
+
+def write_update(client, state):
+  rng = state['rng']
+  return client.request('PUT', '/questions/%d' % rng.randint(1, state['size']),
+    json={'difficulty': rng.randint(1, 5)})
+
+# deletes a question created by this thread, so the bank keeps its size
+def write_delete(client, state):
+  status, body, _ = client.request('GET', '/questions/search?q=' + state['tag'])
+  if status != 200:
+    return write_create(client, state)
+  question_id = state['rng'].choice(json.loads(body)['questions'])['id']
+  return client.request('DELETE', '/questions/%d' % question_id)
+
+def admin_categories(client, state):
+  res = client.request('POST', '/categories',
+    json={'category': 'Load %s %d' % (state['tag'], state['rng'].randint(0, 10 ** 9))})
+  if res[0] != 200:
+    return res
+  status, body, _ = client.request('GET', '/categories')
+  created = [int(category_id) for category_id, category_type in json.loads(body)['categories'].items()
+    if category_type.startswith('Load %s ' % state['tag'])]
+  return client.request('DELETE', '/categories/%d' % max(created))
+
+def admin_export(client, state):
+  start = state['rng'].randint(1, state['size'])
+  return client.request('GET', '/questions/export?from_id=%d&to_id=%d' % (start, start + 1000))
+
+def admin_import(client, state):
+  rows = [json.dumps({'question': 'Load import %d?' % i, 'answer': 'Yes',
+    'difficulty': 1, 'category': 1}) for i in range(100)]
+  return client.request('POST', '/questions/import?dry_run=true',
+    data='\n'.join(rows).encode('utf-8'), headers={'Content-Type': 'application/x-ndjson'})
+
+# operation -> weight in the mix
+MIXES = {
+  'browse': {browse_categories: 2, browse_page: 4, browse_after: 2, browse_category: 2,
+    browse_question: 1, browse_not_modified: 1},
+  'search': {search_substring: 1, search_index: 3},
+  'quiz': {quiz_question: 4, quiz_session: 1},
+  'write': {write_create: 2, write_update: 2, write_delete: 1},
+  'admin': {admin_categories: 1, admin_export: 1, admin_import: 1},
+}
+MIXES['all'] = dict(
+  [(operation, weight * 10) for operation, weight in MIXES['browse'].items()] +
+  [(operation, weight * 4) for operation, weight in MIXES['search'].items()] +
+  [(operation, weight * 5) for operation, weight in MIXES['quiz'].items()] +
+  [(operation, weight) for operation, weight in MIXES['write'].items()] +
+  [(operation, 1) for operation in MIXES['admin']])
+
+
+def run_mix(make_client, mix, requests, threads, size, categories, seed):
+  operations = list(MIXES[mix].items())
+  timings = {operation.__name__: [] for operation, _ in operations}
+  errors = {}
+  lock = threading.Lock()
+
+  def worker(number):
+    client = make_client()
+    state = {'rng': random.Random(seed * 1000 + number), 'size': size, 'categories': categories,
+      'tag': 'loadthread%d' % number}
+    picks = state['rng'].choices([operation for operation, _ in operations],
+      [weight for _, weight in operations], k=requests // threads)
+    for operation in picks:
+      start = time.perf_counter()
+      status = operation(client, state)[0]
+      seconds = time.perf_counter() - start
+      with lock:
+        timings[operation.__name__].append(seconds)
+        if status >= 500:
+          errors[operation.__name__] = errors.get(operation.__name__, 0) + 1
+
+  start = time.perf_counter()
+  workers = [threading.Thread(target=worker, args=(number, )) for number in range(threads)]
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  seconds = time.perf_counter() - start
+
+  done = sum(len(values) for values in timings.values())
+  result = {'requests': done, 'seconds': round(seconds, 3),
+    'requests_per_second': round(done / seconds, 1), 'operations': {}}
+  for name, values in timings.items():
+    if values:
+      result['operations'][name] = {
+        'count': len(values),
+        'errors': errors.get(name, 0),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3)
+      }
+  return result
+
+
+def print_result(mix, result):
+  print('%-8s %7d requests  %8.1f req/s' % (mix, result['requests'], result['requests_per_second']))
+  for name, stats in sorted(result['operations'].items()):
+    print('  %-22s %6d  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms%s' % (
+      name, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+      '  %d errors' % stats['errors'] if stats['errors'] else ''))
+
+
+# Returns the regressions of results against the baseline,
+# operations with less than min_count requests are too noisy to compare
+def compare(results, baseline, tolerance, min_count=20):
+  regressions = []
+  for mix, result in results.items():
+    base = baseline.get('mixes', {}).get(mix)
+    if base is None:
+      continue
+    if result['requests_per_second'] < base['requests_per_second'] * (1 - tolerance):
+      regressions.append('%s: %.1f req/s, baseline %.1f req/s' % (
+        mix, result['requests_per_second'], base['requests_per_second']))
+    for name, stats in result['operations'].items():
+      base_stats = base['operations'].get(name)
+      if (base_stats and min(stats['count'], base_stats['count']) >= min_count and
+          stats['p95_ms'] > base_stats['p95_ms'] * (1 + tolerance)):
+        regressions.append('%s %s: p95 %.2f ms, baseline %.2f ms' % (
+          mix, name, stats['p95_ms'], base_stats['p95_ms']))
+      if stats['errors']:
+        regressions.append('%s %s: %d errors' % (mix, name, stats['errors']))
+  return regressions
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=10000, help='questions to seed (10000, 100000, 1000000)')
+  parser.add_argument('--categories', type=int, default=6)
+  parser.add_argument('--database', default=None,
+    help='database to seed, it is dropped first (default: temporary sqlite file)')
+  parser.add_argument('--url', default=None, help='send requests to this running server, nothing is seeded')
+  parser.add_argument('--mix', nargs='+', default=list(MIXES), choices=list(MIXES))
+  parser.add_argument('--requests', type=int, default=1000, help='requests per mix')
+  parser.add_argument('--threads', type=int, default=4)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--save', default=None, help='save the results as a baseline JSON file')
+  parser.add_argument('--compare', default=None, help='compare the results with a baseline JSON file')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+    help='allowed slowdown against the baseline, 0.2 is 20%%')
+  args = parser.parse_args()
+
+  if args.url:
+    make_client = lambda: HttpClient(args.url)
+  else:
+    start = time.perf_counter()
+    app = seed_app(args.database, questions=args.size, categories=args.categories, seed=args.seed)
+    print('seeded %d questions in %.1f s' % (args.size, time.perf_counter() - start))
+    make_client = lambda: AppClient(app)
+
+  results = {}
+  for mix in args.mix:
+    results[mix] = run_mix(make_client, mix, args.requests, args.threads,
+      args.size, args.categories, args.seed)
+    print_result(mix, results[mix])
+
+  report = {'size': args.size, 'categories': args.categories, 'threads': args.threads,
+    'requests': args.requests, 'mixes': results}
+  if args.save:
+    with open(args.save, 'w') as baseline_file:
+      json.dump(report, baseline_file, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as baseline_file:
+      regressions = compare(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+      print('REGRESSION ' + regression)
+    if regressions:
+      sys.exit(1)
@@ -0,0 +1,57 @@
+import os
+import random
+import tempfile
+
+from flaskr import create_app
+from models import db, Question, Category
+
+WORDS = ('river mountain painter novel planet element battle empire river song '
+  'ocean desert king queen war treaty engine island city tower bridge actor '
+  'movie league goal medal olympic virus organ blood atom galaxy comet poet '
+  'opera statue temple canal border capital volcano glacier forest harbor').split()
+
+'''
+seed_app(database_path, questions, categories)
+    creates the app on the given database and fills it with a synthetic,
+    reproducible question bank. Without database_path a temporary sqlite
+    file is used
+'''
+def seed_app(database_path=None, questions=10000, categories=6, batch=10000, seed=1):
+  if database_path is None:
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    database_path = 'sqlite:///' + path
+
+  app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+  rng = random.Random(seed)
+
+  with app.app_context():
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Category.__table__.insert(),
+      [{'id': i, 'type': 'Category %d' % i} for i in range(1, categories + 1)])
+
+    rows = []
+    for i in range(1, questions + 1):
+      words = rng.sample(WORDS, 6)
+      rows.append({
+        'id': i,
+        'question': 'Question %d: which %s is %s %s %s %s?' % (i, *words[:5]),
+        'answer': words[5].title(),
+        'category': rng.randint(1, categories),
+        'difficulty': rng.randint(1, 5)
+      })
+      if len(rows) == batch:
+        db.session.execute(Question.__table__.insert(), rows)
+        rows = []
+    if rows:
+      db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+    Question.changed()
+
+  return app
+
+
+def percentile(timings, p):
+  ordered = sorted(timings)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
@@ -1,37 +1,208 @@
 import os
-from flask import Flask, request, abort, jsonify
+import click
+from flask import Flask, Response, request, abort, jsonify, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from models import *
 import random
+from array import array
 
-from models import setup_db, Question, Category
+from models import setup_db, category_version, Question, Category, DataVersion, QuestionStats
+from .quiz import QuestionPool, QuizRequest
+from .sessions import QuizSession, session_store
+from .search import SearchIndex
+from .suggest import SUGGESTIONS, MAX_SUGGESTIONS, SuggestIndex
+from .duplicates import DUPLICATE_CHECK, DUPLICATE_MODES, DUPLICATE_THRESHOLD, DuplicateIndex
+from .cache import CategoryCache
+from .bulk import (IMPORT_BATCH_SIZE, BULK_CHUNK_SIZE, missing_fields, import_questions, export_questions,
+  question_selection, update_values, delete_questions, update_questions, delete_category)
+from .etags import conditional, matching_etag, question_etag
+from .responses import response_cache
+from .compression import response_compressor
+from .singleflight import SINGLE_FLIGHT_TIMEOUT, single_flight
+from .metrics import init_metrics, timing
+from .serialize import json_encoder, question_rows
+from .changes import (CHANGES_PER_PAGE, MAX_CHANGES_PER_PAGE, CHANGE_LOG_COMPACT_INTERVAL,
+  CHANGE_LOG_RETENTION, ChangeLogCompactor, current_change, read_changes, compact_changes)
+from .snapshot import SNAPSHOT_REFRESH, snapshot_enabled, QuestionSnapshot, SnapshotCategories, SnapshotQuestionPool
+from .results import (LEADERBOARD_SIZE, LEADERBOARD_TTL, MAX_RESULT_ANSWERS, MAX_PLAYER_LENGTH,
+  quiz_result, unknown_questions, result_writer, Leaderboards)
+from .replicas import REPLICA_STICKY_SECONDS, REPLICA_CHECK_INTERVAL, configure_replicas, ReplicaRouter
 
 QUESTIONS_PER_PAGE = 10
+# questions POST /quizzes returns at most in one batch
+MAX_QUIZ_QUESTIONS = 50
+# endpoints that are allowed in the read-only snapshot mode besides GET,
+# they don't change any questions or categories (quiz results only add results and stats)
+SNAPSHOT_POST_ENDPOINTS = frozenset(['search_question', 'get_quizzes', 'start_quiz_session',
+  'next_quiz_question', 'end_quiz_session', 'record_quiz_result'])
+
+# headers every response gets, so the frontend can call the API from its own origin
+CORS_HEADERS = (
+  ('Access-Control-Allow-Headers', 'Content-Type, Authorization, If-None-Match, If-Match'),
+  ('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE, OPTIONS'),
+  ('Access-Control-Expose-Headers', 'ETag'),
+)
+# message of the JSON error responses
+ERROR_MESSAGES = {
+  400: 'Bad request',
+  404: 'Not found',
+  405: 'Method not allowed',
+  409: 'Already exists',
+  412: 'Precondition failed',
+  422: 'Unprocessable',
+  500: 'Internal Server Error',
+  503: 'Service unavailable'
+}
+
+# bodies of the question lists, the native endpoints of flaskr.asgi send the same
+def questions_page(questions, total, categories, last_id):
+  return {
+    "success": True,
+    "questions": questions,
+    "total_questions": total,
+    "categories": categories,
+    "current_category": 0,
+    # id to pass as 'after' to get the next page without OFFSET
+    "next_after": last_id
+  }
+
+
+def category_questions_page(questions, category_type):
+  return {
+    "success": True,
+    "questions": questions,
+    "total_questions": len(questions),
+    "current_category": category_type
+  }
+
+
+def search_results(questions):
+  return {
+    "success": True,
+    "questions": questions,
+    "total_questions": len(questions)
+  }
+
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  # read replicas from SQLALCHEMY_REPLICAS or DATABASE_REPLICAS are extra binds
+  replicas = configure_replicas(app)
+  setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+  # orjson when it's installed, the responses stay the same
+  app.json_encoder = json_encoder(app)
+  # SNAPSHOT_MODE serves the questions and categories from memory and rejects writes,
+  # the snapshot picks up writes of other apps from the change log
+  snapshot = None
+  if snapshot_enabled(app):
+    snapshot = QuestionSnapshot(app, float(app.config.get('SNAPSHOT_REFRESH', SNAPSHOT_REFRESH)))
+    snapshot.load()
+    question_pool = SnapshotQuestionPool(snapshot)
+    search_index = SearchIndex(app, rows=snapshot.search_rows)
+    suggest_index = SuggestIndex(app, rows=snapshot.search_rows)
+    duplicate_index = DuplicateIndex(app, rows=snapshot.search_rows, texts=snapshot.texts,
+      threshold=float(app.config.get('DUPLICATE_THRESHOLD', DUPLICATE_THRESHOLD)))
+    category_cache = SnapshotCategories(snapshot)
+  else:
+    question_pool = QuestionPool()
+    search_index = SearchIndex(app)
+    suggest_index = SuggestIndex(app)
+    duplicate_index = DuplicateIndex(app,
+      threshold=float(app.config.get('DUPLICATE_THRESHOLD', DUPLICATE_THRESHOLD)))
+    category_cache = CategoryCache()
+  # data versions behind the ETags, as the snapshot saw them in snapshot mode
+  versions = snapshot.versions if snapshot is not None else DataVersion.current_many
+  # encoded responses of the question lists, None when RESPONSE_CACHE is off
+  responses = response_cache(app.config.get('RESPONSE_CACHE', os.getenv('RESPONSE_CACHE')))
+  # gzip/brotli for big enough responses, unless COMPRESSION is off
+  compressor = response_compressor(app)
+  # identical GET requests at the same time share one response, unless SINGLE_FLIGHT is off
+  flights = single_flight(app.config.get('SINGLE_FLIGHT', os.getenv('SINGLE_FLIGHT')),
+    float(app.config.get('SINGLE_FLIGHT_TIMEOUT', SINGLE_FLIGHT_TIMEOUT)))
+  # per request timings and GET /metrics, only when METRICS_ENABLED is set
+  metrics = init_metrics(app)
+  if metrics is not None and responses is not None:
+    metrics.add_counters('trivia_response_cache', responses.stats)
+  if metrics is not None and snapshot is not None:
+    metrics.add_gauges('trivia_snapshot', snapshot.memory)
+  if metrics is not None and flights is not None:
+    metrics.add_counters('trivia_single_flight', flights.stats)
+  if metrics is not None and compressor is not None:
+    metrics.add_counters('trivia_compression', compressor.stats)
+  # read-only endpoints read from the replicas, snapshot mode reads from memory anyway
+  router = None
+  if replicas and snapshot is None:
+    router = ReplicaRouter(app, replicas,
+      float(app.config.get('REPLICA_STICKY_SECONDS', REPLICA_STICKY_SECONDS)),
+      float(app.config.get('REPLICA_CHECK_INTERVAL', REPLICA_CHECK_INTERVAL)))
+  if metrics is not None and router is not None:
+    metrics.add_counters('trivia_db', router.request_counts)
+    metrics.add_gauges('trivia_db', router.stats)
+  # compacts the log behind GET /changes now and then, snapshot mode doesn't write
+  compactor = None
+  if snapshot is None:
+    compactor = ChangeLogCompactor(app,
+      int(app.config.get('CHANGE_LOG_COMPACT_INTERVAL', CHANGE_LOG_COMPACT_INTERVAL)))
+  # what POST /questions and the import do with duplicates without ?duplicates=
+  duplicate_check = app.config.get('DUPLICATE_CHECK', DUPLICATE_CHECK)
+  # what the ASGI entry point (flaskr.asgi) shares with this app. It serves the read
+  # endpoints itself only when they read from the primary database without metrics
+  app.extensions['trivia'] = {
+    'responses': responses,
+    'compressor': compressor,
+    'single_flight': flights is not None,
+    'native_reads': snapshot is None and router is None and metrics is None
+  }
+  quiz_sessions = session_store(
+    app.config.get('QUIZ_SESSION_STORE', os.getenv('QUIZ_SESSION_STORE')))
+  # quiz results are written in batches (group commit), the leaderboards
+  # are kept in memory and the written results are merged into them
+  results_writer = result_writer(app)
+  leaderboards = Leaderboards(int(app.config.get('LEADERBOARD_SIZE', LEADERBOARD_SIZE)),
+    int(app.config.get('LEADERBOARD_TTL', LEADERBOARD_TTL)))
+  results_writer.listeners.append(leaderboards.add)
+  if metrics is not None:
+    metrics.add_counters('trivia_quiz', results_writer.stats)
+    metrics.add_gauges('trivia_quiz', results_writer.pending)
   
-  # helper function that takes the arguments of questions, categories and page,
-  # it formats them and limits the respond to QUESTIONS_PER_PAGE 
+  # helper function that takes the arguments of questions, categories (id -> type) and page,
+  # it formats them and limits the respond to QUESTIONS_PER_PAGE.
+  # Only one page is fetched from the database (LIMIT/OFFSET), or if the
+  # 'after' argument is given the page starts after that question id (keyset),
+  # so deep pages cost the same as the first one. In snapshot mode the page is a slice of it
   def paginate_questions(req, categories, questions):
     page = req.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    after = req.args.get('after', None, type=int)
+
+    if snapshot is not None:
+      formatted_questions, length, last_id = snapshot.page(page, after, QUESTIONS_PER_PAGE)
+      return {
+        'paginated_questions': formatted_questions,
+        'paginated_categories': categories,
+        'length': length,
+        'last_id': last_id
+      }
 
-    formatted_categories = {}
-    for category in categories:
-      c = category.format()
-      formatted_categories[c['id']] = c['type']
+    if after is not None:
+      page_questions = questions.filter(Question.id > after)
+    elif page < 1:
+      page_questions = None
+    else:
+      page_questions = questions.offset((page - 1) * QUESTIONS_PER_PAGE)
 
-    formatted_questions = [question.format() for question in questions]
+    formatted_questions = []
+    if page_questions is not None:
+      formatted_questions = question_rows(page_questions.limit(QUESTIONS_PER_PAGE))
 
     return {
-      'paginated_questions': formatted_questions[start:end],
-    	'paginated_categories': formatted_categories,
-      'length': len(formatted_questions)
+      'paginated_questions': formatted_questions,
+    	'paginated_categories': categories,
+      'length': Question.count(),
+      'last_id': formatted_questions[-1]['id'] if formatted_questions else None
     }
 
   '''
@@ -42,10 +213,59 @@ def create_app(test_config=None):
   '''
   DONE: Use the after_request decorator to set Access-Control-Allow
   '''
+  # helper function that returns the formatted question with the id or None,
+  # from memory in snapshot mode
+  def find_question(question_id):
+    if snapshot is not None:
+      return snapshot.question(question_id)
+    question = Question.query.get(question_id)
+    if question is None:
+      return None
+    with timing('format'):
+      return question.format()
+
+  # helper function that returns the formatted questions with the ids,
+  # in the same order and without the ones that don't exist
+  def find_questions(question_ids):
+    if snapshot is not None:
+      return [question.value for question in snapshot.questions(question_ids)]
+    # questions come from the database in any order
+    questions = question_rows(Question.query.filter(Question.id.in_(question_ids)))
+    questions_by_id = {question['id']: question for question in questions}
+    return [questions_by_id[question_id] for question_id in question_ids if question_id in questions_by_id]
+
+  # snapshot mode is read-only, writes get 405
+  if snapshot is not None:
+    @app.before_request
+    def reject_writes():
+      if (request.method not in ('GET', 'HEAD', 'OPTIONS')
+          and request.endpoint not in SNAPSHOT_POST_ENDPOINTS):
+        abort(405)
+
+  if compactor is not None:
+    @app.before_request
+    def compact_change_log():
+      compactor.maybe_compact()
+
+  if router is not None:
+    @app.before_request
+    def route_reads():
+      router.route(request)
+
+    @app.after_request
+    def stick_to_primary(res):
+      return router.after_write(request, res)
+
+  # responses of the cache were compressed by conditional already
+  if compressor is not None:
+    @app.after_request
+    def compress_response(res):
+      return compressor.compress_response(request, res)
+
   @app.after_request
   def after_request(res):
-    res.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-    res.headers.add('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+    for name, value in CORS_HEADERS:
+      res.headers.add(name, value)
     
     return res
 
@@ -55,16 +275,11 @@ def create_app(test_config=None):
   for all available categories.
   '''
   @app.route('/categories', methods=['GET'])
+  @conditional('categories', versions=versions, flights=flights)
   def get_categories():
-    categories = Category.query.order_by(Category.id).all()
-    formatted_categories = {}
-    for category in categories:
-      formatted_category = category.format()
-      formatted_categories[formatted_category['id']] = formatted_category['type']
-
     return jsonify({
       "success": True,
-      "categories": formatted_categories
+      "categories": category_cache.encoded_types()
     }), 200
 
   # Added additional route that lets us create additional categories
@@ -72,15 +287,13 @@ def create_app(test_config=None):
   @app.route('/categories', methods=['POST'])
   def create_category():
     body = request.get_json()
-    categories = Category.query.with_entities(Category.type).all()
-    categories_array = [type for (type, ) in categories]
     
     if not body:
       abort(422)
 
     new_category = body.get('category', None)
 
-    if new_category in categories_array:
+    if new_category in category_cache.type_set():
       abort(409)
 
     if new_category is None:
@@ -98,19 +311,33 @@ def create_app(test_config=None):
       abort(422)
 
   # Another route for deleting categories here, not implemented on frontend
+  # Its questions are left without a category, or with ?questions=delete deleted
+  # and with ?questions=move&to=<id> moved to another category, in chunks
   @app.route('/categories/<int:category_id>', methods=['DELETE'])
-  def delete_category(category_id):
+  def delete_category_route(category_id):
+    questions = request.args.get('questions', 'keep')
+    to_category_id = request.args.get('to', None, type=int)
+    batch_size = request.args.get('batch_size', BULK_CHUNK_SIZE, type=int)
+
+    if (questions not in ('keep', 'delete', 'move') or batch_size < 1 or
+        (questions == 'move') != (to_category_id is not None) or to_category_id == category_id):
+      abort(422)
+
     try:
       category = Category.query.filter(Category.id == category_id).one_or_none()
 
       if category is None:
         abort(404)
+      if to_category_id is not None and category_cache.get(to_category_id) is None:
+        abort(422)
 
-      category.delete()
+      changed = delete_category(category, questions, to_category_id, batch_size)
       
       return jsonify({
         "success": True,
-        "category_id": category_id
+        "category_id": category_id,
+        "questions": questions,
+        "changed_questions": changed
       }), 200
     except:
       abort(422)
@@ -129,22 +356,18 @@ def create_app(test_config=None):
   '''
 
   @app.route('/questions', methods=['GET'])
+  @conditional('questions', 'categories', cache=responses, versions=versions, flights=flights,
+    compressor=compressor)
   def get_questions():
-    categories = Category.query.order_by(Category.id).all()
-    questions = Question.query.order_by(Question.id).all()
+    questions = Question.query.order_by(Question.id)
     # It uses the helper function paginate_questions
-    paginated_results = paginate_questions(request, categories, questions)
+    paginated_results = paginate_questions(request, category_cache.encoded_types(), questions)
     
     if len(paginated_results['paginated_questions']) == 0:
       abort(404)
 
-    return jsonify({
-      "success": True,
-      "questions": paginated_results['paginated_questions'],
-      "total_questions": paginated_results['length'],
-      "categories": paginated_results['paginated_categories'],
-      "current_category": 0
-    }), 200
+    return jsonify(questions_page(paginated_results['paginated_questions'], paginated_results['length'],
+      paginated_results['paginated_categories'], paginated_results['last_id'])), 200
       
   '''
   DONE: 
@@ -183,39 +406,229 @@ def create_app(test_config=None):
   @app.route('/questions', methods=['POST'])
   def create_question():
     body = request.get_json()
-    if not body:
+    # error handling on empty inputs, bulk import uses the same rules
+    if not body or missing_fields(body):
       abort(422)
-    # error handling on empty inputs
     new_question = body.get('question', None)
-    if not new_question:
-      abort(422)
     new_answer = body.get('answer', None)
-    if not new_answer:
-      abort(422)
     new_difficulty = body.get('difficulty', None)
-    if not new_difficulty:
-       abort(422)
     new_category = body.get('category', None)
-    if not new_category:
+
+    # near-duplicates of the question that is already in the bank,
+    # with ?duplicates=reject the question isn't saved when there are any
+    duplicates_mode = request.args.get('duplicates', duplicate_check)
+    if duplicates_mode not in DUPLICATE_MODES:
       abort(422)
+    duplicates = []
+    if duplicates_mode != 'allow':
+      duplicates = [{'id': question_id, 'question': question, 'similarity': score}
+        for question_id, question, score in duplicate_index.find(new_question)]
+      if duplicates and duplicates_mode == 'reject':
+        return jsonify({
+          "success": False,
+          "error": 409,
+          "message": "Duplicate question",
+          "duplicates": duplicates
+        }), 409
     
     try:
       question = Question(
         question=new_question, 
         answer=new_answer, 
         difficulty=new_difficulty, 
-        category=new_category)
+        category=int(new_category))
       question.insert()
 
-      return jsonify({'success': True})
+      if duplicates_mode == 'allow':
+        return jsonify({'success': True})
+      return jsonify({'success': True, 'duplicates': duplicates})
     except:
       abort(422)
     
+  # Imports many questions at once from NDJSON (one question object per line)
+  # or CSV (with question,answer,difficulty,category header) in the request body.
+  # Body is read line by line and inserted in batches, with one commit per batch.
+  # Rows that aren't valid are skipped and reported with their line number
+  @app.route('/questions/import', methods=['POST'])
+  def bulk_import_questions():
+    import_format = request.args.get('format', None)
+    if import_format is None:
+      import_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    batch_size = request.args.get('batch_size', IMPORT_BATCH_SIZE, type=int)
+    dry_run = request.args.get('dry_run', 'false').lower() in ('1', 'true')
+    duplicates_mode = request.args.get('duplicates', duplicate_check)
+
+    if import_format not in ('ndjson', 'csv') or batch_size < 1 or duplicates_mode not in DUPLICATE_MODES:
+      abort(422)
+
+    report = import_questions(request.stream, import_format, batch_size, dry_run,
+      duplicate_index, duplicates_mode, category_cache.types())
+
+    return jsonify({
+      "success": True,
+      "dry_run": dry_run,
+      **report
+    }), 200
+
+  # Deletes many questions, given with a list of ids or a filter
+  # (category, difficulty, from_id, to_id), batch_size of them in one transaction
+  @app.route('/questions/bulk-delete', methods=['POST'])
+  def bulk_delete_questions():
+    body = request.get_json()
+    batch_size = request.args.get('batch_size', BULK_CHUNK_SIZE, type=int)
+
+    try:
+      ids, conditions = question_selection(body.get('ids', None), body.get('filter', None))
+    except (AttributeError, ValueError):
+      abort(422)
+    if batch_size < 1:
+      abort(422)
+
+    deleted, batches = delete_questions(ids, conditions, batch_size)
+
+    return jsonify({
+      "success": True,
+      "deleted": deleted,
+      "batches": batches
+    }), 200
+
+  # Sets the category and/or difficulty of many questions, selected like in bulk-delete
+  @app.route('/questions/bulk', methods=['PATCH'])
+  def bulk_update_questions():
+    body = request.get_json()
+    batch_size = request.args.get('batch_size', BULK_CHUNK_SIZE, type=int)
+
+    try:
+      ids, conditions = question_selection(body.get('ids', None), body.get('filter', None))
+      values = update_values(body.get('set', None))
+    except (AttributeError, ValueError):
+      abort(422)
+    if batch_size < 1:
+      abort(422)
+
+    updated, batches = update_questions(values, ids, conditions, batch_size)
+
+    return jsonify({
+      "success": True,
+      "updated": updated,
+      "batches": batches
+    }), 200
+
+  # The same import from the command line:
+  # flask import-questions questions.ndjson --batch-size 5000
+  @app.cli.command('import-questions')
+  @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+  @click.option('--format', 'import_format', type=click.Choice(['ndjson', 'csv']), default=None,
+    help='Format of the file, by default guessed from its extension.')
+  @click.option('--batch-size', default=IMPORT_BATCH_SIZE, type=click.IntRange(1))
+  @click.option('--dry-run', is_flag=True, help='Only validate the rows.')
+  @click.option('--duplicates', 'duplicates_mode', type=click.Choice(DUPLICATE_MODES), default=duplicate_check,
+    help='Look for duplicates of the questions in the bank and skip (reject) or report (flag) them.')
+  def import_questions_command(path, import_format, batch_size, dry_run, duplicates_mode):
+    if import_format is None:
+      import_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+    with open(path, 'rb') as lines:
+      report = import_questions(lines, import_format, batch_size, dry_run,
+        duplicate_index, duplicates_mode, category_cache.types())
+
+    for error in report['errors']:
+      click.echo('line {}: {}'.format(error['line'], error['message']), err=True)
+    for duplicate in report.get('duplicates', []):
+      click.echo('line {}: duplicate of {}'.format(duplicate['line'], duplicate['duplicate_of']), err=True)
+    click.echo('{} {} questions, {} failed in {}s ({} rows/sec)'.format(
+      'validated' if dry_run else 'imported', report['imported'], report['failed'],
+      report['seconds'], report['rows_per_second']))
+
+  # Streams all questions (or of one category / id range) as NDJSON or CSV,
+  # the output can be imported again with POST /questions/import
+  @app.route('/questions/export', methods=['GET'])
+  def bulk_export_questions():
+    export_format = request.args.get('format', 'ndjson')
+    category = request.args.get('category', None, type=int)
+    from_id = request.args.get('from_id', None, type=int)
+    to_id = request.args.get('to_id', None, type=int)
+
+    if export_format not in ('ndjson', 'csv'):
+      abort(422)
+
+    rows = snapshot.export_rows(category, from_id, to_id) if snapshot is not None else None
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(
+      stream_with_context(export_questions(export_format, category, from_id, to_id, rows=rows)),
+      mimetype=mimetype,
+      headers={'Content-Disposition': 'attachment; filename=questions.' + export_format})
+
+  # Questions and categories that changed since the version the client has, so it doesn't
+  # load all the pages again. Without since only the current version is returned,
+  # ask for it before loading the questions
+  @app.route('/changes', methods=['GET'])
+  @conditional('changes', cache=responses, flights=flights, compressor=compressor)
+  def get_changes():
+    since = request.args.get('since', None, type=int)
+    limit = request.args.get('limit', CHANGES_PER_PAGE, type=int)
+
+    if (since is None and 'since' in request.args) or (since is not None and since < 0) or limit < 1:
+      abort(422)
+
+    if since is None:
+      return jsonify({
+        "success": True,
+        "version": current_change()
+      }), 200
+
+    return jsonify({
+      "success": True,
+      **read_changes(since, min(limit, MAX_CHANGES_PER_PAGE))
+    }), 200
+
+  # Compacts the change log, for a cron job when CHANGE_LOG_COMPACT_INTERVAL is 0:
+  # flask compact-changes --retention 86400
+  @app.cli.command('compact-changes')
+  @click.option('--retention', default=CHANGE_LOG_RETENTION, type=click.IntRange(0),
+    help='Seconds the changes are kept.')
+  def compact_changes_command(retention):
+    click.echo('removed {} changes'.format(compact_changes(retention)))
+
+  # Returns one question, with its ETag to send as If-Match when updating it
+  @app.route('/questions/<int:question_id>', methods=['GET'])
+  def get_question(question_id):
+    formatted_question = find_question(question_id)
+
+    if formatted_question is None:
+      abort(404)
+
+    # the client can have the ETag of the compressed response, it's the same question
+    etag = question_etag(formatted_question)
+    matched = matching_etag(request.if_none_match, etag)
+    if matched is not None:
+      res = make_response('', 304)
+      res.set_etag(matched)
+      return res
+
+    res = make_response(jsonify({
+      "success": True,
+      "question": formatted_question
+    }))
+    res.set_etag(etag)
+    return res
+
   # Added a route to update question. It is a PUT as it changes all columns 
   # If there would be only one column change I'd use PATCH
   @app.route('/questions/<int:question_id>', methods=['PUT'])
   def update_question(question_id):
     body = request.get_json()
+
+    # the row is locked until the update is committed, so the If-Match check below
+    # and the update see the same question (sqlite has no row locks, FOR UPDATE is left out)
+    question = Question.query.filter(Question.id == question_id).with_for_update().one_or_none()
+
+    # With If-Match the question is updated only if nobody changed it
+    # since the client got it (its ETag still matches), otherwise 412
+    if request.if_match and question is not None:
+      if matching_etag(request.if_match, question_etag(question.format()), weak=False) is None:
+        db.session.rollback()
+        abort(412)
     
     # if statements are moved to async as if they aren't defined in body,
     # we will use the ones already set in our db
@@ -225,8 +638,6 @@ def create_app(test_config=None):
     new_category = body.get('category', None)
 
     try:
-      question = Question.query.filter(Question.id == question_id).one_or_none()
-      
       if question is None:
         abort(400)
 
@@ -238,14 +649,17 @@ def create_app(test_config=None):
       if new_difficulty:
         question.difficulty = new_difficulty
       if new_category:
-        question.category = new_category
+        question.category = int(new_category)
       
       question.update()
-      formatted_question = question.format()
-      return jsonify({
+      with timing('format'):
+        formatted_question = question.format()
+      res = jsonify({
         "success": True,
         "question": formatted_question
         })
+      res.set_etag(question_etag(formatted_question))
+      return res
     
     except:
       abort(400)
@@ -266,21 +680,97 @@ def create_app(test_config=None):
     search_term = body.get('searchTerm', None)
 
     try:
-      questions = Question.query.filter(Question.question.ilike('%' + search_term + '%')).all()
+      formatted_questions = question_rows(
+        Question.query.filter(Question.question.ilike('%' + search_term + '%')))
       
-      if not questions:
+      if not formatted_questions:
         abort(422)
 
-      formatted_questions = [question.format() for question in questions]
      
-      return jsonify({
-        "success": True,
-        "questions": formatted_questions,
-        "total_questions": len(formatted_questions)
-      }), 200
+      return jsonify(search_results(formatted_questions)), 200
     except:
       abort(422)
 
+  # Ranked search over the word index, paginated like get_questions.
+  # Matches whole words (the POST above still matches any substring),
+  # with answers=true the answers are searched too
+  @app.route('/questions/search', methods=['GET'])
+  def search_questions_index():
+    search_term = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    search_answers = request.args.get('answers', 'false').lower() in ('1', 'true')
+
+    if not search_term.strip() or page < 1:
+      abort(422)
+
+    start = (page - 1) * QUESTIONS_PER_PAGE
+    question_ids, total = search_index.search(
+      search_term, search_answers, start, start + QUESTIONS_PER_PAGE)
+
+    if not question_ids:
+      abort(404)
+
+    # in the order of the ranking
+    if snapshot is not None:
+      formatted_questions = snapshot.questions(question_ids)
+    else:
+      formatted_questions = find_questions(question_ids)
+
+    return jsonify({
+      "success": True,
+      "questions": formatted_questions,
+      "total_questions": total,
+      "page": page
+    }), 200
+
+  # Clusters of questions that are (near-)duplicates of each other, the biggest first,
+  # paginated in groups of 10 clusters. threshold is the share of the text they
+  # need in common, DUPLICATE_THRESHOLD by default
+  @app.route('/questions/duplicates', methods=['GET'])
+  @conditional('questions', cache=responses, versions=versions, flights=flights,
+    compressor=compressor)
+  def get_duplicates():
+    page = request.args.get('page', 1, type=int)
+    threshold = request.args.get('threshold', duplicate_index.threshold, type=float)
+
+    if page < 1 or not 0 < threshold <= 1:
+      abort(422)
+
+    clusters = duplicate_index.clusters(threshold)
+    start = (page - 1) * QUESTIONS_PER_PAGE
+    page_clusters = clusters[start:start + QUESTIONS_PER_PAGE]
+    questions = {question['id']: question for question in
+      find_questions([question_id for ids in page_clusters for question_id in ids])}
+
+    return jsonify({
+      "success": True,
+      "clusters": [[questions[question_id] for question_id in ids if question_id in questions]
+        for ids in page_clusters],
+      "total_clusters": len(clusters),
+      "total_duplicates": sum(len(ids) - 1 for ids in clusters),
+      "page": page
+    }), 200
+
+  # Autocomplete for the search box: beginnings of the questions that start with q
+  # and the words starting with the last word of q, the most frequent first.
+  # Served from memory, limit sets how many of each (SUGGESTIONS by default)
+  @app.route('/questions/suggest', methods=['GET'])
+  def suggest_questions():
+    search_term = request.args.get('q', '')
+    limit = request.args.get('limit', SUGGESTIONS, type=int)
+
+    if not search_term.strip() or not 1 <= limit <= MAX_SUGGESTIONS:
+      abort(422)
+
+    questions, words = suggest_index.suggest(search_term, limit)
+
+    return jsonify({
+      "success": True,
+      "query": search_term,
+      "questions": [{"prefix": prefix, "count": count} for prefix, count in questions],
+      "words": [{"word": word, "count": count} for word, count in words]
+    }), 200
+
   '''
   DONE: 
   Create a GET endpoint to get questions based on category. 
@@ -289,25 +779,26 @@ def create_app(test_config=None):
   categories in the left column will cause only questions of that 
   category to be shown. 
   '''
-  # changed to string as the test fails when integer
-  @app.route('/categories/<string:category_id>/questions', methods=['GET'])
+  # category is an integer column with an index on (category, id),
+  # so this reads only the rows of the category, already in id order
+  # Depends only on the version of this category (bumped by writes to its questions),
+  # so it stays cached when questions of other categories change
+  @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+  @conditional('categories', category_version, cache=responses, versions=versions,
+    flights=flights, compressor=compressor)
   def category_questions(category_id):
-    category = Category.query.filter(Category.id == category_id).first()
+    category_type = category_cache.get(category_id)
 
-    if not category:
+    if category_type is None:
       abort(404)
 
-    questions = Question.query.filter(Question.category == category_id).all()
-      
-    formatted_questions = [question.format() for question in questions]
-    formatted_category = category.format()
+    if snapshot is not None:
+      formatted_questions = snapshot.category_questions(category_id)
+    else:
+      formatted_questions = question_rows(
+        Question.query.filter(Question.category == category_id).order_by(Question.id))
 
-    return jsonify({
-      "success": True,
-      "questions": formatted_questions,
-      "total_questions": len(formatted_questions),
-      "current_category": formatted_category['type']
-    })
+    return jsonify(category_questions_page(formatted_questions, category_type))
 
   '''
   DONE: 
@@ -320,34 +811,150 @@ def create_app(test_config=None):
   one question at a time is displayed, the user is allowed to answer
   and shown whether they were correct or not. 
   '''
+  # With count it returns that many different questions at once (MAX_QUIZ_QUESTIONS at most),
+  # so a whole round takes one request. categories (list of ids) picks from more categories
+  # instead of quiz_category and difficulty only from questions with that difficulty
   @app.route('/quizzes', methods=['POST'])
   def get_quizzes():
+    try:
+      quiz = QuizRequest(request.get_json(), MAX_QUIZ_QUESTIONS)
+    except ValueError:
+      abort(422)
+
+    # Random unanswered question ids are picked from the pool of ids
+    # for desired categories or all categories, and only those questions are loaded.
+    # If the pool is out of date (question was deleted or moved by another worker)
+    # it is reloaded and we pick the missing ones again
+    for _ in range(2):
+      question_ids = quiz.sample(question_pool)
+      if not question_ids:
+        break
+      if quiz.add(question_ids, find_questions(question_ids)):
+        break
+      question_pool.invalidate()
+
+    return jsonify(quiz.response()), 200
+
+  # Quiz sessions keep the shuffled order of questions on the server,
+  # so the client doesn't have to send all previous questions every time.
+  # Start a session for a category and then ask for the next question with its id
+  @app.route('/quizzes/sessions', methods=['POST'])
+  def start_quiz_session():
     body = request.get_json()
+    if not body or 'quiz_category' not in body:
+      abort(422)
+
     category = body['quiz_category']
-    previous_questions = body['previous_questions']
-    
-    # If/else to set the questions for desired category 
-    # or all categories, that are unanswered
-    
-    if category['id'] == 0:
-      questions = Question.query.filter(Question.id.notin_(previous_questions)).all()
-    else:
-      questions = Question.query.filter(
-        Question.category == category['id'], 
-        Question.id.notin_(previous_questions)).all()
-    
-    # If there are no more unanswerd questions send this
-    if len(questions) == 0:
-      return jsonify({
-        "status": "no more questions"
-      })
+    # copy of the pool ids, shuffled with the seed if client wants to replay the same quiz
+    order = array('l', question_pool.ids(category['id']))
+    random.Random(body.get('seed', None)).shuffle(order)
+
+    session_id = quiz_sessions.create(QuizSession(category['id'], order))
+
+    return jsonify({
+      "success": True,
+      "session_id": session_id,
+      "total_questions": len(order)
+    }), 200
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+  def next_quiz_question(session_id):
+    # skips the questions that were deleted since the session started
+    question = None
+    while question is None:
+      try:
+        question_id = quiz_sessions.next_id(session_id)
+      except KeyError:
+        abort(404)
+
+      if question_id is None:
+        return jsonify({
+          "status": "no more questions"
+        })
+
+      question = find_question(question_id)
+
+    return jsonify({
+      "success": True,
+      "question": question
+    }), 200
+
+  # Results of played quizzes, answers are {"question": id, "correct": true/false}.
+  # The request returns when the result is committed, together with the results
+  # that came at about the same time (group commit), so a whole class finishing
+  # at once is one transaction and not one per answer
+  @app.route('/quizzes/results', methods=['POST'])
+  def record_quiz_result():
+    body = request.get_json()
+    if not body or 'quiz_category' not in body:
+      abort(422)
+
+    try:
+      category_id = int(body['quiz_category']['id'])
+    except (TypeError, KeyError, ValueError):
+      abort(422)
+    player = body.get('player', None)
+    answers = body.get('answers', None)
+
+    if ((category_id != 0 and category_cache.get(category_id) is None)
+        or (player is not None and (not isinstance(player, str) or len(player) > MAX_PLAYER_LENGTH))
+        or not isinstance(answers, list) or not 0 < len(answers) <= MAX_RESULT_ANSWERS
+        or not all(isinstance(answer, dict) and type(answer.get('question')) is int
+          and isinstance(answer.get('correct'), bool) for answer in answers)
+        or len(set(answer['question'] for answer in answers)) != len(answers)):
+      abort(422)
+    # answers of questions that don't exist (deleted ones can't be answered anymore)
+    if unknown_questions(answer['question'] for answer in answers):
+      abort(422)
+
+    result = quiz_result(category_id, player,
+      [(answer['question'], answer['correct']) for answer in answers])
+    try:
+      results_writer.submit(result)
+    except TimeoutError:
+      abort(503)
+    except Exception:
+      abort(500)
+
+    return jsonify({
+      "success": True,
+      "result_id": result['id'],
+      "score": result['score'],
+      "total": result['total']
+    }), 201
+
+  # best results of the quizzes of a category, 0 is the quizzes of all categories
+  @app.route('/quizzes/leaderboards/<int:category_id>', methods=['GET'])
+  def get_leaderboard(category_id):
+    if category_id != 0 and category_cache.get(category_id) is None:
+      abort(404)
+
+    return jsonify({
+      "success": True,
+      "category": category_id,
+      "leaderboard": leaderboards.top(category_id)
+    }), 200
+
+  # how many times the question was answered in quizzes and how many answers were correct
+  @app.route('/questions/<int:question_id>/stats', methods=['GET'])
+  def get_question_stats(question_id):
+    if find_question(question_id) is None:
+      abort(404)
+
+    stats = QuestionStats.query.get(question_id)
+    if stats is None:
+      stats = QuestionStats(question_id=question_id, answered=0, correct=0)
+
+    return jsonify(dict(stats.format(), success=True)), 200
+
+  @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+  def end_quiz_session(session_id):
+    if not quiz_sessions.delete(session_id):
+      abort(404)
 
-    # Randomize the question
-    random_question = random.choice(questions).format()
-    
     return jsonify({
       "success": True,
-      "question": random_question
+      "session_id": session_id
     }), 200
 
   '''
@@ -360,7 +967,7 @@ def create_app(test_config=None):
     return jsonify({
       "success": False, 
       "error": 500,
-      "message": "Internal Server Error"
+      "message": ERROR_MESSAGES[500]
     }), 500
   
   @app.errorhandler(404)
@@ -368,7 +975,7 @@ def create_app(test_config=None):
     return jsonify({
       "success": False, 
       "error": 404,
-      "message": "Not found"
+      "message": ERROR_MESSAGES[404]
     }), 404
 
   @app.errorhandler(422)
@@ -376,23 +983,47 @@ def create_app(test_config=None):
     return jsonify({
       "success": False, 
       "error": 422,
-      "message": "Unprocessable"
+      "message": ERROR_MESSAGES[422]
     }), 422
 
   @app.errorhandler(409)
-  def unprocassable(error):
+  def conflict(error):
     return jsonify({
       "success": False, 
       "error": 409,
-      "message": "Already exists"
+      "message": ERROR_MESSAGES[409]
     }), 409
   
+  @app.errorhandler(412)
+  def precondition_failed(error):
+    return jsonify({
+      "success": False, 
+      "error": 412,
+      "message": ERROR_MESSAGES[412]
+    }), 412
+
+  @app.errorhandler(405)
+  def method_not_allowed(error):
+    return jsonify({
+      "success": False, 
+      "error": 405,
+      "message": ERROR_MESSAGES[405]
+    }), 405
+
+  @app.errorhandler(503)
+  def service_unavailable(error):
+    return jsonify({
+      "success": False, 
+      "error": 503,
+      "message": ERROR_MESSAGES[503]
+    }), 503
+
   @app.errorhandler(400)
   def unprocassable(error):
     return jsonify({
       "success": False, 
       "error": 400,
-      "message": "Bad request"
+      "message": ERROR_MESSAGES[400]
     }), 400
 
 
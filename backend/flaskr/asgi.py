@@ -0,0 +1,686 @@
+'''
+ASGI entry point, for an async server like uvicorn:
+
+  uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+
+The read endpoints that wait for the database on every request (the question and
+category lists, one question, the substring search and POST /quizzes) are coroutines
+on an async driver (asyncpg, or aiosqlite for sqlite files), so a worker keeps serving
+other requests while they wait. Every other endpoint is the Flask app of create_app,
+run in a thread pool. Responses are the same as from the Flask app
+'''
+import os
+import re
+import sys
+import time
+import asyncio
+import threading
+from array import array
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import json
+from sqlalchemy import select, func
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import parse_etags, quote_etag, parse_options_header, parse_accept_header
+from werkzeug.urls import url_decode
+
+from models import Question, Category, DataVersion, QUESTION_COUNT_TTL, category_version
+from . import (create_app, questions_page, category_questions_page, search_results,
+  QUESTIONS_PER_PAGE, MAX_QUIZ_QUESTIONS, CORS_HEADERS, ERROR_MESSAGES)
+from .quiz import QuestionPool, QuizRequest, pool_key
+from .etags import ConditionalRequest, matching_etag, question_etag
+from .serialize import FORMAT_FIELDS, FORMAT_COLUMNS
+from .singleflight import SINGLE_FLIGHT_TIMEOUT
+from .asyncdb import ASYNC_DB_POOL_SIZE, async_database
+from .compression import encoded_etag
+
+# threads that run the endpoints of the Flask app in every worker
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 20))
+# chunks of a streamed Flask response waiting to be sent before the thread making them waits
+STREAM_QUEUE_SIZE = 8
+
+
+'''
+AsyncRequest
+    method, path, arguments, headers and body of a request to a native endpoint,
+    with the parts of flask.Request the endpoints use
+'''
+class AsyncRequest:
+
+  def __init__(self, scope, body):
+    self.method = scope['method']
+    self.path = scope['path']
+    self.args = url_decode(scope['query_string'])
+    self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+      for name, value in scope['headers']])
+    self.body = body
+    # (ResponseCache, key, etag) when the response is from the cache, it's kept compressed there too
+    self.cached = None
+
+  # the JSON body, None when it isn't JSON and 400 when it can't be parsed (like Flask)
+  def get_json(self):
+    mimetype = parse_options_header(self.headers.get('Content-Type', ''))[0]
+    if not (mimetype == 'application/json' or (mimetype.startswith('application/')
+        and mimetype.endswith('+json'))):
+      return None
+    try:
+      return json.loads(self.body)
+    except ValueError:
+      abort(400)
+
+  # key of the request in the response cache, the same as flaskr.responses.request_key
+  def key(self):
+    return self.path + '?' + urlencode(sorted(self.args.items(multi=True)))
+
+
+'''
+AsyncFlights
+    SingleFlight for coroutines: identical requests that come while the first one
+    is rendering wait for its response. After timeout seconds they render their own
+'''
+class AsyncFlights:
+
+  def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+    self.timeout = timeout
+    self._flights = {}
+
+  # returns (result, shared)
+  async def do(self, key, render):
+    flight = self._flights.get(key)
+    if flight is not None:
+      try:
+        return await asyncio.wait_for(asyncio.shield(flight), self.timeout), True
+      except asyncio.TimeoutError:
+        return await render(), False
+
+    flight = self._flights[key] = asyncio.get_running_loop().create_future()
+    try:
+      result = await render()
+      flight.set_result(result)
+      return result, False
+    except Exception as e:
+      flight.set_exception(e)
+      # retrieved here, so it isn't reported when nobody else waited for it
+      flight.exception()
+      raise
+    finally:
+      del self._flights[key]
+
+
+'''
+AsyncQuestionPool
+    QuestionPool that is refreshed with an async query before it's used,
+    picking ids never loads them
+'''
+class AsyncQuestionPool(QuestionPool):
+
+  def __init__(self):
+    super().__init__()
+    self._refresh_lock = None
+
+  async def refresh(self, database):
+    if not self.stale():
+      return
+    if self._refresh_lock is None:
+      self._refresh_lock = asyncio.Lock()
+    async with self._refresh_lock:
+      if self.stale():
+        version, generation = Question.version, self._generation
+        self.fill(await database.fetch_all(
+          select([Question.id, Question.category, Question.difficulty])), version, generation)
+
+  def ids(self, category_id, difficulty=None):
+    pool = self._pool
+    return (pool[0] if pool is not None else {}).get(pool_key(category_id, difficulty), array('l'))
+
+
+'''
+RequestBody
+    wsgi.input of a request to the Flask app. The body is received from the server
+    as the app reads it, so big uploads (the import) aren't kept in memory
+'''
+class RequestBody:
+
+  def __init__(self, receive, loop):
+    self._receive = receive
+    self._loop = loop
+    self._buffer = b''
+    self._more = True
+
+  # runs in the thread of the Flask app, receive() in the event loop
+  def _fill(self):
+    message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+    if message['type'] == 'http.disconnect':
+      self._more = False
+      return
+    self._buffer += message.get('body', b'')
+    self._more = message.get('more_body', False)
+
+  def _take(self, size):
+    data, self._buffer = self._buffer[:size], self._buffer[size:]
+    return data
+
+  def read(self, size=-1):
+    while self._more and (size is None or size < 0 or len(self._buffer) < size):
+      self._fill()
+    return self._take(len(self._buffer) if size is None or size < 0 else size)
+
+  def readline(self, size=-1):
+    while self._more and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+      self._fill()
+    end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+    if size is not None and size >= 0:
+      end = min(end, size)
+    return self._take(end)
+
+  def __iter__(self):
+    line = self.readline()
+    while line:
+      yield line
+      line = self.readline()
+
+
+# WSGI environ of the ASGI request
+def wsgi_environ(scope, body):
+  server = scope.get('server') or ('localhost', 80)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': '',
+    'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+    'QUERY_STRING': scope['query_string'].decode('latin-1'),
+    'SERVER_NAME': server[0],
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': body,
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': True,
+    'wsgi.run_once': False,
+    # the body is read until its end when there is no Content-Length
+    'wsgi.input_terminated': True
+  }
+  if scope.get('client'):
+    environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+  for name, value in scope['headers']:
+    key = name.decode('latin-1').upper().replace('-', '_')
+    if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+      key = 'HTTP_' + key
+    value = value.decode('latin-1')
+    environ[key] = environ[key] + (';' if key == 'HTTP_COOKIE' else ',') + value if key in environ else value
+  return environ
+
+
+async def read_body(receive):
+  body = b''
+  more = True
+  while more:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      break
+    body += message.get('body', b'')
+    more = message.get('more_body', False)
+  return body
+
+
+async def send_response(send, status, headers, body):
+  await send({
+    'type': 'http.response.start',
+    'status': status,
+    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+  })
+  await send({'type': 'http.response.body', 'body': body})
+
+
+'''
+AsyncApp
+    the ASGI app around the Flask app. Native endpoints are used only when the Flask
+    app reads them from the primary database (no SNAPSHOT_MODE, read replicas or
+    METRICS_ENABLED), otherwise all requests go to the Flask app.
+    The async database connects on the first request, in the server's event loop
+'''
+class AsyncApp:
+
+  def __init__(self, flask_app, threads=ASGI_THREADS, pool_size=ASYNC_DB_POOL_SIZE):
+    self.flask_app = flask_app
+    self.pool_size = pool_size
+    self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='flask')
+    shared = flask_app.extensions['trivia']
+    self.native = shared['native_reads']
+    self.responses = shared['responses']
+    self.compressor = shared['compressor']
+    self.flights = None
+    if shared['single_flight']:
+      self.flights = AsyncFlights(float(flask_app.config.get('SINGLE_FLIGHT_TIMEOUT', SINGLE_FLIGHT_TIMEOUT)))
+    self.question_pool = AsyncQuestionPool()
+    self.routes = (
+      ('GET', re.compile(r'/categories$'), self.get_categories),
+      ('GET', re.compile(r'/questions$'), self.get_questions),
+      ('GET', re.compile(r'/questions/(\d+)$'), self.get_question),
+      ('GET', re.compile(r'/categories/(\d+)/questions$'), self.category_questions),
+      ('POST', re.compile(r'/questions/search$'), self.search_question),
+      ('POST', re.compile(r'/quizzes$'), self.get_quizzes),
+    )
+    self._database = None
+    # (database version, local version, id -> type) of the categories
+    self._categories = None
+    self._loop_thread = None
+
+  @property
+  def database(self):
+    if self._database is None:
+      self._database = async_database(self.flask_app.config['SQLALCHEMY_DATABASE_URI'], self.pool_size)
+    return self._database
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await self.lifespan(receive, send)
+      return
+    if scope['type'] != 'http':
+      return
+
+    route = self.native_route(scope) if self.native else None
+    if route is None:
+      await self.call_flask(scope, receive, send)
+      return
+
+    endpoint, args = route
+    request = AsyncRequest(scope, await read_body(receive))
+    try:
+      status, headers, body = await endpoint(request, *args)
+    except HTTPException as e:
+      status, headers, body = self.error(e.code)
+    except Exception:
+      self.flask_app.logger.exception('Exception on %s [%s]', request.path, request.method)
+      status, headers, body = self.error(500)
+    status, headers, body = self.compress(request, status, list(headers), body)
+    await send_response(send, status, headers + list(CORS_HEADERS), body)
+
+  def native_route(self, scope):
+    for method, pattern, endpoint in self.routes:
+      if scope['method'] == method:
+        match = pattern.match(scope['path'])
+        if match is not None:
+          return endpoint, [int(arg) for arg in match.groups()]
+    return None
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        await self.close()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  async def close(self):
+    if self._database is not None:
+      await self._database.close()
+      self._database = None
+    self.executor.shutdown(wait=False)
+
+  '''
+  call_flask(scope, receive, send)
+      runs the Flask app in a thread of the pool, the body is read and the response
+      sent in chunks as the app asks for them. One thread runs the whole request,
+      streamed responses need its app context
+  '''
+  async def call_flask(self, scope, receive, send):
+    loop = asyncio.get_running_loop()
+    environ = wsgi_environ(scope, RequestBody(receive, loop))
+    # (status, headers) first, then the chunks of the body and None at the end
+    queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+
+    def put(item):
+      asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+      put((int(status.split(' ', 1)[0]), headers))
+      return put
+
+    def run():
+      try:
+        iterable = self.flask_app(environ, start_response)
+        try:
+          for chunk in iterable:
+            if chunk:
+              put(chunk)
+        finally:
+          if hasattr(iterable, 'close'):
+            iterable.close()
+        put(None)
+      except BaseException as e:
+        put(e)
+
+    finished = loop.run_in_executor(self.executor, run)
+    done = False
+    try:
+      item = await queue.get()
+      if isinstance(item, BaseException):
+        raise item
+      status, headers = item
+      await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+      })
+      while True:
+        item = await queue.get()
+        if isinstance(item, BaseException):
+          raise item
+        if item is None:
+          done = True
+          await send({'type': 'http.response.body', 'body': b''})
+          break
+        await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+    finally:
+      # the client went away, the thread still has to finish
+      if not done:
+        async def drain():
+          while not finished.done():
+            try:
+              await asyncio.wait_for(queue.get(), 1)
+            except asyncio.TimeoutError:
+              pass
+        loop.create_task(drain())
+    await finished
+
+  # JSON body the way jsonify writes it
+  def json_body(self, value):
+    config = self.flask_app.config
+    if config['JSONIFY_PRETTYPRINT_REGULAR'] or self.flask_app.debug:
+      encoded = json.dumps(value, app=self.flask_app, indent=2, separators=(', ', ': '))
+    else:
+      encoded = json.dumps(value, app=self.flask_app, separators=(',', ':'))
+    return (encoded + '\n').encode('utf-8')
+
+  def json_headers(self, body):
+    return [('Content-Type', self.flask_app.config['JSONIFY_MIMETYPE']), ('Content-Length', str(len(body)))]
+
+  def response(self, value, status=200, headers=()):
+    body = self.json_body(value)
+    return status, self.json_headers(body) + list(headers), body
+
+  def error(self, code):
+    code = code if code in ERROR_MESSAGES else 500
+    return self.response({
+      "success": False,
+      "error": code,
+      "message": ERROR_MESSAGES[code]
+    }, code)
+
+  # the response compressed with Compressor.compress_body, all of them are JSON
+  def compress(self, request, status, headers, body):
+    if self.compressor is None:
+      return status, headers, body
+    body, encoding, vary = self.compressor.compress_body(
+      parse_accept_header(request.headers.get('Accept-Encoding')), status,
+      self.flask_app.config['JSONIFY_MIMETYPE'], body, request.cached)
+    if vary:
+      headers = headers + [('Vary', 'Accept-Encoding')]
+    if encoding is not None:
+      headers = [(name, encoded_etag(value, encoding) if name == 'ETag' else value)
+        for name, value in headers if name != 'Content-Length'] + [
+        ('Content-Encoding', encoding), ('Content-Length', str(len(body)))]
+    return status, headers, body
+
+  async def fetch_all(self, statement):
+    return await self.database.fetch_all(statement)
+
+  async def question_rows(self, statement):
+    return [dict(zip(FORMAT_FIELDS, row)) for row in await self.fetch_all(statement)]
+
+  async def versions(self, *names):
+    versions = dict(await self.fetch_all(
+      select([DataVersion.name, DataVersion.version]).where(DataVersion.name.in_(names))))
+    return [versions.get(name, 0) for name in names]
+
+  # id -> type of all categories, loaded again when the version read for the ETag changed
+  async def category_types(self, version):
+    categories = self._categories
+    if categories is None or categories[:2] != (version, Category.version):
+      local_version = Category.version
+      types = dict(await self.fetch_all(select([Category.id, Category.type]).order_by(Category.id)))
+      categories = self._categories = (version, local_version, types)
+    return categories[2]
+
+  # the same count and cache as Question.count()
+  async def question_count(self):
+    cached = Question._count_cache
+    if cached is not None and time.time() - cached[1] < QUESTION_COUNT_TTL:
+      return cached[0]
+
+    total = (await self.fetch_all(select([func.count(Question.id)])))[0][0]
+    Question._count_cache = (total, time.time())
+    return total
+
+  '''
+  conditional(request, names, render, cache)
+      flaskr.etags.conditional with its ConditionalRequest, the versions are read
+      and the response rendered asynchronously. render(versions) returns the response
+      for the versions of the names
+  '''
+  async def conditional(self, request, names, render, cache=False):
+    versions = dict(zip(names, await self.versions(*names)))
+    conditional_request = ConditionalRequest(names, [versions[name] for name in names],
+      parse_etags(request.headers.get('If-None-Match')), request.key(), self.responses if cache else None)
+    if conditional_request.not_modified:
+      return 304, conditional_request.headers(), b''
+    request.cached = conditional_request.cached
+    body = conditional_request.hit
+    if body is not None:
+      return 200, self.json_headers(body) + conditional_request.headers(), body
+
+    async def render_and_cache():
+      status, response_headers, body = await render(versions)
+      conditional_request.rendered(status, body)
+      return status, response_headers, body
+
+    shared = False
+    if self.flights is not None:
+      (status, response_headers, body), shared = await self.flights.do(conditional_request.flight_key,
+        render_and_cache)
+    else:
+      status, response_headers, body = await render_and_cache()
+    if status != 200:
+      return status, response_headers, body
+    return status, response_headers + conditional_request.headers(shared), body
+
+  async def get_categories(self, request):
+    async def render(versions):
+      return self.response({
+        "success": True,
+        "categories": await self.category_types(versions['categories'])
+      })
+    return await self.conditional(request, ['categories'], render)
+
+  async def get_questions(self, request):
+    page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', None, type=int)
+
+    async def render(versions):
+      questions = select(FORMAT_COLUMNS).order_by(Question.id)
+      formatted_questions = []
+      if after is not None:
+        formatted_questions = await self.question_rows(
+          questions.where(Question.id > after).limit(QUESTIONS_PER_PAGE))
+      elif page >= 1:
+        formatted_questions = await self.question_rows(
+          questions.offset((page - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE))
+
+      if len(formatted_questions) == 0:
+        abort(404)
+
+      return self.response(questions_page(formatted_questions, await self.question_count(),
+        await self.category_types(versions['categories']), formatted_questions[-1]['id']))
+    return await self.conditional(request, ['questions', 'categories'], render, cache=True)
+
+  async def get_question(self, request, question_id):
+    questions = await self.question_rows(select(FORMAT_COLUMNS).where(Question.id == question_id))
+    if not questions:
+      abort(404)
+
+    etag = question_etag(questions[0])
+    matched = matching_etag(parse_etags(request.headers.get('If-None-Match')), etag)
+    if matched is not None:
+      return 304, [('ETag', quote_etag(matched))], b''
+    return self.response({
+      "success": True,
+      "question": questions[0]
+    }, headers=[('ETag', quote_etag(etag))])
+
+  async def category_questions(self, request, category_id):
+    async def render(versions):
+      category_type = (await self.category_types(versions['categories'])).get(category_id)
+      if category_type is None:
+        abort(404)
+
+      formatted_questions = await self.question_rows(
+        select(FORMAT_COLUMNS).where(Question.category == category_id).order_by(Question.id))
+      return self.response(category_questions_page(formatted_questions, category_type))
+    return await self.conditional(request, ['categories', category_version(category_id)], render,
+      cache=True)
+
+  async def search_question(self, request):
+    body = request.get_json()
+    search_term = body.get('searchTerm', None)
+
+    try:
+      formatted_questions = await self.question_rows(
+        select(FORMAT_COLUMNS).where(Question.question.ilike('%' + search_term + '%')))
+
+      if not formatted_questions:
+        abort(422)
+
+      return self.response(search_results(formatted_questions))
+    except Exception:
+      abort(422)
+
+  # the same as get_quizzes of the Flask app, the pool of ids is refreshed asynchronously
+  async def get_quizzes(self, request):
+    try:
+      quiz = QuizRequest(request.get_json(), MAX_QUIZ_QUESTIONS)
+    except ValueError:
+      abort(422)
+
+    for _ in range(2):
+      await self.question_pool.refresh(self.database)
+      question_ids = quiz.sample(self.question_pool)
+      if not question_ids:
+        break
+      if quiz.add(question_ids,
+          await self.question_rows(select(FORMAT_COLUMNS).where(Question.id.in_(question_ids)))):
+        break
+      self.question_pool.invalidate()
+
+    return self.response(quiz.response())
+
+  # runs the coroutine in the event loop of a thread of this app, for the test client
+  def run_sync(self, coroutine):
+    if self._loop_thread is None:
+      loop = asyncio.new_event_loop()
+      thread = threading.Thread(target=loop.run_forever, daemon=True)
+      thread.start()
+      self._loop_thread = (loop, thread)
+    return asyncio.run_coroutine_threadsafe(coroutine, self._loop_thread[0]).result()
+
+  # closes the database and stops the loop of run_sync
+  def shutdown(self):
+    if self._loop_thread is not None:
+      loop, thread = self._loop_thread
+      self.run_sync(self.close())
+      loop.call_soon_threadsafe(loop.stop)
+      thread.join()
+      self._loop_thread = None
+
+  def test_client(self):
+    return TestClient(self)
+
+
+'''
+TestClient
+    sends requests to the AsyncApp the way the Flask test client does (get, post...
+    with json, data, content_type and headers) and returns Flask responses
+'''
+class TestClient:
+
+  def __init__(self, app):
+    self.app = app
+
+  def open(self, path, method='GET', json=None, data=None, content_type=None, headers=None):
+    path, _, query_string = path.partition('?')
+    headers = Headers(headers or {})
+    if json is not None:
+      data = globals()['json'].dumps(json)
+      content_type = content_type or 'application/json'
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    data = data or b''
+    if content_type is not None:
+      headers['Content-Type'] = content_type
+    if data:
+      headers['Content-Length'] = str(len(data))
+
+    scope = {
+      'type': 'http',
+      'http_version': '1.1',
+      'method': method,
+      'scheme': 'http',
+      'path': path,
+      'query_string': query_string.encode('latin-1'),
+      'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+      'server': ('localhost', 80),
+      'client': ('127.0.0.1', 50000)
+    }
+
+    async def request():
+      received = []
+      sent = False
+
+      async def receive():
+        nonlocal sent
+        if not sent:
+          sent = True
+          return {'type': 'http.request', 'body': data, 'more_body': False}
+        return {'type': 'http.disconnect'}
+
+      async def send(message):
+        received.append(message)
+
+      await self.app(scope, receive, send)
+      start = received[0]
+      body = b''.join(message.get('body', b'') for message in received[1:])
+      return start['status'], [(name.decode('latin-1'), value.decode('latin-1'))
+        for name, value in start['headers']], body
+
+    status, response_headers, body = self.app.run_sync(request())
+    return self.app.flask_app.response_class(body, status=status, headers=response_headers)
+
+  def get(self, path, **kwargs):
+    return self.open(path, 'GET', **kwargs)
+
+  def post(self, path, **kwargs):
+    return self.open(path, 'POST', **kwargs)
+
+  def put(self, path, **kwargs):
+    return self.open(path, 'PUT', **kwargs)
+
+  def patch(self, path, **kwargs):
+    return self.open(path, 'PATCH', **kwargs)
+
+  def delete(self, path, **kwargs):
+    return self.open(path, 'DELETE', **kwargs)
+
+
+'''
+create_asgi_app(test_config)
+    the Flask app of create_app(test_config) served through AsyncApp
+'''
+def create_asgi_app(test_config=None):
+  app = create_app(test_config)
+  return AsyncApp(app, int(app.config.get('ASGI_THREADS', ASGI_THREADS)),
+    int(app.config.get('ASYNC_DB_POOL_SIZE', ASYNC_DB_POOL_SIZE)))
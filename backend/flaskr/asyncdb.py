@@ -0,0 +1,134 @@
+import os
+import re
+import asyncio
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+# the async drivers are only needed by the ASGI entry point (flaskr.asgi)
+try:
+  import asyncpg
+except ImportError:
+  asyncpg = None
+try:
+  import aiosqlite
+except ImportError:
+  aiosqlite = None
+
+# connections of the async pool of every worker
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', 20))
+
+NUMERIC_PARAM = re.compile(r'(?<![:\w]):(\d+)')
+
+
+'''
+PostgresDatabase
+    asyncpg pool on the database of the URL. Statements are compiled by
+    SQLAlchemy for Postgres, with $1, $2... parameters asyncpg expects
+'''
+class PostgresDatabase:
+  dialect = postgresql.dialect(paramstyle='numeric')
+
+  def __init__(self, url, pool_size=ASYNC_DB_POOL_SIZE):
+    if asyncpg is None:
+      raise RuntimeError('The async mode on Postgres needs asyncpg: pip install asyncpg')
+    # asyncpg takes postgres:// and postgresql:// without the driver name
+    self.dsn = re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', url)
+    self.pool_size = pool_size
+    self._pool = None
+    self._lock = asyncio.Lock()
+
+  async def _connection_pool(self):
+    if self._pool is None:
+      async with self._lock:
+        if self._pool is None:
+          self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+    return self._pool
+
+  def compile(self, statement):
+    compiled = statement.compile(dialect=self.dialect)
+    params = compiled.construct_params()
+    return NUMERIC_PARAM.sub(r'$\1', str(compiled)), [params[name] for name in compiled.positiontup]
+
+  async def fetch_all(self, statement):
+    sql, params = self.compile(statement)
+    pool = await self._connection_pool()
+    async with pool.acquire() as connection:
+      return [tuple(row) for row in await connection.fetch(sql, *params)]
+
+  async def close(self):
+    if self._pool is not None:
+      await self._pool.close()
+      self._pool = None
+
+
+'''
+SQLiteDatabase
+    aiosqlite connections to the sqlite file of the URL, each runs its queries
+    in its own thread. At most pool_size are opened, they are reused
+'''
+class SQLiteDatabase:
+  dialect = sqlite.dialect()
+
+  def __init__(self, url, pool_size=ASYNC_DB_POOL_SIZE):
+    if aiosqlite is None:
+      raise RuntimeError('The async mode on sqlite needs aiosqlite: pip install aiosqlite')
+    self.path = url[len('sqlite:///'):]
+    if not self.path:
+      raise ValueError('The async mode needs a sqlite file, not an in-memory database')
+    self.pool_size = pool_size
+    self._idle = []
+    self._opened = 0
+    self._available = asyncio.Condition()
+
+  async def _acquire(self):
+    async with self._available:
+      while not self._idle and self._opened >= self.pool_size:
+        await self._available.wait()
+      if self._idle:
+        return self._idle.pop()
+      self._opened += 1
+    try:
+      return await aiosqlite.connect(self.path, timeout=10)
+    except Exception:
+      async with self._available:
+        self._opened -= 1
+        self._available.notify()
+      raise
+
+  async def _release(self, connection):
+    async with self._available:
+      self._idle.append(connection)
+      self._available.notify()
+
+  def compile(self, statement):
+    compiled = statement.compile(dialect=self.dialect)
+    params = compiled.construct_params()
+    return str(compiled), [params[name] for name in compiled.positiontup]
+
+  async def fetch_all(self, statement):
+    sql, params = self.compile(statement)
+    connection = await self._acquire()
+    try:
+      async with connection.execute(sql, params) as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+    finally:
+      await self._release(connection)
+
+  async def close(self):
+    async with self._available:
+      idle, self._idle = self._idle, []
+      self._opened -= len(idle)
+    for connection in idle:
+      await connection.close()
+
+
+'''
+async_database(url, pool_size)
+    async database for the SQLAlchemy URL of the app, Postgres or a sqlite file
+'''
+def async_database(url, pool_size=ASYNC_DB_POOL_SIZE):
+  if url.startswith('postgres'):
+    return PostgresDatabase(url, pool_size)
+  if url.startswith('sqlite:///'):
+    return SQLiteDatabase(url, pool_size)
+  raise ValueError('The async mode supports only Postgres and sqlite files, not ' + url.split(':')[0])
@@ -0,0 +1,350 @@
+import io
+import os
+import csv
+import json
+import time
+
+from models import db, Question, Category, QuestionChange
+from .duplicates import normalize_question
+
+# rows inserted (and committed) together
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+# the report doesn't list more errors than this, only counts them
+MAX_REPORTED_ERRORS = 1000
+# rows fetched from the database cursor (and sent to the client) at once when exporting
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+# questions changed (and committed) together by bulk updates and deletes
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 1000))
+
+QUESTION_FIELDS = ('question', 'answer', 'difficulty', 'category')
+# what bulk updates and deletes can select questions by
+FILTER_FIELDS = ('category', 'difficulty', 'from_id', 'to_id')
+# fields bulk updates can set
+BULK_UPDATE_FIELDS = ('category', 'difficulty')
+
+
+# fields that are empty, the same rules POST /questions uses
+def missing_fields(values):
+  return [field for field in QUESTION_FIELDS if not values.get(field, None)]
+
+
+# Turns a parsed row into values for the questions table, raises ValueError if it's not valid.
+# With categories (id -> type) the category has to be one of them
+def question_values(row, categories=None):
+  if not isinstance(row, dict):
+    raise ValueError('row is not an object')
+
+  missing = missing_fields(row)
+  if missing:
+    raise ValueError('missing ' + ', '.join(missing))
+
+  values = {
+    'question': row['question'],
+    'answer': row['answer']
+  }
+  for field in ('difficulty', 'category'):
+    try:
+      values[field] = int(row[field])
+    except (TypeError, ValueError):
+      raise ValueError(field + ' is not a number')
+  if categories is not None and values['category'] not in categories:
+    raise ValueError('category does not exist')
+  return values
+
+
+# Yields (line number, parsed row or exception) from lines of bytes, one at a time
+def parse_rows(lines, format='ndjson'):
+  if format == 'csv':
+    # csv reader asks for more lines itself when a quoted value has a new line
+    reader = csv.DictReader(line.decode('utf-8') for line in lines)
+    try:
+      for row in reader:
+        yield reader.line_num, row
+    except (csv.Error, UnicodeDecodeError) as error:
+      yield reader.line_num, error
+    return
+
+  for line_number, line in enumerate(lines, 1):
+    if not line.strip():
+      continue
+    try:
+      yield line_number, json.loads(line.decode('utf-8'))
+    except ValueError as error:
+      yield line_number, error
+
+
+'''
+import_questions(lines, format, batch_size, dry_run, duplicates, duplicates_mode, categories)
+    validates and inserts questions from NDJSON or CSV lines, batch_size rows
+    in one statement and one commit. Lines are read as they come, so the file
+    is never in memory as a whole. Returns the report with the errors by line.
+    Rows with a category that isn't in categories (id -> type, all categories in
+    the database when not given) are errors of their own line, not of their batch.
+    With a DuplicateIndex rows that duplicate a question in the bank (or the
+    same text on an earlier line) are skipped as errors with duplicates_mode "reject"
+    or imported and listed in the report's duplicates with "flag"
+'''
+def import_questions(lines, format='ndjson', batch_size=IMPORT_BATCH_SIZE, dry_run=False,
+    duplicates=None, duplicates_mode='allow', categories=None):
+  start = time.perf_counter()
+  if categories is None:
+    categories = set(category_id for category_id, in db.session.query(Category.id))
+  report = {
+    'imported': 0,
+    'failed': 0,
+    'errors': []
+  }
+  check_duplicates = duplicates is not None and duplicates_mode != 'allow'
+  if check_duplicates:
+    report['duplicates'] = []
+  # hash of the normalized text -> line, the index doesn't have the rows of this import yet
+  seen = {}
+
+  # 'question 12' or 'line 3' the row duplicates, or None
+  def duplicate_of(line_number, text):
+    normalized = hash(normalize_question(text))
+    if normalized in seen:
+      return 'line {}'.format(seen[normalized])
+    seen[normalized] = line_number
+    found = duplicates.find(text)
+    return 'question {}'.format(found[0][0]) if found else None
+
+  def error(line_number, message):
+    report['failed'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+      report['errors'].append({'line': line_number, 'message': message})
+
+  def insert(batch):
+    if dry_run:
+      report['imported'] += len(batch)
+      return
+    try:
+      db.session.execute(Question.__table__.insert(), [values for (_, values) in batch])
+      Question.bump_versions(*[values['category'] for (_, values) in batch])
+      QuestionChange.log('import')
+      db.session.commit()
+      report['imported'] += len(batch)
+    except Exception as exception:
+      db.session.rollback()
+      for line_number, _ in batch:
+        error(line_number, 'not saved: ' + str(exception).split('\n')[0])
+
+  batch = []
+  for line_number, row in parse_rows(lines, format):
+    if isinstance(row, Exception):
+      error(line_number, 'not valid ' + format + ': ' + str(row))
+      continue
+    try:
+      values = question_values(row, categories)
+    except ValueError as exception:
+      error(line_number, str(exception))
+      continue
+
+    if check_duplicates:
+      duplicate = duplicate_of(line_number, values['question'])
+      if duplicate is not None and duplicates_mode == 'reject':
+        error(line_number, 'duplicate of ' + duplicate)
+        continue
+      if duplicate is not None and len(report['duplicates']) < MAX_REPORTED_ERRORS:
+        report['duplicates'].append({'line': line_number, 'duplicate_of': duplicate})
+    batch.append((line_number, values))
+
+    if len(batch) >= batch_size:
+      insert(batch)
+      batch = []
+
+  if batch:
+    insert(batch)
+
+  if report['imported'] and not dry_run:
+    Question.changed()
+
+  seconds = time.perf_counter() - start
+  report['seconds'] = round(seconds, 3)
+  report['rows_per_second'] = round((report['imported'] + report['failed']) / seconds) if seconds else 0
+  return report
+
+
+'''
+export_questions(format, category, from_id, to_id, rows)
+    yields questions as NDJSON or CSV text, in the format import_questions reads,
+    EXPORT_CHUNK_SIZE rows at a time. Rows are read as plain tuples through
+    a streaming cursor, so memory stays the same for any size of the table.
+    rows can be given instead, as (id, question, answer, difficulty, category) tuples
+'''
+def export_questions(format='ndjson', category=None, from_id=None, to_id=None,
+    chunk_size=EXPORT_CHUNK_SIZE, rows=None):
+  fields = ('id', ) + QUESTION_FIELDS
+  if rows is None:
+    query = db.session.query(Question.id, Question.question, Question.answer,
+      Question.difficulty, Question.category)
+    if category is not None:
+      query = query.filter(Question.category == category)
+    if from_id is not None:
+      query = query.filter(Question.id >= from_id)
+    if to_id is not None:
+      query = query.filter(Question.id <= to_id)
+    rows = query.order_by(Question.id).yield_per(chunk_size)
+
+  buffer = io.StringIO()
+  if format == 'csv':
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(fields)
+    write = writer.writerow
+  else:
+    def write(row):
+      buffer.write(json.dumps(dict(zip(fields, row))))
+      buffer.write('\n')
+
+  count = 0
+  for row in rows:
+    write(row)
+    count += 1
+    if count % chunk_size == 0:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+
+  if buffer.tell():
+    yield buffer.getvalue()
+
+
+'''
+question_selection(ids, filters)
+    returns (sorted ids or None, conditions) of the questions to change,
+    from a list of ids or a filter with FILTER_FIELDS. Raises ValueError if it's not valid
+'''
+def question_selection(ids=None, filters=None):
+  if (ids is None) == (filters is None):
+    raise ValueError('send ids or filter')
+
+  if ids is not None:
+    if not isinstance(ids, list) or not ids:
+      raise ValueError('ids is not a list of ids')
+    try:
+      return sorted(set(int(question_id) for question_id in ids)), []
+    except (TypeError, ValueError):
+      raise ValueError('ids is not a list of ids')
+
+  # an empty filter would select all questions
+  if not isinstance(filters, dict) or not filters or set(filters) - set(FILTER_FIELDS):
+    raise ValueError('filter can have only ' + ', '.join(FILTER_FIELDS))
+  try:
+    values = dict((field, int(value)) for field, value in filters.items())
+  except (TypeError, ValueError):
+    raise ValueError('filter values are not numbers')
+
+  conditions = []
+  if 'category' in values:
+    conditions.append(Question.category == values['category'])
+  if 'difficulty' in values:
+    conditions.append(Question.difficulty == values['difficulty'])
+  if 'from_id' in values:
+    conditions.append(Question.id >= values['from_id'])
+  if 'to_id' in values:
+    conditions.append(Question.id <= values['to_id'])
+  return None, conditions
+
+
+# Turns the fields of a bulk update into values for the questions table, raises ValueError if they're not valid
+def update_values(fields):
+  if not isinstance(fields, dict) or not fields or set(fields) - set(BULK_UPDATE_FIELDS):
+    raise ValueError('set can have only ' + ', '.join(BULK_UPDATE_FIELDS))
+  try:
+    values = dict((field, int(value)) for field, value in fields.items())
+  except (TypeError, ValueError):
+    raise ValueError('values are not numbers')
+  if 'category' in values and Category.query.get(values['category']) is None:
+    raise ValueError('category does not exist')
+  return values
+
+
+'''
+change_questions(action, change, ids, conditions, chunk_size, categories, last)
+    runs change(ids) (one UPDATE or DELETE statement) on the selected questions,
+    chunk_size of them in one transaction. Versions of their categories (and the
+    given categories) are bumped and the changes are logged in the same transaction.
+    last() runs in the transaction of the last chunk.
+    Returns (number of changed questions, number of transactions)
+'''
+def change_questions(action, change, ids=None, conditions=(), chunk_size=BULK_CHUNK_SIZE,
+    categories=(), last=None):
+  changed = 0
+  batches = 0
+  position = 0
+  last_id = None
+  done = False
+
+  try:
+    while not done:
+      query = db.session.query(Question.id, Question.category).filter(*conditions)
+      if ids is not None:
+        rows = query.filter(Question.id.in_(ids[position:position + chunk_size])).all()
+        position += chunk_size
+        done = position >= len(ids)
+      else:
+        # keyset over the ids, rows that stop matching after the change are not read again
+        if last_id is not None:
+          query = query.filter(Question.id > last_id)
+        rows = query.order_by(Question.id).limit(chunk_size).all()
+        done = len(rows) < chunk_size
+        if rows:
+          last_id = rows[-1][0]
+
+      if rows:
+        question_ids = [question_id for question_id, _ in rows]
+        change(question_ids)
+        Question.bump_versions(*[category for _, category in rows], *categories)
+        QuestionChange.log_many(action, question_ids)
+        changed += len(rows)
+      if done and last is not None:
+        last()
+      db.session.commit()
+      batches += 1
+  except:
+    db.session.rollback()
+    raise
+  finally:
+    # chunks committed before an error stay changed
+    if changed:
+      Question.changed()
+
+  return changed, batches
+
+
+def delete_questions(ids=None, conditions=(), chunk_size=BULK_CHUNK_SIZE, last=None):
+  def delete(question_ids):
+    Question.query.filter(Question.id.in_(question_ids)).delete(synchronize_session=False)
+  return change_questions('delete', delete, ids, conditions, chunk_size, last=last)
+
+
+def update_questions(values, ids=None, conditions=(), chunk_size=BULK_CHUNK_SIZE, last=None):
+  def update(question_ids):
+    Question.query.filter(Question.id.in_(question_ids)).update(values, synchronize_session=False)
+  return change_questions('update', update, ids, conditions, chunk_size,
+    categories=[values['category']] if 'category' in values else [], last=last)
+
+
+'''
+delete_category(category, questions, to_category_id, chunk_size)
+    deletes the category and its questions ('delete'), moves them to another
+    category ('move') or leaves them without a category ('keep').
+    The questions are changed in chunks, the category is deleted with the last one.
+    Returns the number of deleted or moved questions
+'''
+def delete_category(category, questions='keep', to_category_id=None, chunk_size=BULK_CHUNK_SIZE):
+  category_id = category.id
+  if questions == 'keep':
+    category.delete()
+    return 0
+
+  conditions = [Question.category == category_id]
+  if questions == 'delete':
+    changed, _ = delete_questions(conditions=conditions, chunk_size=chunk_size,
+      last=category.delete_without_commit)
+  else:
+    changed, _ = update_questions({'category': to_category_id}, conditions=conditions,
+      chunk_size=chunk_size, last=category.delete_without_commit)
+  Category.version += 1
+  return changed
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import threading
+
+from models import db, Category, DataVersion
+from .serialize import Encoded
+
+# seconds between checks of the categories version in the database,
+# that's how long a category added by another worker can be missing here
+CATEGORY_CACHE_POLL = float(os.getenv('CATEGORY_CACHE_POLL', 5))
+
+# Returns id -> type of all categories (ordered by id), the set of types and the types encoded
+def load_categories():
+  types = {}
+  for category_id, category_type in db.session.query(Category.id, Category.type) \
+      .order_by(Category.id):
+    types[category_id] = category_type
+
+  # encoded the way jsonify does it, sorted by id and only ASCII
+  encoded = Encoded(types, json.dumps(types, sort_keys=True, separators=(',', ':')))
+  return types, frozenset(types.values()), encoded
+
+
+'''
+CategoryCache
+    categories kept in memory, as id -> type dictionary and a set of types.
+    They are loaded again when this process changes a category or when the
+    version in the database (bumped by every worker) is different than ours
+'''
+class CategoryCache:
+
+  def __init__(self, poll_interval=CATEGORY_CACHE_POLL):
+    self.poll_interval = poll_interval
+    # (database version, local version, types, type set, types encoded)
+    self._data = None
+    self._checked_at = 0
+    self._lock = threading.Lock()
+
+  def invalidate(self):
+    self._data = None
+
+  def _load(self):
+    # version is read before the rows, so a write in between makes us load again next time
+    version = DataVersion.current('categories')
+    local_version = Category.version
+    self._data = (version, local_version) + load_categories()
+    self._checked_at = time.time()
+    return self._data
+
+  def _get(self):
+    data = self._data
+    if data is None or data[1] != Category.version:
+      with self._lock:
+        return self._load()
+
+    if time.time() - self._checked_at > self.poll_interval:
+      self._checked_at = time.time()
+      if DataVersion.current('categories') != data[0]:
+        with self._lock:
+          return self._load()
+    return data
+
+  # id -> type of all categories, ordered by id. Don't change it
+  def types(self):
+    return self._get()[2]
+
+  # types with their JSON, for responses
+  def encoded_types(self):
+    return self._get()[4]
+
+  def type_set(self):
+    return self._get()[3]
+
+  def get(self, category_id):
+    return self._get()[2].get(category_id)
@@ -0,0 +1,142 @@
+import os
+import time
+import threading
+
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from models import db, Question, Category, DataVersion, QuestionChange
+from .serialize import question_rows
+
+# changes returned by one GET /changes request, by default and at most
+CHANGES_PER_PAGE = 100
+MAX_CHANGES_PER_PAGE = 1000
+# seconds changes are kept in the log, clients that were away longer load everything again
+CHANGE_LOG_RETENTION = int(os.getenv('CHANGE_LOG_RETENTION', 7 * 24 * 3600))
+# seconds between compactions of the log, 0 turns them off (run `flask compact-changes` instead)
+CHANGE_LOG_COMPACT_INTERVAL = int(os.getenv('CHANGE_LOG_COMPACT_INTERVAL', 3600))
+# the 'changes_compacted' version holds the id of the newest change removed
+# because of its age, a client asking for changes since an older id could miss some
+COMPACTED = 'changes_compacted'
+
+
+# id of the newest change, also when the log was compacted away
+def current_change():
+  return max(db.session.query(func.max(QuestionChange.id)).scalar() or 0, DataVersion.current(COMPACTED))
+
+
+'''
+read_changes(since, limit)
+    returns the changes after the since version: current rows of the questions and
+    categories that were inserted or updated and ids of the deleted ones, from at most
+    limit changes. version is the one to ask with next time, has_more tells there are more.
+    reset is True when the client has to load everything again: after an import
+    or when the changes since its version were compacted away
+'''
+def read_changes(since, limit=CHANGES_PER_PAGE):
+  result = {
+    'since': since,
+    'version': since,
+    'has_more': False,
+    'reset': False,
+    'questions': [],
+    'deleted_questions': [],
+    'categories': {},
+    'deleted_categories': []
+  }
+
+  if since < DataVersion.current(COMPACTED):
+    result.update(reset=True, version=current_change())
+    return result
+
+  changes = db.session.query(QuestionChange.id, QuestionChange.question_id,
+    QuestionChange.category_id, QuestionChange.action) \
+    .filter(QuestionChange.id > since) \
+    .order_by(QuestionChange.id).limit(limit + 1).all()
+  if len(changes) > limit:
+    changes = changes[:limit]
+    result['has_more'] = True
+  if not changes:
+    return result
+
+  if any(action == 'import' for _, _, _, action in changes):
+    result.update(reset=True, has_more=False, version=current_change())
+    return result
+  result['version'] = changes[-1][0]
+
+  # a question changed many times is sent once, as it is now
+  question_ids = sorted(set(question_id for _, question_id, _, _ in changes if question_id is not None))
+  if question_ids:
+    questions = question_rows(Question.query.filter(Question.id.in_(question_ids)).order_by(Question.id))
+    found = set(question['id'] for question in questions)
+    result['questions'] = questions
+    result['deleted_questions'] = [question_id for question_id in question_ids if question_id not in found]
+
+  # questions of a deleted category are left without one, clients set their category to null
+  category_ids = sorted(set(category_id for _, _, category_id, _ in changes if category_id is not None))
+  if category_ids:
+    categories = dict(db.session.query(Category.id, Category.type).filter(Category.id.in_(category_ids)))
+    result['categories'] = categories
+    result['deleted_categories'] = [category_id for category_id in category_ids
+      if category_id not in categories]
+
+  return result
+
+
+'''
+compact_changes(retention)
+    removes the changes of a question or category that have a newer one
+    (clients get the current row anyway) and the changes older than retention seconds.
+    Returns the number of removed changes
+'''
+def compact_changes(retention=CHANGE_LOG_RETENTION):
+  removed = 0
+  newer = aliased(QuestionChange)
+  for column, newer_column in ((QuestionChange.question_id, newer.question_id),
+      (QuestionChange.category_id, newer.category_id)):
+    newest = db.session.query(func.max(newer.id)).filter(newer_column == column).as_scalar()
+    removed += QuestionChange.query.filter(column.isnot(None), QuestionChange.id < newest) \
+      .delete(synchronize_session=False)
+
+  oldest = time.time() - retention
+  expired = db.session.query(func.max(QuestionChange.id)) \
+    .filter(QuestionChange.changed_at < oldest).scalar()
+  if expired is not None:
+    removed += QuestionChange.query.filter(QuestionChange.id <= expired).delete(synchronize_session=False)
+    DataVersion.query.filter(DataVersion.name == COMPACTED, DataVersion.version < expired) \
+      .update({DataVersion.version: expired}, synchronize_session=False)
+
+  # responses of GET /changes depend on the log, their ETags change
+  DataVersion.bump('changes')
+  db.session.commit()
+  return removed
+
+
+'''
+ChangeLogCompactor
+    compacts the change log in the background, a request starts it
+    when interval seconds passed since the last time in this process
+'''
+class ChangeLogCompactor:
+
+  def __init__(self, app, interval=CHANGE_LOG_COMPACT_INTERVAL, retention=CHANGE_LOG_RETENTION):
+    self.app = app
+    self.interval = interval
+    self.retention = retention
+    self._compacted_at = time.time()
+    self._lock = threading.Lock()
+
+  def maybe_compact(self):
+    if (self.interval and time.time() - self._compacted_at > self.interval and
+        self._lock.acquire(False)):
+      self._compacted_at = time.time()
+
+      def compact():
+        try:
+          with self.app.app_context():
+            compact_changes(self.retention)
+        except Exception:
+          self.app.logger.exception('Compacting the change log failed')
+        finally:
+          self._lock.release()
+      threading.Thread(target=compact, daemon=True).start()
@@ -0,0 +1,148 @@
+import os
+import zlib
+import threading
+from time import perf_counter
+
+from werkzeug.http import quote_etag, unquote_etag
+
+# brotli when it's installed, gzip only without it
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# bodies smaller than this many bytes are sent as they are, compressing them saves almost nothing
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+# zlib level of gzip, 1 (fastest) to 9 (smallest)
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+# brotli quality, 0 (fastest) to 11 (smallest, far too slow for every request)
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+COMPRESS_MIMETYPES = frozenset(['application/json', 'text/plain', 'text/csv', 'application/x-ndjson'])
+# encodings in the order they are preferred, brotli only when it's installed
+ENCODINGS = ('br', 'gzip')
+
+
+# ETag header of the response compressed with the encoding. A compressed body isn't
+# the same bytes, so it gets its own tag: "questions12-categories3-gzip"
+def encoded_etag(header, encoding):
+  etag, weak = unquote_etag(header)
+  return quote_etag('{}-{}'.format(etag, encoding), weak)
+
+
+'''
+Compressor
+    gzip and brotli content negotiation. Bodies of at least min_size bytes are
+    compressed with the encoding from Accept-Encoding the client prefers (brotli
+    when it likes both the same), smaller ones and streamed responses are sent as they are.
+    Counts the responses, bytes before and after and time spent per encoding
+'''
+class Compressor:
+
+  def __init__(self, min_size=COMPRESS_MIN_SIZE, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+    self.min_size = min_size
+    self.gzip_level = gzip_level
+    self.brotli_quality = brotli_quality
+    self.encodings = ENCODINGS if brotli is not None else ('gzip', )
+    self._lock = threading.Lock()
+    self._counts = {'small_responses': 0}
+    for encoding in self.encodings:
+      for name in ('responses', 'bytes_in', 'bytes_out', 'seconds'):
+        self._counts['{}{{encoding="{}"}}'.format(name, encoding)] = 0
+
+  # encoding for the parsed Accept-Encoding header, None when the client accepts none of them
+  def negotiate(self, accept_encodings):
+    best, best_quality = None, 0
+    for encoding in self.encodings:
+      quality = accept_encodings[encoding]
+      if quality > best_quality:
+        best, best_quality = encoding, quality
+    return best
+
+  # False for bodies too small to compress
+  def worth(self, size):
+    if size >= self.min_size:
+      return True
+    with self._lock:
+      self._counts['small_responses'] += 1
+    return False
+
+  def compress(self, body, encoding):
+    start = perf_counter()
+    if encoding == 'br':
+      compressed = brotli.compress(body, quality=self.brotli_quality)
+    else:
+      # gzip header without a timestamp, the same body always compresses to the same bytes
+      compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      compressed = compressor.compress(body) + compressor.flush()
+    seconds = perf_counter() - start
+
+    with self._lock:
+      self._counts['responses{{encoding="{}"}}'.format(encoding)] += 1
+      self._counts['bytes_in{{encoding="{}"}}'.format(encoding)] += len(body)
+      self._counts['bytes_out{{encoding="{}"}}'.format(encoding)] += len(compressed)
+      self._counts['seconds{{encoding="{}"}}'.format(encoding)] += seconds
+    return compressed
+
+  '''
+  encode(body, encoding, cache)
+      the body compressed with the encoding. cache is (ResponseCache, key, etag)
+      when the body came from the response cache, then it's compressed only the first
+      time and the compressed body is kept in the cache next to it
+  '''
+  def encode(self, body, encoding, cache=None):
+    if cache is None:
+      return self.compress(body, encoding)
+    responses, key, etag = cache
+    return responses.compressed(key, etag, encoding, body, self.compress)
+
+  '''
+  compress_body(accept_encodings, status, mimetype, body, cache)
+      the part of compress_response the native endpoints of flaskr.asgi use too.
+      Returns (body, encoding, vary): encoding is None when the body is sent
+      as it is, vary when the response needs Vary: Accept-Encoding. See encode for cache
+  '''
+  def compress_body(self, accept_encodings, status, mimetype, body, cache=None):
+    if status != 200 or mimetype not in COMPRESS_MIMETYPES or not self.worth(len(body)):
+      return body, None, False
+    encoding = self.negotiate(accept_encodings)
+    if encoding is None:
+      return body, None, True
+    return self.encode(body, encoding, cache), encoding, True
+
+  '''
+  compress_response(request, response, cache)
+      compresses the Flask response for the request if it is worth it, streamed
+      ones are sent as they are. The ETag gets the encoding (see encoded_etag),
+      matching_etag accepts it back in If-None-Match and If-Match
+  '''
+  def compress_response(self, request, response, cache=None):
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+      return response
+    body, encoding, vary = self.compress_body(request.accept_encodings, response.status_code,
+      response.mimetype, response.get_data(), cache)
+    if vary:
+      response.vary.add('Accept-Encoding')
+    if encoding is not None:
+      response.set_data(body)
+      response.headers['Content-Encoding'] = encoding
+      if 'ETag' in response.headers:
+        response.headers['ETag'] = encoded_etag(response.headers['ETag'], encoding)
+    return response
+
+  # counters of compressed responses, read by the metrics
+  def stats(self):
+    with self._lock:
+      return dict(self._counts)
+
+
+'''
+response_compressor(app)
+    Compressor with the COMPRESS_* settings, None when COMPRESSION is off
+'''
+def response_compressor(app):
+  setting = app.config.get('COMPRESSION', os.getenv('COMPRESSION', 'on'))
+  if str(setting).lower() in ('off', 'false', '0', 'no'):
+    return None
+  return Compressor(int(app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)),
+    int(app.config.get('GZIP_LEVEL', GZIP_LEVEL)),
+    int(app.config.get('BROTLI_QUALITY', BROTLI_QUALITY)))
@@ -0,0 +1,319 @@
+import os
+import re
+import time
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import combinations
+
+from models import db, Question
+from .search import SEARCH_INDEX_TTL, question_texts
+
+# share of the character shingles two questions need in common to be duplicates
+DUPLICATE_THRESHOLD = float(os.getenv('DUPLICATE_THRESHOLD', 0.8))
+# what POST /questions and the import do with duplicates by default:
+# "allow" doesn't look for them, "flag" saves the question and returns them, "reject" doesn't save it
+DUPLICATE_CHECK = os.getenv('DUPLICATE_CHECK', 'allow')
+DUPLICATE_MODES = ('allow', 'flag', 'reject')
+# characters in one shingle
+SHINGLE_SIZE = 4
+# values in the MinHash signature, split into bands of BAND_ROWS values.
+# Questions with one band the same are compared, with 8 bands of 4 a pair that
+# is 80% similar is compared with 98.5% probability and one 50% similar with 40%
+MINHASH_SIZE = 32
+BAND_ROWS = 4
+BANDS = MINHASH_SIZE // BAND_ROWS
+# a band more questions share comes from words common to many of them (like
+# "which country"), not from duplicates. It's skipped, so a lookup compares a bounded
+# number of questions for any size of the bank
+MAX_BUCKET_SIZE = 50
+# ids of questions loaded with one query
+LOAD_CHUNK_SIZE = 500
+
+NOT_WORD = re.compile(r'[^\w\s]+')
+MASK = 2 ** 64 - 1
+
+
+# lowercase text without punctuation and with single spaces,
+# questions that differ only in that are exact duplicates
+def normalize_question(text):
+  return ' '.join(NOT_WORD.sub('', (text or '').lower()).split())
+
+
+def shingles(normalized):
+  if len(normalized) <= SHINGLE_SIZE:
+    return {normalized}
+  return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+# Jaccard similarity of two sets of shingles
+def similarity(a, b):
+  return len(a & b) / len(a | b) if a or b else 1.0
+
+
+'''
+minhash(shingles)
+    MinHash signature with one hash per shingle (one permutation hashing): the hash picks
+    one of MINHASH_SIZE bins and the bin keeps the smallest. An empty bin takes the value
+    of the next bin that has one, shifted by the distance, so short questions get
+    a full signature too. Uses Python's hash, signatures are only valid in this process
+'''
+def minhash(shingle_set):
+  bins = [None] * MINHASH_SIZE
+  for shingle in shingle_set:
+    value = hash(shingle) & MASK
+    i = value % MINHASH_SIZE
+    value //= MINHASH_SIZE
+    if bins[i] is None or value < bins[i]:
+      bins[i] = value
+
+  signature = list(bins)
+  for i in range(MINHASH_SIZE):
+    distance = 1
+    while signature[i] is None:
+      value = bins[(i + distance) % MINHASH_SIZE]
+      if value is not None:
+        signature[i] = value + (distance << 59)
+      distance += 1
+  return signature
+
+
+# key of every band of the signature
+def band_keys(signature):
+  return [hash(tuple(signature[band * BAND_ROWS:(band + 1) * BAND_ROWS])) for band in range(BANDS)]
+
+
+'''
+LSHIndex
+    question ids by the hash of their normalized text and by each band of their
+    MinHash signature, as sorted arrays of keys next to arrays of ids.
+    Questions that share any key are the candidates to compare, so looking for
+    duplicates of a question takes the same time for any size of the bank
+'''
+class LSHIndex:
+
+  def __init__(self):
+    self.exact = (array('q'), array('l'))
+    self.bands = [(array('q'), array('l')) for _ in range(BANDS)]
+
+  @staticmethod
+  def keys(text):
+    normalized = normalize_question(text)
+    return hash(normalized), band_keys(minhash(shingles(normalized)))
+
+  # built from (id, question) rows at once, faster than adding them one by one
+  @classmethod
+  def from_rows(cls, rows):
+    index = cls()
+    ids, exact, bands = array('l'), array('q'), [array('q') for _ in range(BANDS)]
+    for question_id, question in rows:
+      exact_key, keys = cls.keys(question)
+      ids.append(question_id)
+      exact.append(exact_key)
+      for band, key in zip(bands, keys):
+        band.append(key)
+
+    for (sorted_keys, sorted_ids), keys in zip([index.exact] + index.bands, [exact] + bands):
+      order = sorted(range(len(keys)), key=keys.__getitem__)
+      sorted_keys.extend(keys[i] for i in order)
+      sorted_ids.extend(ids[i] for i in order)
+    return index
+
+  def add(self, question_id, text):
+    exact_key, keys = self.keys(text)
+    for (sorted_keys, ids), key in zip([self.exact] + self.bands, [exact_key] + keys):
+      i = bisect_right(sorted_keys, key)
+      sorted_keys.insert(i, key)
+      ids.insert(i, question_id)
+
+  def remove(self, question_id, text):
+    exact_key, keys = self.keys(text)
+    for (sorted_keys, ids), key in zip([self.exact] + self.bands, [exact_key] + keys):
+      for i in range(bisect_left(sorted_keys, key), bisect_right(sorted_keys, key)):
+        if ids[i] == question_id:
+          del sorted_keys[i]
+          del ids[i]
+          break
+
+  # (ids with the same normalized text, ids with a band the same)
+  def candidates(self, text):
+    exact_key, keys = self.keys(text)
+    exact_keys, exact_ids = self.exact
+    exact = set(exact_ids[bisect_left(exact_keys, exact_key):bisect_right(exact_keys, exact_key)])
+    similar = set()
+    for (sorted_keys, ids), key in zip(self.bands, keys):
+      start, end = bisect_left(sorted_keys, key), bisect_right(sorted_keys, key)
+      if end - start <= MAX_BUCKET_SIZE:
+        similar.update(ids[start:end])
+    return exact, similar - exact
+
+  # lists of ids that share a key, (True if the key is the exact one, ids)
+  def groups(self):
+    for exact, (sorted_keys, ids) in zip([True] + [False] * BANDS, [self.exact] + self.bands):
+      start = 0
+      for end in range(1, len(sorted_keys) + 1):
+        if end == len(sorted_keys) or sorted_keys[end] != sorted_keys[start]:
+          if end - start > 1 and (exact or end - start <= MAX_BUCKET_SIZE):
+            yield exact, list(ids[start:end])
+          start = end
+
+
+# question texts of the ids, by id
+def load_texts(question_ids):
+  question_ids = sorted(question_ids)
+  texts = {}
+  for i in range(0, len(question_ids), LOAD_CHUNK_SIZE):
+    texts.update(db.session.query(Question.id, Question.question)
+      .filter(Question.id.in_(question_ids[i:i + LOAD_CHUNK_SIZE])))
+  return texts
+
+
+'''
+DuplicateIndex
+    LSHIndex of all questions, built on the first use and kept in sync with
+    the writes of this process through Question.observers, like SearchIndex.
+    Writes from other workers are picked up by a rebuild every SEARCH_INDEX_TTL seconds.
+    Candidates are checked against their text (from texts, the database by default),
+    so only questions at least threshold similar are reported
+'''
+class DuplicateIndex:
+
+  def __init__(self, app, ttl=SEARCH_INDEX_TTL, rows=None, threshold=DUPLICATE_THRESHOLD, texts=None):
+    self.app = app
+    self.ttl = ttl
+    self.rows = rows or question_texts
+    self.texts = texts or load_texts
+    self.threshold = threshold
+    self._index = None
+    self._built_at = 0
+    self._pending = None
+    self._lock = threading.Lock()
+    self._build_lock = threading.Lock()
+    Question.observers.add(self)
+
+  def build(self):
+    with self._lock:
+      self._pending = []
+
+    with self.app.app_context():
+      index = LSHIndex.from_rows((question_id, question) for question_id, question, _ in self.rows())
+
+    with self._lock:
+      self._index = index
+      self._built_at = time.time()
+      # writes that happened while we were reading the table
+      pending, self._pending = self._pending, None
+      for action, old, new in pending:
+        self._apply(old, new)
+
+  def _apply(self, old, new):
+    if old is not None:
+      self._index.remove(old['id'], old['question'])
+    if new is not None:
+      self._index.add(new['id'], new['question'])
+
+  def question_changed(self, action, old, new):
+    with self._lock:
+      if self._pending is not None:
+        self._pending.append((action, old, new))
+      if self._index is None:
+        return
+      if action is None:
+        # questions were changed in bulk, rebuild on the next use
+        self._built_at = 0
+        return
+      self._apply(old, new)
+
+  def _ensure_built(self):
+    if self._index is None:
+      with self._build_lock:
+        if self._index is None:
+          self.build()
+    elif time.time() - self._built_at > self.ttl and self._build_lock.acquire(False):
+      # the old index keeps serving while the new one is built
+      def rebuild():
+        try:
+          self.build()
+        finally:
+          self._build_lock.release()
+      threading.Thread(target=rebuild, daemon=True).start()
+
+  '''
+  find(text, exclude, threshold)
+      returns the questions that are duplicates of the text, as (id, question, similarity)
+      with the most similar first. exclude is the id of the question itself
+  '''
+  def find(self, text, exclude=None, threshold=None):
+    threshold = self.threshold if threshold is None else threshold
+    self._ensure_built()
+    with self._lock:
+      exact, similar = self._index.candidates(text)
+    exact.discard(exclude)
+    similar.discard(exclude)
+    if not exact and not similar:
+      return []
+
+    texts = self.texts(exact | similar)
+    text_shingles = shingles(normalize_question(text))
+    duplicates = []
+    for question_id, question in texts.items():
+      score = similarity(text_shingles, shingles(normalize_question(question)))
+      if question_id in exact or score >= threshold:
+        duplicates.append((question_id, question, round(score, 3)))
+    duplicates.sort(key=lambda duplicate: (-duplicate[2], duplicate[0]))
+    return duplicates
+
+  '''
+  clusters(threshold)
+      groups all questions that are duplicates of each other, returns lists of their ids
+      with the biggest clusters first. Only questions that share a key of the index
+      are compared, pairs at least threshold similar join their clusters
+  '''
+  def clusters(self, threshold=None):
+    threshold = self.threshold if threshold is None else threshold
+    self._ensure_built()
+    with self._lock:
+      groups = list(self._index.groups())
+    if not groups:
+      return []
+
+    texts = self.texts(set(question_id for _, ids in groups for question_id in ids))
+    question_shingles = {}
+
+    def shingles_of(question_id):
+      if question_id not in question_shingles:
+        question_shingles[question_id] = shingles(normalize_question(texts[question_id]))
+      return question_shingles[question_id]
+
+    parent = {}
+
+    def root(question_id):
+      while parent.get(question_id, question_id) != question_id:
+        question_id = parent[question_id]
+      return question_id
+
+    def join(a, b):
+      a, b = root(a), root(b)
+      if a != b:
+        parent[max(a, b)] = min(a, b)
+
+    compared = set()
+    for exact, ids in groups:
+      # questions deleted since the index was read
+      ids = [question_id for question_id in ids if question_id in texts]
+      if exact:
+        for question_id in ids[1:]:
+          join(ids[0], question_id)
+        continue
+      for a, b in combinations(sorted(ids), 2):
+        if (a, b) not in compared:
+          compared.add((a, b))
+          if similarity(shingles_of(a), shingles_of(b)) >= threshold:
+            join(a, b)
+
+    clusters = {}
+    for question_id in parent:
+      clusters.setdefault(root(question_id), set()).add(question_id)
+    for first, ids in clusters.items():
+      ids.add(first)
+    return sorted((sorted(ids) for ids in clusters.values()), key=lambda ids: (-len(ids), ids[0]))
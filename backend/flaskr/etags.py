@@ -0,0 +1,133 @@
+import json
+import hashlib
+from functools import wraps
+
+from flask import request, make_response, current_app
+from werkzeug.http import quote_etag
+
+from models import DataVersion
+from .responses import request_key
+from .compression import ENCODINGS
+
+'''
+conditional(*tables, cache, versions, flights, compressor)
+    decorator for GET endpoints that depend only on the given tables
+    (names of DataVersion rows, or functions that make the name from the
+    arguments of the endpoint). The ETag is made from their versions (one small
+    query), so a request with a matching If-None-Match gets 304 before the endpoint
+    runs any other query or builds the response. With a ResponseCache the encoded
+    response is kept for that ETag and sent again until one of the versions changes.
+    With a SingleFlight identical requests for the same ETag that come while
+    the response is built share it. versions reads them, DataVersion.current_many by default.
+    With a Compressor cached responses are compressed once and kept compressed in the cache too
+'''
+def conditional(*tables, cache=None, versions=DataVersion.current_many, flights=None, compressor=None):
+  def decorator(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      names = [table(**kwargs) if callable(table) else table for table in tables]
+      key = request_key(request) if cache is not None or flights is not None else None
+      conditional_request = ConditionalRequest(names, versions(*names), request.if_none_match, key, cache)
+      shared = False
+
+      if conditional_request.not_modified:
+        response = make_response('', 304)
+      elif conditional_request.hit is not None:
+        response = current_app.response_class(conditional_request.hit,
+          mimetype=current_app.config['JSONIFY_MIMETYPE'])
+      else:
+        # (status, body, mimetype) of the response, from the view or a request in flight
+        def render():
+          response = make_response(view(*args, **kwargs))
+          body = response.get_data()
+          conditional_request.rendered(response.status_code, body)
+          return response.status_code, body, response.mimetype
+
+        if flights is not None:
+          (status, body, mimetype), shared = flights.do(conditional_request.flight_key, render)
+        else:
+          status, body, mimetype = render()
+        response = current_app.response_class(body, status=status, mimetype=mimetype)
+        if status != 200:
+          return response
+
+      for name, value in conditional_request.headers(shared):
+        response.headers[name] = value
+      if compressor is not None and conditional_request.cached is not None:
+        response = compressor.compress_response(request, response, conditional_request.cached)
+      return response
+    return wrapper
+  return decorator
+
+
+'''
+matching_etag(etags, etag, weak)
+    the tag of the parsed If-None-Match (weak comparison) or If-Match (weak=False)
+    that is the etag or the etag of its compressed response ("questions12-gzip"),
+    clients send back the one they got. None when none of them is
+'''
+def matching_etag(etags, etag, weak=True):
+  contains = etags.contains_weak if weak else etags.contains
+  for variant in [etag] + ['{}-{}'.format(etag, encoding) for encoding in ENCODINGS]:
+    if contains(variant):
+      return variant
+  return None
+
+
+# ETag of the versions of the tables, like "questions12-categories3"
+def versions_etag(names, versions):
+  return '-'.join('{}{}'.format(name, version) for name, version in zip(names, versions))
+
+
+'''
+ConditionalRequest(names, versions, if_none_match, key, cache)
+    the part of conditional that doesn't read the database, the native endpoints
+    of flaskr.asgi use it too: the ETag of the versions, if the client has it
+    already (not_modified), the body from the ResponseCache for it (hit) and the
+    headers of the response. key is the request_key of the request
+'''
+class ConditionalRequest:
+
+  def __init__(self, names, versions, if_none_match, key=None, cache=None):
+    self.etag = versions_etag(names, versions)
+    self.key = key
+    self.cache = cache
+    # the tag the client has, it's sent back with 304
+    self.matched = matching_etag(if_none_match, self.etag)
+    self.not_modified = self.matched is not None
+    self.hit = None
+    if cache is not None and not self.not_modified:
+      self.hit = cache.get(key, self.etag)
+
+  # (ResponseCache, key, etag) for Compressor.encode, None without the cache
+  @property
+  def cached(self):
+    return (self.cache, self.key, self.etag) if self.cache is not None else None
+
+  # requests with the same key and ETag share the response
+  @property
+  def flight_key(self):
+    return (self.key, self.etag)
+
+  # keeps the rendered body in the cache
+  def rendered(self, status, body):
+    if status == 200 and self.cache is not None:
+      self.cache.put(self.key, self.etag, body)
+
+  # ETag and cache headers of the response, shared when it came from a request in flight
+  def headers(self, shared=False):
+    # browsers keep the response but ask if it changed every time
+    headers = [('ETag', quote_etag(self.matched or self.etag)), ('Cache-Control', 'no-cache')]
+    if self.not_modified:
+      return headers
+    if self.cache is not None:
+      headers.append(('X-Cache', 'HIT' if self.hit is not None else 'MISS'))
+    if shared:
+      headers.append(('X-Coalesced', 'true'))
+    return headers
+
+
+# ETag of one formatted question, it changes when any of its values change
+def question_etag(formatted_question):
+  content = json.dumps(formatted_question, sort_keys=True, default=str)
+  return hashlib.sha1(content.encode('utf-8')).hexdigest()
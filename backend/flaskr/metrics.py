@@ -0,0 +1,339 @@
+import os
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context, jsonify, Response
+from sqlalchemy import event, text
+
+from models import db, pool_state
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# parts of a request that are timed, in the order they are in Server-Timing header
+PARTS = ('db', 'orm', 'format', 'json')
+
+
+def metrics_enabled(app):
+  value = app.config.get('METRICS_ENABLED', os.getenv('METRICS_ENABLED', ''))
+  return str(value).lower() in ('1', 'true', 'yes')
+
+
+# times of one request, kept in flask.g
+class RequestTimings:
+  __slots__ = ('start', 'queries') + PARTS
+
+  def __init__(self):
+    self.start = perf_counter()
+    self.queries = 0
+    for part in PARTS:
+      setattr(self, part, 0.0)
+
+
+def current_timings():
+  if has_request_context():
+    return g.get('timings', None)
+  return None
+
+
+# adds the time spent in the block (like formatting questions) to a part of the current request
+@contextmanager
+def timing(part):
+  timings = current_timings()
+  if timings is None:
+    yield
+    return
+  start = perf_counter()
+  try:
+    yield
+  finally:
+    setattr(timings, part, getattr(timings, part) + perf_counter() - start)
+
+
+'''
+QueryTimer
+    TimedQuery timer, loading time without the time the database itself took
+'''
+class QueryTimer:
+
+  def start(self):
+    timings = current_timings()
+    if timings is None:
+      return None
+    return (timings, perf_counter(), timings.db)
+
+  def stop(self, token):
+    if token is None:
+      return
+    timings, start, db_time = token
+    timings.orm += perf_counter() - start - (timings.db - db_time)
+
+
+# subclass of the app's JSON encoder that times encoding
+def timed_encoder(encoder):
+  class TimedJSONEncoder(encoder):
+
+    def encode(self, o):
+      timings = current_timings()
+      if timings is None:
+        return super().encode(o)
+      start = perf_counter()
+      try:
+        return super().encode(o)
+      finally:
+        timings.json += perf_counter() - start
+
+  return TimedJSONEncoder
+
+
+'''
+Metrics
+    per route: latency histogram, number of requests and queries
+    and total time of every part. Kept in memory of the worker
+'''
+class Metrics:
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # (method, route) -> [bucket counts, count, sum, queries, db, orm, format, json]
+    self._routes = {}
+    # (prefix, function returning name -> count) of counters kept by others, like caches
+    self._counters = []
+    # the same for gauges, values that go up and down
+    self._gauges = []
+    # the same for histograms, read(): name -> {'buckets': {bound: count}, 'count', 'sum'}
+    self._histograms = []
+
+  # adds counters to the metrics, read(): name -> value. They are named prefix_name_total
+  def add_counters(self, prefix, read):
+    self._counters.append((prefix, read))
+
+  # adds gauges to the metrics, read(): name -> value. They are named prefix_name
+  def add_gauges(self, prefix, read):
+    self._gauges.append((prefix, read))
+
+  # adds histograms to the metrics, they are named prefix_name
+  def add_histograms(self, prefix, read):
+    self._histograms.append((prefix, read))
+
+  def record(self, method, route, seconds, timings):
+    with self._lock:
+      stats = self._routes.get((method, route))
+      if stats is None:
+        stats = self._routes[(method, route)] = [[0] * len(LATENCY_BUCKETS), 0, 0.0, 0] + [0.0] * len(PARTS)
+
+      buckets = stats[0]
+      for i, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+          buckets[i] += 1
+      stats[1] += 1
+      stats[2] += seconds
+      stats[3] += timings.queries
+      for i, part in enumerate(PARTS):
+        stats[4 + i] += getattr(timings, part)
+
+  # metrics in Prometheus text format
+  def render(self):
+    with self._lock:
+      routes = sorted((key, [list(stats[0])] + stats[1:]) for key, stats in self._routes.items())
+
+    lines = [
+      '# HELP trivia_request_duration_seconds Time to handle a request.',
+      '# TYPE trivia_request_duration_seconds histogram'
+    ]
+    for (method, route), stats in routes:
+      labels = 'method="{}",route="{}"'.format(method, route)
+      for bound, count in zip(LATENCY_BUCKETS, stats[0]):
+        lines.append('trivia_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+      lines.append('trivia_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, stats[1]))
+      lines.append('trivia_request_duration_seconds_sum{{{}}} {}'.format(labels, stats[2]))
+      lines.append('trivia_request_duration_seconds_count{{{}}} {}'.format(labels, stats[1]))
+
+    lines.append('# HELP trivia_db_queries_total SQL queries run by requests.')
+    lines.append('# TYPE trivia_db_queries_total counter')
+    for (method, route), stats in routes:
+      lines.append('trivia_db_queries_total{{method="{}",route="{}"}} {}'.format(method, route, stats[3]))
+
+    for i, part in enumerate(PARTS):
+      lines.append('# HELP trivia_{}_seconds_total Time requests spent in {}.'.format(part, part))
+      lines.append('# TYPE trivia_{}_seconds_total counter'.format(part))
+      for (method, route), stats in routes:
+        lines.append('trivia_{}_seconds_total{{method="{}",route="{}"}} {}'.format(
+          part, method, route, stats[4 + i]))
+
+    for prefix, read in self._counters:
+      lines.extend(labelled_lines(prefix, read(), 'counter', '_total'))
+
+    for prefix, read in self._gauges:
+      lines.extend(labelled_lines(prefix, read(), 'gauge'))
+
+    for prefix, read in self._histograms:
+      typed = set()
+      for name, histogram in sorted(read().items()):
+        base, _, labels = name.partition('{')
+        metric = '{}_{}'.format(prefix, base)
+        labels = labels.rstrip('}')
+        if metric not in typed:
+          typed.add(metric)
+          lines.append('# TYPE {} histogram'.format(metric))
+        for bound, count in sorted(histogram['buckets'].items()):
+          lines.append('{}_bucket{{{}le="{}"}} {}'.format(metric, labels + ',' if labels else '', bound, count))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(metric, labels + ',' if labels else '', histogram['count']))
+        labels = '{{{}}}'.format(labels) if labels else ''
+        lines.append('{}_sum{} {}'.format(metric, labels, histogram['sum']))
+        lines.append('{}_count{} {}'.format(metric, labels, histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+# lines of counters or gauges, names can have labels like 'checked_out{bind="primary"}'
+def labelled_lines(prefix, values, kind, suffix=''):
+  lines = []
+  typed = set()
+  for name, value in sorted(values.items()):
+    base, brace, labels = name.partition('{')
+    metric = '{}_{}{}'.format(prefix, base, suffix)
+    if metric not in typed:
+      typed.add(metric)
+      lines.append('# TYPE {} {}'.format(metric, kind))
+    lines.append('{}{}{} {}'.format(metric, brace, labels, value))
+  return lines
+
+
+# engines of the primary database and the read replicas by name
+def database_engines(app):
+  with app.app_context():
+    engines = {'primary': db.get_engine(app)}
+    for bind in app.config.get('SQLALCHEMY_BINDS') or {}:
+      engines[bind] = db.get_engine(app, bind=bind)
+  return engines
+
+
+'''
+PoolMetrics
+    connection pool of every database for the metrics: what is checked out now,
+    counters of the connections opened, closed and checked out and
+    a histogram of the time checkouts waited for a connection
+'''
+class PoolMetrics:
+
+  def __init__(self, app):
+    self.engines = database_engines(app)
+
+  def gauges(self):
+    gauges = {}
+    for bind, engine in self.engines.items():
+      for name, value in pool_state(engine.pool).items():
+        gauges['{}{{bind="{}"}}'.format(name, bind)] = value
+    return gauges
+
+  def counters(self):
+    counters = {}
+    for bind, engine in self.engines.items():
+      stats = engine.pool_stats.read()
+      for name in ('connects', 'closes', 'invalidated', 'checkouts', 'timeouts'):
+        counters['{}{{bind="{}"}}'.format(name, bind)] = stats[name]
+    return counters
+
+  def histograms(self):
+    return dict(('wait_seconds{{bind="{}"}}'.format(bind), engine.pool_stats.read()['wait'])
+      for bind, engine in self.engines.items())
+
+  # GET /status: pool settings and state of every database and, on Postgres,
+  # how many workers with these pools fit into its max_connections
+  def status(self, app):
+    options = app.config.get('DB_POOL_OPTIONS', {})
+    pools = {}
+    for bind, engine in self.engines.items():
+      pool = dict(pool_state(engine.pool), **engine.pool_stats.read())
+      pool['class'] = type(engine.pool).__name__
+      pool['wait']['buckets'] = sorted(pool['wait']['buckets'].items())
+      pools[bind] = pool
+
+    status = {
+      'pid': os.getpid(),
+      'pool_options': options,
+      'pools': pools,
+      # connections one worker can open to the primary database
+      'connections_per_worker': options.get('pool_size', 0) + options.get('max_overflow', 0),
+      'max_connections': None,
+      'connections': None,
+      'max_workers': None
+    }
+    primary = self.engines['primary']
+    if primary.dialect.name == 'postgresql':
+      with primary.connect() as connection:
+        status['max_connections'] = int(connection.execute(text('SHOW max_connections')).scalar())
+        status['connections'] = connection.execute(text(
+          'SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()')).scalar()
+      if status['connections_per_worker']:
+        status['max_workers'] = status['max_connections'] // status['connections_per_worker']
+    return status
+
+
+'''
+init_metrics(app)
+    when METRICS_ENABLED is set, times every request and adds Server-Timing header:
+    db (SQL queries), orm (loading rows into objects), format (building the questions)
+    and json (encoding the response). Metrics are served at GET /metrics,
+    the connection pools at GET /status. When it's not set nothing is registered, so there's no overhead
+'''
+def init_metrics(app):
+  if not metrics_enabled(app):
+    return None
+
+  metrics = Metrics()
+  # read by TimedQuery of this app only, other apps in the process aren't timed by it
+  app.extensions['query_timer'] = QueryTimer()
+  app.json_encoder = timed_encoder(app.json_encoder)
+
+  def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    if timings is not None:
+      timings.queries += 1
+      conn.info.setdefault('query_start', []).append(perf_counter())
+
+  def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    starts = conn.info.get('query_start')
+    if timings is not None and starts:
+      timings.db += perf_counter() - starts.pop()
+
+  # the primary database and the read replicas
+  for engine in database_engines(app).values():
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+  @app.before_request
+  def start_timing():
+    g.timings = RequestTimings()
+
+  @app.after_request
+  def record_timing(res):
+    timings = g.pop('timings', None)
+    if timings is None:
+      return res
+
+    seconds = perf_counter() - timings.start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.record(request.method, route, seconds, timings)
+
+    res.headers.add('Server-Timing', ', '.join(
+      ['{};dur={:.2f}'.format(part, getattr(timings, part) * 1000) for part in PARTS] +
+      ['queries;desc="{}"'.format(timings.queries), 'total;dur={:.2f}'.format(seconds * 1000)]))
+    return res
+
+  pools = PoolMetrics(app)
+  metrics.add_gauges('trivia_db_pool', pools.gauges)
+  metrics.add_counters('trivia_db_pool', pools.counters)
+  metrics.add_histograms('trivia_db_pool', pools.histograms)
+
+  @app.route('/metrics', methods=['GET'])
+  def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+  @app.route('/status', methods=['GET'])
+  def get_status():
+    return jsonify(dict(success=True, **pools.status(app)))
+
+  return metrics
@@ -0,0 +1,192 @@
+import os
+import time
+import random
+import threading
+import itertools
+from array import array
+
+from models import db, Question
+
+# how long (in seconds) the pool of question ids is kept before it's loaded again,
+# other workers can add or delete questions without us knowing
+QUESTION_POOL_TTL = int(os.getenv('QUESTION_POOL_TTL', 60))
+# how many random picks are tried before falling back to filtering the whole pool
+MAX_RANDOM_TRIES = 20
+
+# key of the pool ids of a category (0 for all of them) and difficulty (None for any)
+def pool_key(category_id, difficulty=None):
+  if difficulty is None:
+    return str(category_id)
+  return '{}:{}'.format(category_id, difficulty)
+
+
+# keys of the pool ids a question with the category and difficulty is in, besides '0'
+def question_pool_keys(category, difficulty):
+  if difficulty is None:
+    return (pool_key(category), )
+  return (pool_key(category), pool_key(category, difficulty), pool_key(0, difficulty))
+
+
+'''
+QuestionPool
+    keeps the ids of all questions in memory, grouped by category and by
+    category and difficulty, so random unanswered questions can be picked
+    without loading the candidate rows. Only the picked questions are then
+    loaded from the database.
+'''
+class QuestionPool:
+
+  def __init__(self, ttl=QUESTION_POOL_TTL):
+    self.ttl = ttl
+    # (ids by key, time loaded, Question.version, generation) of the last load,
+    # replaced as a whole so a request never sees half of a load or None
+    self._pool = None
+    # invalidate takes the next one, pools loaded before it are stale
+    self._generations = itertools.count(1)
+    self._generation = 0
+    self._lock = threading.Lock()
+
+  def invalidate(self):
+    self._generation = next(self._generations)
+
+  # Loads only (id, category, difficulty) columns
+  def _load(self):
+    return self.fill(db.session.query(Question.id, Question.category, Question.difficulty))
+
+  # fills the pool from (id, category, difficulty) rows, category 0 holds the ids of all questions.
+  # The version and generation are taken before the rows are read, a write meanwhile makes the pool stale
+  def fill(self, rows, version=None, generation=None):
+    version = Question.version if version is None else version
+    generation = self._generation if generation is None else generation
+    ids = {'0': array('l')}
+    for question_id, category, difficulty in rows:
+      ids['0'].append(question_id)
+      for key in question_pool_keys(category, difficulty):
+        ids.setdefault(key, array('l')).append(question_id)
+
+    self._pool = (ids, time.time(), version, generation)
+    return ids
+
+  def _stale(self, pool):
+    return (pool is None or pool[3] != self._generation or pool[2] != Question.version or
+      time.time() - pool[1] > self.ttl)
+
+  def stale(self):
+    return self._stale(self._pool)
+
+  def ids(self, category_id, difficulty=None):
+    pool = self._pool
+    if self._stale(pool):
+      with self._lock:
+        # requests that waited for the lock use the ids the first one loaded
+        pool = self._pool
+        ids = self._load() if self._stale(pool) else pool[0]
+    else:
+      ids = pool[0]
+    return ids.get(pool_key(category_id, difficulty), array('l'))
+
+  '''
+  sample(category_ids, previous_questions, count, difficulty)
+      returns up to count different random ids from the categories (0 for all)
+      with the difficulty that are not in previous_questions, fewer if there aren't enough
+  '''
+  def sample(self, category_ids, previous_questions, count, difficulty=None):
+    keys = set(str(category_id) for category_id in category_ids)
+    if '0' in keys:
+      keys = {'0'}
+    populations = [self.ids(key, difficulty) for key in sorted(keys)]
+    populations = [ids for ids in populations if ids]
+    answered = set(int(question_id) for question_id in previous_questions)
+    total = sum(len(ids) for ids in populations)
+    picked = []
+    chosen = set()
+
+    # while most questions are still unanswered random picks hit them in a few tries.
+    # A random position in all the populations together is picked, so every id has the same chance
+    if total > 2 * (len(answered) + count):
+      for _ in range(count * MAX_RANDOM_TRIES):
+        position = random.randrange(total)
+        for ids in populations:
+          if position < len(ids):
+            break
+          position -= len(ids)
+        question_id = ids[position]
+        if question_id not in answered and question_id not in chosen:
+          picked.append(question_id)
+          chosen.add(question_id)
+          if len(picked) == count:
+            return picked
+
+    unanswered = [question_id for ids in populations for question_id in ids
+      if question_id not in answered and question_id not in chosen]
+    return picked + random.sample(unanswered, min(count - len(picked), len(unanswered)))
+
+
+'''
+QuizRequest(body, max_count)
+    the questions a POST /quizzes body asks for: from categories (or quiz_category,
+    0 for all), with difficulty, count of them and not in previous_questions.
+    Raises ValueError when they aren't valid. The Flask app and flaskr.asgi
+    sample ids from the pool, load them and add what they found
+'''
+class QuizRequest:
+
+  def __init__(self, body, max_count):
+    self.previous_questions = body['previous_questions']
+    category_ids = body.get('categories', None)
+    if category_ids is None:
+      category_ids = [body['quiz_category']['id']]
+    self.category_ids = category_ids
+    self.difficulty = body.get('difficulty', None)
+    self.count = body.get('count', None)
+
+    if (not isinstance(category_ids, list) or not category_ids
+        or (self.difficulty is not None and not isinstance(self.difficulty, int))
+        or (self.count is not None and (not isinstance(self.count, int) or self.count < 1))):
+      raise ValueError('quiz request is not valid')
+
+    self.category_keys = set(str(category_id) for category_id in category_ids)
+    self.wanted = min(self.count or 1, max_count)
+    self.questions = []
+
+  def matches(self, question):
+    return (('0' in self.category_keys or str(question['category']) in self.category_keys) and
+      (self.difficulty is None or question['difficulty'] == self.difficulty))
+
+  # random unanswered ids from the pool for the questions still missing, empty when there are no more
+  def sample(self, question_pool):
+    return question_pool.sample(self.category_ids,
+      self.previous_questions + [question['id'] for question in self.questions],
+      self.wanted - len(self.questions), self.difficulty)
+
+  '''
+  add(question_ids, questions)
+      adds the loaded questions (in any order) of the sampled ids that still match.
+      Returns False when some of them were deleted or moved by another worker, then
+      the pool is out of date and the missing ones are sampled again after it's loaded
+  '''
+  def add(self, question_ids, questions):
+    by_id = {question['id']: question for question in questions}
+    found = [by_id[question_id] for question_id in question_ids
+      if question_id in by_id and self.matches(by_id[question_id])]
+    self.questions += found
+    return len(found) == len(question_ids)
+
+  # body of the response
+  def response(self):
+    # If there are no more unanswerd questions send this
+    if not self.questions:
+      return {
+        "status": "no more questions"
+      }
+
+    if self.count is None:
+      return {
+        "success": True,
+        "question": self.questions[0]
+      }
+
+    return {
+      "success": True,
+      "questions": self.questions
+    }
@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+from itertools import count
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+from models import db
+
+# endpoints that only read, they are sent to a replica
+READ_ENDPOINTS = frozenset(['get_categories', 'get_questions', 'search_question', 'category_questions',
+  'get_quizzes', 'get_question_stats'])
+# seconds a client's reads go to the primary database after its write, so it sees it
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+# seconds between health checks of the replicas
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 5))
+# cookie with the time until which the client reads from the primary database
+PRIMARY_COOKIE = 'trivia_primary_until'
+PRIMARY = 'primary'
+
+
+# URLs of the read replicas from SQLALCHEMY_REPLICAS setting (a list) or
+# DATABASE_REPLICAS enviroment variable (separated by commas)
+def replica_urls(app):
+  urls = app.config.get('SQLALCHEMY_REPLICAS', None)
+  if urls is None:
+    urls = [url.strip() for url in os.getenv('DATABASE_REPLICAS', '').split(',') if url.strip()]
+  return list(urls)
+
+
+'''
+configure_replicas(app)
+    adds the replicas to SQLALCHEMY_BINDS as replica_0, replica_1, ...
+    before setup_db, returns their names
+'''
+def configure_replicas(app):
+  names = []
+  binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+  for i, url in enumerate(replica_urls(app)):
+    names.append('replica_{}'.format(i))
+    binds[names[-1]] = url
+  if names:
+    app.config['SQLALCHEMY_BINDS'] = binds
+  return names
+
+
+'''
+ReplicaRouter
+    sends the queries of READ_ENDPOINTS to the healthy replicas in turn, everything
+    else to the primary database. After a write the client gets a cookie and its
+    reads go to the primary for REPLICA_STICKY_SECONDS, so it sees what it wrote.
+    Replicas are checked with SELECT 1 every REPLICA_CHECK_INTERVAL seconds and
+    a replica whose connection failed isn't used until it passes a check again.
+    With all replicas down reads go to the primary
+'''
+class ReplicaRouter:
+
+  def __init__(self, app, names, sticky_seconds=REPLICA_STICKY_SECONDS,
+      check_interval=REPLICA_CHECK_INTERVAL):
+    self.app = app
+    self.names = names
+    self.sticky_seconds = sticky_seconds
+    self.check_interval = check_interval
+    self.healthy = dict((name, True) for name in names)
+    self.requests = dict((name, 0) for name in [PRIMARY] + names)
+    self._next = count()
+    self._checked_at = 0
+    self._check_lock = threading.Lock()
+    self._counts_lock = threading.Lock()
+
+    with app.app_context():
+      for name in names:
+        event.listen(db.get_engine(app, bind=name), 'handle_error', self._failed(name))
+    self.check()
+
+  # a replica whose connection fails is marked down right away
+  def _failed(self, name):
+    def handle_error(context):
+      if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+        self.healthy[name] = False
+    return handle_error
+
+  def check(self):
+    self._checked_at = time.time()
+    with self.app.app_context():
+      for name in self.names:
+        try:
+          with db.get_engine(self.app, bind=name).connect() as connection:
+            connection.execute(text('SELECT 1'))
+          self.healthy[name] = True
+        except Exception:
+          self.healthy[name] = False
+          self.app.logger.warning('Read replica %s is down', name)
+
+  # checks the replicas in the background when it's time
+  def _maybe_check(self):
+    if (time.time() - self._checked_at > self.check_interval and
+        self._check_lock.acquire(False)):
+      self._checked_at = time.time()
+
+      def check():
+        try:
+          self.check()
+        finally:
+          self._check_lock.release()
+      threading.Thread(target=check, daemon=True).start()
+
+  # name of the bind the request reads from
+  def choose(self, req):
+    if req.endpoint not in READ_ENDPOINTS:
+      return PRIMARY
+    try:
+      if float(req.cookies.get(PRIMARY_COOKIE, 0)) > time.time():
+        return PRIMARY
+    except ValueError:
+      pass
+
+    self._maybe_check()
+    healthy = [name for name in self.names if self.healthy[name]]
+    if not healthy:
+      return PRIMARY
+    return healthy[next(self._next) % len(healthy)]
+
+  def route(self, req):
+    name = self.choose(req)
+    if name != PRIMARY:
+      db.session.info['read_bind'] = name
+    else:
+      db.session.info.pop('read_bind', None)
+    with self._counts_lock:
+      self.requests[name] += 1
+    return name
+
+  # after a successful write the client reads from the primary for a while
+  def after_write(self, req, res):
+    if (req.method not in ('GET', 'HEAD', 'OPTIONS') and req.endpoint not in READ_ENDPOINTS
+        and res.status_code < 400):
+      res.set_cookie(PRIMARY_COOKIE, '%.3f' % (time.time() + self.sticky_seconds),
+        max_age=int(self.sticky_seconds) + 1, httponly=True)
+    return res
+
+  # requests routed to every bind, for the metrics
+  def request_counts(self):
+    with self._counts_lock:
+      return dict(('requests{{bind="{}"}}'.format(name), value) for name, value in self.requests.items())
+
+  # if the replicas are up, for the metrics
+  def stats(self):
+    return dict(('replica_up{{bind="{}"}}'.format(name), int(self.healthy[name])) for name in self.names)
@@ -0,0 +1,192 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+# bytes of responses the cache keeps before it evicts the least recently used ones
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+# key of the current request, the same for the same arguments in any order
+def request_key(req):
+  return req.path + '?' + urlencode(sorted(req.args.items(multi=True)))
+
+
+'''
+MemoryResponseStore
+    keeps encoded responses in this process, for a single worker.
+    Least recently used ones are evicted when together they have more than max_bytes
+'''
+class MemoryResponseStore:
+
+  def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+
+  # Returns (etag, body) or None
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+      return entry
+
+  def put(self, key, etag, body):
+    size = len(key) + len(body)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self._bytes -= len(key) + len(old[1])
+      self._entries[key] = (etag, body)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        old_key, (_, old_body) = self._entries.popitem(last=False)
+        self._bytes -= len(old_key) + len(old_body)
+        self.evictions += 1
+
+
+'''
+SQLiteResponseStore
+    keeps encoded responses in a sqlite file so all workers on one machine share them.
+    Time of the last use is updated at most once a second per entry,
+    so hits don't write to the file every time
+'''
+class SQLiteResponseStore:
+
+  def __init__(self, path, max_bytes=RESPONSE_CACHE_BYTES):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.evictions = 0
+    self._local = threading.local()
+    self._connection().execute('''CREATE TABLE IF NOT EXISTS response_cache (
+      key TEXT PRIMARY KEY,
+      etag TEXT,
+      body BLOB,
+      size INTEGER,
+      used REAL)''')
+    self._connection().execute(
+      'CREATE INDEX IF NOT EXISTS response_cache_used ON response_cache (used)')
+
+  # sqlite connections can't be shared between threads
+  def _connection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+      connection.execute('PRAGMA journal_mode=WAL')
+      self._local.connection = connection
+    return connection
+
+  def get(self, key):
+    connection = self._connection()
+    row = connection.execute('SELECT etag, body, used FROM response_cache WHERE key = ?',
+      (key, )).fetchone()
+    if row is None:
+      return None
+
+    now = time.time()
+    if now - row[2] > 1:
+      connection.execute('UPDATE response_cache SET used = ? WHERE key = ?', (now, key))
+    return row[0], row[1]
+
+  def put(self, key, etag, body):
+    size = len(key) + len(body)
+    if size > self.max_bytes:
+      return
+    connection = self._connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      connection.execute('INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)',
+        (key, etag, body, size, time.time()))
+      excess = connection.execute('SELECT total(size) FROM response_cache').fetchone()[0] - self.max_bytes
+      if excess > 0:
+        evicted = []
+        for old_key, old_size in connection.execute(
+            'SELECT key, size FROM response_cache ORDER BY used'):
+          evicted.append((old_key, ))
+          excess -= old_size
+          if excess <= 0:
+            break
+        connection.executemany('DELETE FROM response_cache WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+      connection.execute('COMMIT')
+    except:
+      connection.execute('ROLLBACK')
+      raise
+
+
+'''
+ResponseCache
+    encoded responses by request key, each stored with the ETag it was built for.
+    The ETag is made from the data versions the response depends on (see conditional),
+    which writes bump, so an entry with another ETag is stale and is built again.
+    Counts hits and misses of this process, evictions come from the store
+'''
+class ResponseCache:
+
+  def __init__(self, store):
+    self.store = store
+    self.hits = 0
+    self.misses = 0
+    self.compressed_hits = 0
+    self._lock = threading.Lock()
+
+  # Returns the body cached for the key and etag, or None
+  def get(self, key, etag):
+    entry = self.store.get(key)
+    hit = entry is not None and entry[0] == etag
+    with self._lock:
+      if hit:
+        self.hits += 1
+      else:
+        self.misses += 1
+    return entry[1] if hit else None
+
+  def put(self, key, etag, body):
+    self.store.put(key, etag, body)
+
+  '''
+  compressed(key, etag, encoding, body, compress)
+      the cached body compressed with the encoding. compress(body, encoding) runs
+      only the first time, the result is kept under key#encoding with the same etag
+  '''
+  def compressed(self, key, etag, encoding, body, compress):
+    variant = key + '#' + encoding
+    entry = self.store.get(variant)
+    if entry is not None and entry[0] == etag:
+      with self._lock:
+        self.compressed_hits += 1
+      return entry[1]
+
+    compressed = compress(body, encoding)
+    self.store.put(variant, etag, compressed)
+    return compressed
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'compressed_hits': self.compressed_hits,
+      'evictions': self.store.evictions
+    }
+
+
+'''
+response_cache(url)
+    creates the cache from RESPONSE_CACHE setting:
+    "memory" (default), "sqlite:///path/to/responses.db" or "off"
+'''
+def response_cache(url=None):
+  if url == 'off':
+    return None
+  if not url or url == 'memory':
+    return ResponseCache(MemoryResponseStore())
+  if url.startswith('sqlite:///'):
+    return ResponseCache(SQLiteResponseStore(url[len('sqlite:///'):]))
+  raise ValueError('Unknown response cache: ' + url)
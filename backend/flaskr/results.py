@@ -0,0 +1,357 @@
+import os
+import time
+import secrets
+import threading
+from bisect import insort
+
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Question, QuizResult, QuizAnswer, QuestionStats
+
+# results written in one transaction at most
+RESULTS_BATCH_SIZE = int(os.getenv('RESULTS_BATCH_SIZE', 500))
+# seconds the first result of a batch waits for more before the batch is written
+RESULTS_FLUSH_INTERVAL = float(os.getenv('RESULTS_FLUSH_INTERVAL', 0.05))
+# seconds a request waits for its result to be written
+RESULTS_WRITE_TIMEOUT = float(os.getenv('RESULTS_WRITE_TIMEOUT', 10))
+# results on every leaderboard
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))
+# seconds a leaderboard is kept before it's loaded again, with the results of other workers
+LEADERBOARD_TTL = int(os.getenv('LEADERBOARD_TTL', 30))
+# answers of one quiz result at most
+MAX_RESULT_ANSWERS = 100
+MAX_PLAYER_LENGTH = 50
+# question ids looked up with one query
+IDS_CHUNK_SIZE = 500
+
+
+'''
+quiz_result(category_id, player, answers)
+    result to write, answers are (question id, correct) pairs
+'''
+def quiz_result(category_id, player, answers):
+  return {
+    'id': secrets.token_urlsafe(16),
+    'category': category_id,
+    'player': player,
+    'score': sum(1 for _, correct in answers if correct),
+    'total': len(answers),
+    'played_at': time.time(),
+    'answers': answers
+  }
+
+
+# ids of the questions that aren't in the database
+def unknown_questions(question_ids):
+  question_ids = sorted(set(question_ids))
+  found = set()
+  for i in range(0, len(question_ids), IDS_CHUNK_SIZE):
+    found.update(question_id for (question_id, ) in db.session.query(Question.id)
+      .filter(Question.id.in_(question_ids[i:i + IDS_CHUNK_SIZE])))
+  return [question_id for question_id in question_ids if question_id not in found]
+
+
+'''
+add_question_stats(stats)
+    adds {question id: (answered, correct)} to the stats of the questions.
+    Postgres does it with INSERT ... ON CONFLICT DO UPDATE, other databases update
+    the rows that exist and insert the others. There another worker can insert
+    the same row first and it raises IntegrityError
+'''
+def add_question_stats(stats):
+  table = QuestionStats.__table__
+  # in question id order, so two workers writing at once can't deadlock
+  question_ids = sorted(stats)
+  rows = [{'question_id': question_id, 'answered': stats[question_id][0], 'correct': stats[question_id][1]}
+    for question_id in question_ids]
+
+  if db.session.get_bind().dialect.name == 'postgresql':
+    statement = postgresql.insert(table)
+    db.session.execute(statement.on_conflict_do_update(index_elements=[table.c.question_id], set_={
+      'answered': table.c.answered + statement.excluded.answered,
+      'correct': table.c.correct + statement.excluded.correct
+    }), rows)
+    return
+
+  existing = set()
+  for i in range(0, len(question_ids), IDS_CHUNK_SIZE):
+    existing.update(question_id for (question_id, ) in db.session.query(QuestionStats.question_id)
+      .filter(QuestionStats.question_id.in_(question_ids[i:i + IDS_CHUNK_SIZE])))
+
+  updated = [{'id': row['question_id'], 'answered_delta': row['answered'], 'correct_delta': row['correct']}
+    for row in rows if row['question_id'] in existing]
+  if updated:
+    db.session.execute(table.update().where(table.c.question_id == bindparam('id')).values(
+      answered=table.c.answered + bindparam('answered_delta'),
+      correct=table.c.correct + bindparam('correct_delta')), updated)
+  inserted = [row for row in rows if row['question_id'] not in existing]
+  if inserted:
+    db.session.execute(table.insert(), inserted)
+
+
+'''
+write_results(results)
+    inserts the results and their answers and adds the answers to the stats of
+    their questions, each with one executemany, as part of the current transaction
+'''
+def write_results(results):
+  db.session.execute(QuizResult.__table__.insert(),
+    [{key: value for key, value in result.items() if key != 'answers'} for result in results])
+  answers = [{'result_id': result['id'], 'question_id': question_id, 'correct': correct}
+    for result in results for question_id, correct in result['answers']]
+  if not answers:
+    return
+  db.session.execute(QuizAnswer.__table__.insert(), answers)
+
+  stats = {}
+  for answer in answers:
+    answered, correct = stats.get(answer['question_id'], (0, 0))
+    stats[answer['question_id']] = (answered + 1, correct + int(answer['correct']))
+  add_question_stats(stats)
+
+
+class PendingResult:
+  __slots__ = ('result', 'done', 'error')
+
+  def __init__(self, result):
+    self.result = result
+    self.done = threading.Event()
+    self.error = None
+
+
+'''
+ResultWriter
+    group commit of quiz results: results of concurrent requests are collected
+    and written by a background thread in one transaction when batch_size of them
+    are waiting or interval seconds after the first one came. A request waits until
+    its result is committed (at most timeout seconds).
+    With group_commit off every result is written by its own request in its own transaction.
+    listeners are called with the results after they are committed, their errors are only logged
+'''
+class ResultWriter:
+
+  def __init__(self, app, batch_size=RESULTS_BATCH_SIZE, interval=RESULTS_FLUSH_INTERVAL,
+      timeout=RESULTS_WRITE_TIMEOUT, group_commit=True):
+    self.app = app
+    self.batch_size = batch_size
+    self.interval = interval
+    self.timeout = timeout
+    self.group_commit = group_commit
+    self.listeners = []
+    self._pending = []
+    self._pending_since = 0
+    self._condition = threading.Condition()
+    self._thread = None
+    self._lock = threading.Lock()
+    self._counts = {'result_batches': 0, 'results': 0, 'answers': 0, 'result_write_retries': 0,
+      'result_write_errors': 0}
+
+  '''
+  submit(result)
+      writes the result, returns when it is committed.
+      Raises the error of the write, or TimeoutError when it took longer than timeout
+  '''
+  def submit(self, result):
+    item = PendingResult(result)
+    if not self.group_commit:
+      self._write([item])
+    else:
+      with self._condition:
+        if not self._pending:
+          self._pending_since = time.time()
+        self._pending.append(item)
+        self._condition.notify()
+        # started on the first result, so a forked worker starts its own
+        if self._thread is None:
+          self._thread = threading.Thread(target=self._run, daemon=True)
+          self._thread.start()
+      if not item.done.wait(self.timeout):
+        raise TimeoutError('Quiz result was not written in time')
+
+    if item.error is not None:
+      raise item.error
+
+  def _run(self):
+    while True:
+      batch = []
+      try:
+        with self._condition:
+          while not self._pending:
+            self._condition.wait()
+          # more results can come until the batch is full or the first one waited interval seconds
+          while len(self._pending) < self.batch_size:
+            remaining = self._pending_since + self.interval - time.time()
+            if remaining <= 0:
+              break
+            self._condition.wait(remaining)
+          batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+          self._pending_since = time.time()
+
+        with self.app.app_context():
+          self._write(batch)
+      except Exception as e:
+        # the thread keeps writing the next batches, the requests of this one get the error
+        self.app.logger.exception('Quiz result writer failed')
+        for item in batch:
+          if not item.done.is_set():
+            item.error = e
+            item.done.set()
+
+  def _write(self, batch):
+    results = [item.result for item in batch]
+    error = None
+    try:
+      for attempt in range(2):
+        try:
+          write_results(results)
+          db.session.commit()
+          error = None
+          break
+        except IntegrityError as e:
+          # another worker added stats of the same question first (not on postgres),
+          # the second try updates them
+          db.session.rollback()
+          error = e
+          with self._lock:
+            self._counts['result_write_retries'] += 1
+        except Exception as e:
+          db.session.rollback()
+          error = e
+          break
+
+      with self._lock:
+        if error is None:
+          self._counts['result_batches'] += 1
+          self._counts['results'] += len(results)
+          self._counts['answers'] += sum(len(result['answers']) for result in results)
+        else:
+          self._counts['result_write_errors'] += 1
+
+      if error is None:
+        # the results are committed, a listener that fails doesn't change that
+        for listener in self.listeners:
+          try:
+            listener(results)
+          except Exception:
+            self.app.logger.exception('Quiz result listener %r failed', listener)
+      else:
+        self.app.logger.error('Writing %d quiz results failed: %s', len(results), error)
+    finally:
+      for item in batch:
+        item.error = error
+        item.done.set()
+
+  # counters of batches and results written, read by the metrics
+  def stats(self):
+    with self._lock:
+      return dict(self._counts)
+
+  # results waiting for their batch
+  def pending(self):
+    with self._condition:
+      return {'results_pending': len(self._pending)}
+
+
+'''
+result_writer(app)
+    ResultWriter with the RESULTS_* settings, RESULTS_GROUP_COMMIT=off writes
+    every result in its own transaction
+'''
+def result_writer(app):
+  setting = app.config.get('RESULTS_GROUP_COMMIT', os.getenv('RESULTS_GROUP_COMMIT', 'on'))
+  return ResultWriter(app,
+    int(app.config.get('RESULTS_BATCH_SIZE', RESULTS_BATCH_SIZE)),
+    float(app.config.get('RESULTS_FLUSH_INTERVAL', RESULTS_FLUSH_INTERVAL)),
+    float(app.config.get('RESULTS_WRITE_TIMEOUT', RESULTS_WRITE_TIMEOUT)),
+    group_commit=str(setting).lower() not in ('off', 'false', '0', 'no'))
+
+
+'''
+Leaderboards
+    the best size results of every category, in memory. A leaderboard is loaded
+    from the index on (category, score) the first time it's asked for, then the results
+    written by this process are merged into it as they are committed.
+    Results of other workers show up when it's loaded again after ttl seconds
+'''
+class Leaderboards:
+
+  def __init__(self, size=LEADERBOARD_SIZE, ttl=LEADERBOARD_TTL):
+    self.size = size
+    self.ttl = ttl
+    # category id -> (sorted entries, time it was loaded)
+    self._boards = {}
+    # category id -> [number of loads running, entries added since the first of them started]
+    self._loading = {}
+    self._lock = threading.Lock()
+
+  # best first: higher score, then the one played earlier
+  @staticmethod
+  def entry(result):
+    return (-result['score'], result['played_at'], result['id'], result['player'], result['total'])
+
+  def _load(self, category_id):
+    results = QuizResult.query.filter(QuizResult.category == category_id) \
+      .order_by(QuizResult.score.desc(), QuizResult.played_at, QuizResult.id).limit(self.size)
+    return [self.entry(result.format()) for result in results]
+
+  # the leaderboard of the category as formatted results with their rank
+  def top(self, category_id):
+    with self._lock:
+      board = self._boards.get(category_id)
+      if board is not None and time.time() - board[1] <= self.ttl:
+        entries = list(board[0])
+      else:
+        # loaded outside the lock, so the result writer isn't kept waiting on the query.
+        # Results added meanwhile are kept and merged after it (skipped if they were loaded too)
+        loading = self._loading.setdefault(category_id, [0, []])
+        loading[0] += 1
+        added = len(loading[1])
+        entries = None
+
+    if entries is None:
+      loaded_at = time.time()
+      loaded = None
+      try:
+        loaded = self._load(category_id)
+      finally:
+        with self._lock:
+          loading[0] -= 1
+          if not loading[0]:
+            del self._loading[category_id]
+          if loaded is not None:
+            for entry in loading[1][added:]:
+              self._merge(loaded, entry)
+            self._boards[category_id] = (loaded, loaded_at)
+            entries = list(loaded)
+
+    return [{
+      'rank': rank,
+      'id': result_id,
+      'player': player,
+      'score': -score,
+      'total': total,
+      'played_at': played_at
+    } for rank, (score, played_at, result_id, player, total) in enumerate(entries, 1)]
+
+  # puts the entry in its place in the sorted entries, if it makes the board
+  def _merge(self, entries, entry):
+    if len(entries) >= self.size and entry >= entries[-1]:
+      return
+    if any(existing[2] == entry[2] for existing in entries):
+      return
+    insort(entries, entry)
+    del entries[self.size:]
+
+  # merges the committed results into the loaded leaderboards (and the ones being loaded)
+  def add(self, results):
+    with self._lock:
+      for result in results:
+        entry = self.entry(result)
+        loading = self._loading.get(result['category'])
+        if loading is not None:
+          loading[1].append(entry)
+        board = self._boards.get(result['category'])
+        if board is not None:
+          self._merge(board[0], entry)
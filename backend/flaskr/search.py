@@ -0,0 +1,218 @@
+import os
+import re
+import math
+import time
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, insort
+
+from models import db, Question
+
+# seconds after which the index is rebuilt in the background,
+# to pick up questions written by other workers
+SEARCH_INDEX_TTL = int(os.getenv('SEARCH_INDEX_TTL', 600))
+# matches in the answer count less than matches in the question
+ANSWER_WEIGHT = 0.5
+
+TOKEN = re.compile(r'\w+')
+# words that are in almost every question, they would only make the postings long
+STOP_WORDS = frozenset('''a an and are as at be by did do does for from has have how in is it
+  its of on or that the this to was were what when where which who whom whose why with'''.split())
+
+
+def tokenize(text):
+  return [token for token in TOKEN.findall((text or '').lower()) if token not in STOP_WORDS]
+
+
+def contains(postings, question_id):
+  if postings is None:
+    return False
+  i = bisect_left(postings, question_id)
+  return i < len(postings) and postings[i] == question_id
+
+
+# sorted ids that are in all of the sorted arrays
+def intersect(lists):
+  lists = sorted(lists, key=len)
+  if len(lists) == 1:
+    return lists[0]
+  ids = set(lists[0])
+  for other in lists[1:]:
+    ids.intersection_update(other)
+  return sorted(ids)
+
+
+def question_texts():
+  return db.session.query(Question.id, Question.question, Question.answer) \
+    .order_by(Question.id).yield_per(10000)
+
+
+'''
+SearchIndex
+    inverted index of the question and answer words: word -> sorted array of question ids.
+    It is built on the first search and kept in sync with the writes of this process
+    through Question.observers. Writes from other workers are picked up
+    by a rebuild in the background every SEARCH_INDEX_TTL seconds.
+    rows returns (id, question, answer) of all questions ordered by id,
+    they are read from the database by default
+'''
+class SearchIndex:
+
+  def __init__(self, app, ttl=SEARCH_INDEX_TTL, rows=None):
+    self.app = app
+    self.ttl = ttl
+    self.rows = rows or question_texts
+    self._questions = None
+    self._answers = None
+    # number of words in the question, by id
+    self._lengths = array('H')
+    # questions in the index, _lengths is indexed by id so its length isn't their number
+    self._documents = 0
+    self._built_at = 0
+    self._pending = None
+    self._lock = threading.Lock()
+    self._build_lock = threading.Lock()
+    Question.observers.add(self)
+
+  def _add(self, questions, answers, lengths, question):
+    question_id = question['id']
+    question_tokens = set(tokenize(question['question']))
+    for postings, tokens in ((questions, question_tokens),
+        (answers, set(tokenize(question['answer'])))):
+      for token in tokens:
+        ids = postings.setdefault(token, array('l'))
+        if not contains(ids, question_id):
+          insort(ids, question_id)
+
+    if len(lengths) <= question_id:
+      lengths.extend([0] * (question_id + 1 - len(lengths)))
+    lengths[question_id] = min(len(question_tokens), 65535)
+
+  def _remove(self, question):
+    question_id = question['id']
+    for postings, text in ((self._questions, question['question']),
+        (self._answers, question['answer'])):
+      for token in set(tokenize(text)):
+        ids = postings.get(token)
+        if contains(ids, question_id):
+          del ids[bisect_left(ids, question_id)]
+          if not ids:
+            del postings[token]
+    if question_id < len(self._lengths):
+      self._lengths[question_id] = 0
+
+  def build(self):
+    questions, answers, lengths = {}, {}, array('H')
+    documents = 0
+    with self._lock:
+      self._pending = []
+
+    with self.app.app_context():
+      for question_id, question, answer in self.rows():
+        # rows come ordered by id, so appending keeps the postings sorted
+        tokens = set(tokenize(question))
+        for token in tokens:
+          questions.setdefault(token, array('l')).append(question_id)
+        for token in set(tokenize(answer)):
+          answers.setdefault(token, array('l')).append(question_id)
+        if len(lengths) <= question_id:
+          lengths.extend([0] * (question_id + 1 - len(lengths)))
+        lengths[question_id] = min(len(tokens), 65535)
+        documents += 1
+
+    with self._lock:
+      self._questions, self._answers, self._lengths = questions, answers, lengths
+      self._documents = documents
+      self._built_at = time.time()
+      # writes that happened while we were reading the table
+      pending, self._pending = self._pending, None
+      for action, old, new in pending:
+        self._apply(action, old, new)
+
+  def _apply(self, action, old, new):
+    if old is not None:
+      self._remove(old)
+      self._documents -= 1
+    if new is not None:
+      self._add(self._questions, self._answers, self._lengths, new)
+      self._documents += 1
+
+  def question_changed(self, action, old, new):
+    with self._lock:
+      if self._pending is not None:
+        self._pending.append((action, old, new))
+      if self._questions is None:
+        return
+      if action is None:
+        # questions were changed in bulk, rebuild on the next search
+        self._built_at = 0
+        return
+      self._apply(action, old, new)
+
+  def _ensure_built(self):
+    if self._questions is None:
+      with self._build_lock:
+        if self._questions is None:
+          self.build()
+    elif time.time() - self._built_at > self.ttl and self._build_lock.acquire(False):
+      # the old index keeps serving while the new one is built
+      def rebuild():
+        try:
+          self.build()
+        finally:
+          self._build_lock.release()
+      threading.Thread(target=rebuild, daemon=True).start()
+
+  def _idf(self, postings, token):
+    return math.log(1 + self._documents / (1 + len(postings.get(token, ()))))
+
+  '''
+  search(term, answers, start, end)
+      returns (ids of the matches from start to end ordered by relevance, number of matches).
+      Questions have to contain all the words of the term, in the question
+      or the answer if answers is True. If none does, questions with any
+      of the words are returned, the ones with more (and rarer) words first.
+      Shorter questions rank higher.
+  '''
+  def search(self, term, answers=False, start=0, end=10):
+    self._ensure_built()
+    tokens = set(tokenize(term))
+    if not tokens:
+      return [], 0
+
+    questions, answers_postings, lengths = self._questions, self._answers, self._lengths
+    empty = array('l')
+
+    def matching(token):
+      ids = questions.get(token, empty)
+      if answers:
+        ids = sorted(set(ids).union(answers_postings.get(token, empty)))
+      return ids
+
+    def length(question_id):
+      return 1 + math.log1p(lengths[question_id] if question_id < len(lengths) else 0)
+
+    candidates = intersect([matching(token) for token in tokens])
+    if candidates and not answers:
+      # every candidate has all the words in the question, only the length differs.
+      # Candidates are ordered by id so equally long questions stay in that order
+      ranked = heapq.nsmallest(end, candidates, key=lengths.__getitem__)
+      return ranked[start:end], len(candidates)
+
+    scores = {}
+    for token in tokens:
+      weight = self._idf(questions, token)
+      for question_id in questions.get(token, empty):
+        scores[question_id] = scores.get(question_id, 0) + weight
+      if answers:
+        weight = ANSWER_WEIGHT * self._idf(answers_postings, token)
+        for question_id in answers_postings.get(token, empty):
+          scores[question_id] = scores.get(question_id, 0) + weight
+
+    if candidates:
+      scores = {question_id: scores[question_id] for question_id in candidates}
+
+    ranked = heapq.nsmallest(end, scores,
+      key=lambda question_id: (-scores[question_id] / length(question_id), question_id))
+    return ranked[start:end], len(scores)
@@ -0,0 +1,132 @@
+import os
+import re
+import json
+
+from flask.json import JSONEncoder
+
+from models import Question
+from .metrics import timing
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# keys of Question.format() and the columns they come from
+FORMAT_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+FORMAT_COLUMNS = (Question.id, Question.question, Question.answer, Question.category,
+  Question.difficulty)
+
+
+'''
+question_rows(query)
+    the same as [question.format() for question in query], but it selects
+    only the columns as plain tuples, so no Question objects are built
+'''
+def question_rows(query):
+  rows = query.with_entities(*FORMAT_COLUMNS).all()
+  with timing('format'):
+    return [dict(zip(FORMAT_FIELDS, row)) for row in rows]
+
+
+'''
+Encoded
+    a value together with its JSON, encoded once and reused in many responses.
+    The fast encoder puts the JSON in as it is, the standard one encodes the value
+'''
+class Encoded:
+  __slots__ = ('value', 'json')
+
+  def __init__(self, value, json):
+    self.value = value
+    self.json = json
+
+
+# Encoded that has only the JSON, the value is decoded when the standard encoder needs it
+class EncodedJSON(Encoded):
+  __slots__ = ()
+
+  def __init__(self, json):
+    self.json = json
+
+  @property
+  def value(self):
+    return json.loads(self.json)
+
+
+if orjson is not None:
+  ORJSON_OPTIONS = (orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+    orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_SUBCLASS)
+  Fragment = getattr(orjson, 'Fragment', None)
+  # floats under 0.0001 are written differently by orjson (0.00001, 1e-7) than json (1e-05),
+  # and from 1e16 up older orjson versions leave out the + of the exponent (1e16, json 1e+16)
+  DIFFERENT_FLOAT = re.compile(rb'[0-9]e-|[0-9]e[0-9]|(?<![0-9.])0\.0000')
+  # checked once, the markers of big floats are looked for only when this orjson writes them differently
+  BIG_FLOATS_DIFFER = orjson.dumps(1e16) != json.dumps(1e16).encode()
+  BIG_FLOAT_MARKERS = tuple(b'e%d' % digit for digit in range(10))
+
+
+# True when orjson's output is the same as json's: only ASCII and no floats it writes differently.
+# The substring checks are much faster than the regex, which is rarely needed
+def same_as_json(encoded):
+  if not encoded.isascii() or b'\x7f' in encoded:
+    return False
+  if (b'e-' in encoded or b'0.0000' in encoded
+      or (BIG_FLOATS_DIFFER and any(marker in encoded for marker in BIG_FLOAT_MARKERS))):
+    return DIFFERENT_FLOAT.search(encoded) is None
+  return True
+
+
+# JSON of the value the way jsonify writes it: compact, sorted and only ASCII
+def encode_json(value):
+  if orjson is not None:
+    try:
+      encoded = orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+      encoded = None
+    if encoded is not None and same_as_json(encoded):
+      return encoded.decode('ascii')
+  return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+# Flask JSON encoder that knows Encoded values
+class StandardJSONEncoder(JSONEncoder):
+
+  def default(self, o):
+    if isinstance(o, Encoded):
+      return o.value
+    return super().default(o)
+
+
+'''
+FastJSONEncoder
+    Flask JSON encoder that uses orjson when its output is the same,
+    byte for byte, as the standard encoder's: compact and sorted, only ASCII,
+    no integer keys and no floats under 0.0001 or from 1e16 up. Otherwise (or for pretty printed
+    JSON in debug) the standard encoder does it
+'''
+class FastJSONEncoder(StandardJSONEncoder):
+
+  def _fast_default(self, o):
+    if isinstance(o, Encoded) and Fragment is not None:
+      return Fragment(o.json)
+    return self.default(o)
+
+  def encode(self, o):
+    if (self.indent is None and self.sort_keys and self.ensure_ascii
+        and (self.item_separator, self.key_separator) == (',', ':')):
+      try:
+        encoded = orjson.dumps(o, default=self._fast_default, option=ORJSON_OPTIONS)
+      except TypeError:
+        encoded = None
+      if encoded is not None and same_as_json(encoded):
+        return encoded.decode('ascii')
+    return super().encode(o)
+
+
+# FastJSONEncoder when orjson is installed, unless FAST_JSON is turned off
+def json_encoder(app):
+  value = app.config.get('FAST_JSON', os.getenv('FAST_JSON', 'true'))
+  if orjson is not None and str(value).lower() in ('1', 'true', 'yes'):
+    return FastJSONEncoder
+  return StandardJSONEncoder
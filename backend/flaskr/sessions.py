@@ -0,0 +1,155 @@
+import os
+import time
+import sqlite3
+import secrets
+import threading
+from array import array
+from collections import OrderedDict
+
+# seconds a quiz session lives after it was last used
+QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', 3600))
+# how many sessions the in-process store keeps before it evicts the least recently used
+QUIZ_SESSION_MAX = int(os.getenv('QUIZ_SESSION_MAX', 10000))
+
+'''
+QuizSession
+    the shuffled question ids of one quiz and how far the player got
+'''
+class QuizSession:
+  __slots__ = ('category', 'order', 'cursor')
+
+  def __init__(self, category, order, cursor=0):
+    self.category = category
+    self.order = order
+    self.cursor = cursor
+
+
+def new_token():
+  return secrets.token_urlsafe(16)
+
+
+'''
+MemorySessionStore
+    keeps sessions in this process, for a single worker.
+    Least recently used sessions are evicted when there are more than max_size
+    and sessions expire ttl seconds after their last use
+'''
+class MemorySessionStore:
+
+  def __init__(self, ttl=QUIZ_SESSION_TTL, max_size=QUIZ_SESSION_MAX):
+    self.ttl = ttl
+    self.max_size = max_size
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+
+  def create(self, session):
+    token = new_token()
+    with self._lock:
+      self._sessions[token] = (session, time.time() + self.ttl)
+      while len(self._sessions) > self.max_size:
+        self._sessions.popitem(last=False)
+    return token
+
+  # Returns the next question id of the session and moves the cursor,
+  # None when all were used. Raises KeyError for unknown or expired tokens
+  def next_id(self, token):
+    with self._lock:
+      session, expires = self._sessions[token]
+      if expires < time.time():
+        del self._sessions[token]
+        raise KeyError(token)
+
+      self._sessions.move_to_end(token)
+      self._sessions[token] = (session, time.time() + self.ttl)
+      if session.cursor >= len(session.order):
+        return None
+      session.cursor += 1
+      return session.order[session.cursor - 1]
+
+  def delete(self, token):
+    with self._lock:
+      return self._sessions.pop(token, None) is not None
+
+
+'''
+SQLiteSessionStore
+    keeps sessions in a sqlite file so all workers on one machine share them.
+    The order is stored once as a blob, moving to the next question updates
+    only the cursor and reads the one id it needs from the blob
+'''
+class SQLiteSessionStore:
+
+  def __init__(self, path, ttl=QUIZ_SESSION_TTL):
+    self.path = path
+    self.ttl = ttl
+    self._local = threading.local()
+    self._connection().execute('''CREATE TABLE IF NOT EXISTS quiz_sessions (
+      token TEXT PRIMARY KEY,
+      category TEXT,
+      question_ids BLOB,
+      total INTEGER,
+      cursor INTEGER,
+      expires REAL)''')
+    self._connection().execute(
+      'CREATE INDEX IF NOT EXISTS quiz_sessions_expires ON quiz_sessions (expires)')
+
+  # sqlite connections can't be shared between threads
+  def _connection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+      connection.execute('PRAGMA journal_mode=WAL')
+      self._local.connection = connection
+    return connection
+
+  def create(self, session):
+    token = new_token()
+    order = array('q', session.order)
+    connection = self._connection()
+    connection.execute('DELETE FROM quiz_sessions WHERE expires < ?', (time.time(), ))
+    connection.execute('INSERT INTO quiz_sessions VALUES (?, ?, ?, ?, ?, ?)', (
+      token, str(session.category), order.tobytes(), len(order),
+      session.cursor, time.time() + self.ttl))
+    return token
+
+  def next_id(self, token):
+    connection = self._connection()
+    size = array('q').itemsize
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      row = connection.execute(
+        'SELECT cursor, total, substr(question_ids, cursor * ? + 1, ?) FROM quiz_sessions '
+        'WHERE token = ? AND expires >= ?', (size, size, token, time.time())).fetchone()
+      if row is None:
+        raise KeyError(token)
+
+      cursor, total, question_id = row
+      if cursor < total:
+        cursor += 1
+      connection.execute('UPDATE quiz_sessions SET cursor = ?, expires = ? WHERE token = ?',
+        (cursor, time.time() + self.ttl, token))
+      connection.execute('COMMIT')
+    except:
+      connection.execute('ROLLBACK')
+      raise
+
+    if not question_id:
+      return None
+    return array('q', question_id)[0]
+
+  def delete(self, token):
+    cursor = self._connection().execute('DELETE FROM quiz_sessions WHERE token = ?', (token, ))
+    return cursor.rowcount > 0
+
+
+'''
+session_store(url)
+    creates the store from QUIZ_SESSION_STORE setting:
+    "memory" (default) or "sqlite:///path/to/sessions.db"
+'''
+def session_store(url=None):
+  if not url or url == 'memory':
+    return MemorySessionStore()
+  if url.startswith('sqlite:///'):
+    return SQLiteSessionStore(url[len('sqlite:///'):])
+  raise ValueError('Unknown quiz session store: ' + url)
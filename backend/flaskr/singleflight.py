@@ -0,0 +1,81 @@
+import os
+import threading
+
+# seconds a request waits for the same request in flight before it runs on its own
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 5))
+
+
+# one computation in flight, done is set when result is there or it failed
+class Flight:
+  __slots__ = ('done', 'result', 'failed')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.failed = False
+
+
+'''
+SingleFlight
+    identical requests that come while one of them is being computed wait for it
+    and share its result instead of running the same queries again.
+    The first request with a key (the leader) runs the function, the others wait up
+    to timeout seconds. When the leader fails or takes longer they run it themselves.
+    Works between the threads of one worker
+'''
+class SingleFlight:
+
+  def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+    self.timeout = timeout
+    self.leaders = 0
+    self.shared = 0
+    self.fallbacks = 0
+    self._flights = {}
+    self._lock = threading.Lock()
+
+  # Returns (result of fn, True if it was shared from another request)
+  def do(self, key, fn):
+    with self._lock:
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = Flight()
+        self.leaders += 1
+
+    if leader:
+      try:
+        flight.result = fn()
+        return flight.result, False
+      except BaseException:
+        flight.failed = True
+        raise
+      finally:
+        with self._lock:
+          del self._flights[key]
+        flight.done.set()
+
+    if flight.done.wait(self.timeout) and not flight.failed:
+      with self._lock:
+        self.shared += 1
+      return flight.result, True
+
+    with self._lock:
+      self.fallbacks += 1
+    return fn(), False
+
+  def stats(self):
+    return {
+      'leaders': self.leaders,
+      'shared': self.shared,
+      'fallbacks': self.fallbacks
+    }
+
+
+'''
+single_flight(setting, timeout)
+    creates SingleFlight from SINGLE_FLIGHT setting, "on" (default) or "off"
+'''
+def single_flight(setting=None, timeout=SINGLE_FLIGHT_TIMEOUT):
+  if str(setting).lower() in ('off', '0', 'false', 'no'):
+    return None
+  return SingleFlight(timeout)
@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import time
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+from models import db, Question, DataVersion, QuestionChange
+from .quiz import QuestionPool, pool_key, question_pool_keys
+from .cache import load_categories
+from .serialize import FORMAT_FIELDS, FORMAT_COLUMNS, EncodedJSON, encode_json
+
+# seconds between looks at the change log for writes made through other apps
+SNAPSHOT_REFRESH = float(os.getenv('SNAPSHOT_REFRESH', 2))
+# changes are looked at again for this many seconds after they were logged, so
+# a write that commits after a newer one (with a higher id) is not skipped
+CHANGE_COMMIT_WINDOW = 30
+# with more changes than this since the last refresh everything is loaded again
+MAX_INCREMENTAL_CHANGES = 10000
+# question ids loaded with one query when refreshing
+LOAD_CHUNK_SIZE = 500
+
+
+# keys of by_category the question is in, questions without a category are only in '0:difficulty'
+def snapshot_keys(category, difficulty):
+  keys = question_pool_keys(category, difficulty)
+  return keys if category is not None else keys[2:]
+
+
+def snapshot_enabled(app):
+  value = app.config.get('SNAPSHOT_MODE', os.getenv('SNAPSHOT_MODE', ''))
+  return str(value).lower() in ('1', 'true', 'yes')
+
+
+'''
+SnapshotState
+    one version of the question bank, it's never changed after it's made.
+    ids are sorted and questions has the JSON of the question at the same index,
+    by_category has sorted ids of every category and of every category and difficulty
+    (by the keys of QuestionPool).
+    versions are the data versions it was read at, watermark the last change
+    in the log it doesn't need to look at again and bulk_changes the changes of
+    many questions after the watermark that were already loaded
+'''
+class SnapshotState:
+  __slots__ = ('ids', 'questions', 'by_category', 'categories', 'versions', 'watermark',
+    'bulk_changes', 'size')
+
+  def __init__(self, ids, questions, by_category, categories, versions, watermark, bulk_changes, size):
+    self.ids = ids
+    self.questions = questions
+    self.by_category = by_category
+    # (id -> type, set of types, types encoded) from load_categories
+    self.categories = categories
+    self.versions = versions
+    self.watermark = watermark
+    self.bulk_changes = bulk_changes
+    # bytes of the JSON strings
+    self.size = size
+
+  def index(self, question_id):
+    i = bisect_left(self.ids, question_id)
+    if i < len(self.ids) and self.ids[i] == question_id:
+      return i
+    return None
+
+
+'''
+QuestionSnapshot
+    all questions and categories in memory, for the read-only snapshot mode.
+    Every question is kept only as its JSON in a list next to a sorted array of ids,
+    so pages are slices and responses put the JSON in without encoding it again.
+    Every SNAPSHOT_REFRESH seconds a request starts a refresh in the background:
+    if the data versions changed it reads the change log from the watermark and
+    loads only the questions that changed. Requests keep using the old state
+    until the new one is swapped in
+'''
+class QuestionSnapshot:
+
+  def __init__(self, app, refresh_interval=SNAPSHOT_REFRESH):
+    self.app = app
+    self.refresh_interval = refresh_interval
+    self.loaded_in = None
+    self._state = None
+    self._refreshed_at = 0
+    self._refresh_lock = threading.Lock()
+
+  # On Postgres all reads of a refresh see the same moment, so the versions match the rows
+  def _begin(self):
+    if db.engine.dialect.name == 'postgresql':
+      db.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
+  def _read_versions(self):
+    return dict(db.session.query(DataVersion.name, DataVersion.version))
+
+  # the newest change that is old enough to be committed if it's ever going to be
+  def _read_watermark(self, since=0):
+    return db.session.query(db.func.max(QuestionChange.id)).filter(
+      QuestionChange.id > since,
+      QuestionChange.changed_at < time.time() - CHANGE_COMMIT_WINDOW).scalar() or since
+
+  def load(self):
+    start = time.perf_counter()
+    with self.app.app_context():
+      self._begin()
+      versions = self._read_versions()
+      watermark = self._read_watermark()
+      bulk_changes = frozenset(change_id for (change_id, ) in db.session.query(QuestionChange.id)
+        .filter(QuestionChange.id > watermark, QuestionChange.action.in_(QuestionChange.BULK_ACTIONS)))
+      categories = load_categories()
+
+      ids, questions, by_category, size = array('l'), [], {}, 0
+      rows = db.session.query(*FORMAT_COLUMNS).order_by(Question.id).yield_per(10000)
+      for row in rows:
+        encoded = encode_json(dict(zip(FORMAT_FIELDS, row)))
+        ids.append(row[0])
+        questions.append(encoded)
+        size += sys.getsizeof(encoded)
+        for key in snapshot_keys(row[3], row[4]):
+          by_category.setdefault(key, array('l')).append(row[0])
+      db.session.commit()
+
+    self._state = SnapshotState(ids, questions, by_category, categories, versions, watermark,
+      bulk_changes, size)
+    self._refreshed_at = time.time()
+    self.loaded_in = time.perf_counter() - start
+    return self._state
+
+  def refresh(self):
+    state = self._state
+    with self.app.app_context():
+      self._begin()
+      versions = self._read_versions()
+      if versions == state.versions:
+        db.session.commit()
+        return state
+
+      changes = db.session.query(QuestionChange.id, QuestionChange.question_id, QuestionChange.action) \
+        .filter(QuestionChange.id > state.watermark) \
+        .order_by(QuestionChange.id).limit(MAX_INCREMENTAL_CHANGES + 1).all()
+      # questions were changed in bulk since the last load, everything is loaded again
+      bulk = len(changes) > MAX_INCREMENTAL_CHANGES or any(action in QuestionChange.BULK_ACTIONS and
+        change_id not in state.bulk_changes for change_id, _, action in changes)
+      if not bulk:
+        question_ids = sorted(set(question_id for _, question_id, _ in changes if question_id is not None))
+        watermark = self._read_watermark(state.watermark)
+        categories = state.categories
+        if versions.get('categories') != state.versions.get('categories'):
+          categories = load_categories()
+        rows = {}
+        for i in range(0, len(question_ids), LOAD_CHUNK_SIZE):
+          for row in db.session.query(*FORMAT_COLUMNS).filter(
+              Question.id.in_(question_ids[i:i + LOAD_CHUNK_SIZE])):
+            rows[row[0]] = dict(zip(FORMAT_FIELDS, row))
+      db.session.commit()
+
+    if bulk:
+      self.load()
+      Question.changed()
+      return self._state
+
+    ids, questions, by_category, size, changed = self._apply(state, question_ids, rows)
+    bulk_changes = frozenset(change_id for change_id in state.bulk_changes if change_id > watermark)
+    self._state = SnapshotState(ids, questions, by_category, categories, versions, watermark,
+      bulk_changes, size)
+    # keeps observers (the search index) in sync, like a write in this process would
+    for action, old, new in changed:
+      Question.changed(action, old, new)
+    return self._state
+
+  # Returns copies of the state's structures with the changed questions,
+  # rows has the current values of the ones that still exist
+  def _apply(self, state, question_ids, rows):
+    ids, questions, size = array('l', state.ids), list(state.questions), state.size
+    by_category = dict(state.by_category)
+    copied = set()
+
+    def category_ids(key):
+      if key not in copied:
+        by_category[key] = array('l', by_category.get(key, ()))
+        copied.add(key)
+      return by_category[key]
+
+    changed = []
+    for question_id in question_ids:
+      new = rows.get(question_id)
+      encoded = encode_json(new) if new is not None else None
+      i = bisect_left(ids, question_id)
+      present = i < len(ids) and ids[i] == question_id
+      # changes seen before are looked at again for a while, most didn't change since
+      if (present and questions[i] == encoded) or (not present and new is None):
+        continue
+
+      old = json.loads(questions[i]) if present else None
+      if old is not None:
+        size -= sys.getsizeof(questions[i])
+        for key in snapshot_keys(old['category'], old['difficulty']):
+          old_ids = category_ids(key)
+          del old_ids[bisect_left(old_ids, question_id)]
+          if not old_ids:
+            del by_category[key]
+
+      if new is None:
+        del ids[i]
+        del questions[i]
+        changed.append(('delete', old, None))
+        continue
+
+      if present:
+        questions[i] = encoded
+      else:
+        ids.insert(i, question_id)
+        questions.insert(i, encoded)
+      size += sys.getsizeof(encoded)
+      for key in snapshot_keys(new['category'], new['difficulty']):
+        insort(category_ids(key), question_id)
+      changed.append(('update' if present else 'insert', old, new))
+
+    return ids, questions, by_category, size, changed
+
+  # The current state, starts a refresh in the background when it's time for one
+  def state(self):
+    if (time.time() - self._refreshed_at > self.refresh_interval and
+        self._refresh_lock.acquire(False)):
+      self._refreshed_at = time.time()
+
+      def refresh():
+        try:
+          self.refresh()
+        except Exception:
+          # the old state keeps serving, next request tries again
+          self.app.logger.exception('Refreshing the question snapshot failed')
+        finally:
+          self._refresh_lock.release()
+      threading.Thread(target=refresh, daemon=True).start()
+    return self._state
+
+  # the same as DataVersion.current_many, as the snapshot saw them
+  def versions(self, *names):
+    versions = self.state().versions
+    return [versions.get(name, 0) for name in names]
+
+  # Returns (questions of the page or after the id, number of all questions, id of the last one)
+  def page(self, page, after=None, per_page=10):
+    state = self.state()
+    if after is not None:
+      start = bisect_right(state.ids, after)
+    elif page < 1:
+      return [], len(state.ids), None
+    else:
+      start = (page - 1) * per_page
+    questions = [EncodedJSON(encoded) for encoded in state.questions[start:start + per_page]]
+    last_id = state.ids[start + len(questions) - 1] if questions else None
+    return questions, len(state.ids), last_id
+
+  def category_questions(self, category_id):
+    state = self.state()
+    return [EncodedJSON(state.questions[state.index(question_id)])
+      for question_id in state.by_category.get(str(category_id), ())]
+
+  # questions with the ids in the same order, without the ones that don't exist
+  def questions(self, question_ids):
+    state = self.state()
+    indexes = [state.index(question_id) for question_id in question_ids]
+    return [EncodedJSON(state.questions[i]) for i in indexes if i is not None]
+
+  # formatted question or None
+  def question(self, question_id):
+    state = self.state()
+    i = state.index(question_id)
+    return json.loads(state.questions[i]) if i is not None else None
+
+  # (id, question, answer) of all questions ordered by id, for the search index
+  def search_rows(self):
+    for encoded in self.state().questions:
+      question = json.loads(encoded)
+      yield question['id'], question['question'], question['answer']
+
+  # question texts of the ids that exist, by id, for the duplicate index
+  def texts(self, question_ids):
+    state = self.state()
+    indexes = [state.index(question_id) for question_id in question_ids]
+    return {question['id']: question['question']
+      for question in (json.loads(state.questions[i]) for i in indexes if i is not None)}
+
+  # rows for export_questions
+  def export_rows(self, category=None, from_id=None, to_id=None):
+    state = self.state()
+    start = bisect_left(state.ids, from_id) if from_id is not None else 0
+    end = bisect_right(state.ids, to_id) if to_id is not None else len(state.ids)
+    for encoded in state.questions[start:end]:
+      question = json.loads(encoded)
+      if category is None or question['category'] == category:
+        yield (question['id'], question['question'], question['answer'],
+          question['difficulty'], question['category'])
+
+  # bytes the snapshot takes, without the search index
+  def memory(self):
+    state = self._state
+    size = (sys.getsizeof(state.ids) + sys.getsizeof(state.questions) + state.size +
+      sum(sys.getsizeof(ids) for ids in state.by_category.values()))
+    return {
+      'questions': len(state.ids),
+      'bytes': size,
+      'bytes_per_question': round(size / len(state.ids), 1) if state.ids else 0
+    }
+
+
+'''
+SnapshotCategories
+    the categories of the snapshot, with the methods of CategoryCache
+'''
+class SnapshotCategories:
+
+  def __init__(self, snapshot):
+    self.snapshot = snapshot
+
+  def invalidate(self):
+    pass
+
+  def types(self):
+    return self.snapshot.state().categories[0]
+
+  def type_set(self):
+    return self.snapshot.state().categories[1]
+
+  def encoded_types(self):
+    return self.snapshot.state().categories[2]
+
+  def get(self, category_id):
+    return self.snapshot.state().categories[0].get(category_id)
+
+
+'''
+SnapshotQuestionPool
+    QuestionPool that picks from the ids of the snapshot, nothing is loaded
+'''
+class SnapshotQuestionPool(QuestionPool):
+
+  def __init__(self, snapshot):
+    super().__init__()
+    self.snapshot = snapshot
+
+  def invalidate(self):
+    pass
+
+  def ids(self, category_id, difficulty=None):
+    state = self.snapshot.state()
+    if str(category_id) == '0' and difficulty is None:
+      return state.ids
+    return state.by_category.get(pool_key(category_id, difficulty), array('l'))
@@ -0,0 +1,199 @@
+import os
+import sys
+import time
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+from models import Question
+from .search import SEARCH_INDEX_TTL, TOKEN, tokenize, question_texts
+
+# characters from the start of a question that are kept in the index, longer
+# questions are suggested by their beginning. Bounds the memory per question
+SUGGEST_PREFIX_LENGTH = int(os.getenv('SUGGEST_PREFIX_LENGTH', 32))
+# suggestions of each kind GET /questions/suggest returns, by default and at most
+SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+# the most frequent words of prefixes this short are kept ready, they match
+# a big part of all words. Longer prefixes match few and are ranked on every request
+CACHED_PREFIX_LENGTH = 2
+# sorts after every other character, prefix + LAST is the end of the prefix's range
+LAST = '\U0010ffff'
+
+
+# lowercase text with single spaces, the way questions are compared
+def normalize(text):
+  return ' '.join((text or '').lower().split())
+
+
+def question_prefix(question):
+  return normalize(question)[:SUGGEST_PREFIX_LENGTH].rstrip()
+
+
+# (start, end) of the keys starting with the prefix in the sorted keys
+def prefix_range(keys, prefix):
+  return bisect_left(keys, prefix), bisect_left(keys, prefix + LAST)
+
+
+# adds delta to the count of the key, keys with no count left are removed
+def change_count(keys, counts, key, delta):
+  i = bisect_left(keys, key)
+  if i < len(keys) and keys[i] == key:
+    counts[i] += delta
+    if counts[i] <= 0:
+      del keys[i]
+      del counts[i]
+  elif delta > 0:
+    keys.insert(i, key)
+    counts.insert(i, delta)
+
+
+'''
+SuggestIndex
+    prefixes of the questions (their first SUGGEST_PREFIX_LENGTH characters, lowercase)
+    and the words in them, each as a sorted list next to an array with the number of
+    questions that have it. Suggestions for a prefix are a range of the sorted list
+    found with bisect. Built on the first request and kept in sync with the writes
+    of this process through Question.observers, like SearchIndex.
+    Writes from other workers are picked up by a rebuild every SEARCH_INDEX_TTL seconds
+'''
+class SuggestIndex:
+
+  def __init__(self, app, ttl=SEARCH_INDEX_TTL, rows=None):
+    self.app = app
+    self.ttl = ttl
+    self.rows = rows or question_texts
+    self._prefixes = None
+    self._prefix_counts = None
+    self._words = None
+    self._word_counts = None
+    # prefix of at most CACHED_PREFIX_LENGTH characters -> its most frequent words
+    self._top_words = {}
+    self._built_at = 0
+    self._pending = None
+    self._lock = threading.Lock()
+    self._build_lock = threading.Lock()
+    Question.observers.add(self)
+
+  def build(self):
+    prefixes, words = {}, {}
+    with self._lock:
+      self._pending = []
+
+    with self.app.app_context():
+      for _, question, _ in self.rows():
+        prefix = question_prefix(question)
+        prefixes[prefix] = prefixes.get(prefix, 0) + 1
+        for word in set(tokenize(question)):
+          words[word] = words.get(word, 0) + 1
+
+    prefix_keys, word_keys = sorted(prefixes), sorted(words)
+    prefix_counts = array('l', (prefixes[prefix] for prefix in prefix_keys))
+    word_counts = array('l', (words[word] for word in word_keys))
+    del prefixes, words
+
+    with self._lock:
+      self._prefixes, self._prefix_counts = prefix_keys, prefix_counts
+      self._words, self._word_counts = word_keys, word_counts
+      self._top_words = {}
+      self._built_at = time.time()
+      # writes that happened while we were reading the table
+      pending, self._pending = self._pending, None
+      for action, old, new in pending:
+        self._apply(old, new)
+
+  def _change(self, question, delta):
+    change_count(self._prefixes, self._prefix_counts, question_prefix(question['question']), delta)
+    for word in set(tokenize(question['question'])):
+      change_count(self._words, self._word_counts, word, delta)
+      for length in range(1, CACHED_PREFIX_LENGTH + 1):
+        self._top_words.pop(word[:length], None)
+
+  def _apply(self, old, new):
+    if old is not None:
+      self._change(old, -1)
+    if new is not None:
+      self._change(new, 1)
+
+  def question_changed(self, action, old, new):
+    with self._lock:
+      if self._pending is not None:
+        self._pending.append((action, old, new))
+      if self._prefixes is None:
+        return
+      if action is None:
+        # questions were changed in bulk, rebuild on the next request
+        self._built_at = 0
+        return
+      self._apply(old, new)
+
+  def _ensure_built(self):
+    if self._prefixes is None:
+      with self._build_lock:
+        if self._prefixes is None:
+          self.build()
+    elif time.time() - self._built_at > self.ttl and self._build_lock.acquire(False):
+      # the old index keeps serving while the new one is built
+      def rebuild():
+        try:
+          self.build()
+        finally:
+          self._build_lock.release()
+      threading.Thread(target=rebuild, daemon=True).start()
+
+  # the most frequent words starting with the prefix, as (word, count)
+  def _rank_words(self, prefix, limit):
+    start, end = prefix_range(self._words, prefix)
+    counts = self._word_counts
+    ranked = heapq.nsmallest(limit, range(start, end), key=lambda i: (-counts[i], i))
+    return [(self._words[i], counts[i]) for i in ranked]
+
+  '''
+  suggest(term, limit)
+      returns (question prefixes starting with the term in alphabetical order,
+      words starting with the last word of the term with the most frequent first),
+      at most limit of each, as (text, number of questions) pairs
+  '''
+  def suggest(self, term, limit=SUGGESTIONS):
+    self._ensure_built()
+    text = normalize(term)
+    words = TOKEN.findall(text)
+    # the word being typed, after a space the next one wasn't started yet
+    word = words[-1] if words and text.endswith(words[-1]) else None
+    if text and term[-1:].isspace():
+      text, word = text + ' ', None
+
+    with self._lock:
+      questions = []
+      # longer terms can't be told apart from the prefixes that were kept
+      if text and len(text) <= SUGGEST_PREFIX_LENGTH:
+        start, end = prefix_range(self._prefixes, text)
+        questions = [(self._prefixes[i], self._prefix_counts[i])
+          for i in range(start, min(end, start + limit))]
+
+      suggested_words = []
+      if word is not None and len(word) <= CACHED_PREFIX_LENGTH:
+        top = self._top_words.get(word)
+        if top is None:
+          top = self._top_words[word] = self._rank_words(word, MAX_SUGGESTIONS)
+        suggested_words = top[:limit]
+      elif word is not None:
+        suggested_words = self._rank_words(word, limit)
+
+    return questions, suggested_words
+
+  # bytes the index takes
+  def memory(self):
+    with self._lock:
+      if self._prefixes is None:
+        return {'questions': 0, 'words': 0, 'bytes': 0}
+      size = (sys.getsizeof(self._prefixes) + sys.getsizeof(self._words) +
+        sys.getsizeof(self._prefix_counts) + sys.getsizeof(self._word_counts) +
+        sum(sys.getsizeof(prefix) for prefix in self._prefixes) +
+        sum(sys.getsizeof(word) for word in self._words))
+      return {
+        'questions': sum(self._prefix_counts),
+        'words': len(self._words),
+        'bytes': size
+      }
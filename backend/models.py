@@ -1,6 +1,15 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import time
+import weakref
+import threading
+from sqlalchemy import Column, String, Integer, Float, Boolean, ForeignKey, Index, create_engine, inspect, event
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy import orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.selectable import SelectBase
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, BaseQuery, get_state
+import sqlalchemy
 import json
 
 DB_USER = os.getenv('DB_USER')
@@ -8,18 +17,301 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 database_name = "trivia"
 database_path = "postgres://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, 'localhost:5432', database_name)
 
-db = SQLAlchemy()
+# connection pool of every worker (and of every read replica):
+# pool_size connections are kept open, up to max_overflow more are opened when they are all
+# checked out, a checkout waits at most pool_timeout seconds for one, connections older than
+# pool_recycle seconds are reopened (-1 never) and pool_pre_ping tests them before a checkout.
+# sqlite files don't keep a pool, only pool_recycle and pool_pre_ping apply to them
+POOL_OPTIONS = {
+  'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+  'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+  'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+  'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', -1)),
+  'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '').lower() in ('1', 'true', 'yes')
+}
+# psycopg2 runs executemany (bulk inserts) as one statement per row, these options
+# send the rows in pages instead. SQLAlchemy 1.3.7 replaced use_batch_mode with executemany_mode
+if tuple(int(part) for part in sqlalchemy.__version__.split('.')[:3] if part.isdigit()) >= (1, 3, 7):
+  EXECUTEMANY_OPTIONS = {'executemany_mode': 'values'}
+else:
+  EXECUTEMANY_OPTIONS = {'use_batch_mode': True}
+# upper bounds (in seconds) of the buckets of the time waited for a connection
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+'''
+TimedQuery
+    query that reports how long loading its rows into objects took,
+    when the metrics of the current app set its timer (app.extensions['query_timer'],
+    with start() and stop(token) methods). Without the timer it's the same as the default query
+'''
+class TimedQuery(BaseQuery):
+
+  def __iter__(self):
+    timer = current_app.extensions.get('query_timer') if has_app_context() else None
+    # streamed queries (yield_per) are not loaded all at once, so they are not timed
+    if timer is None or self._yield_per:
+      return super().__iter__()
+
+    token = timer.start()
+    rows = list(super().__iter__())
+    timer.stop(token)
+    return iter(rows)
+
+'''
+PoolStats
+    counters of one connection pool: connections opened and closed (the churn),
+    checkouts, checkouts that timed out and a histogram of the time they waited
+'''
+class PoolStats:
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.connects = 0
+    self.closes = 0
+    self.invalidated = 0
+    self.checkouts = 0
+    self.timeouts = 0
+    self.wait_buckets = [0] * len(POOL_WAIT_BUCKETS)
+    self.wait_count = 0
+    self.wait_sum = 0.0
+    self.wait_max = 0.0
+
+  # counts the connections of the engine's pool, also after it's recreated
+  def attach(self, engine):
+    engine.pool_stats = self
+    engine.pool.stats = self
+
+    def count(name):
+      def listener(*args):
+        with self._lock:
+          setattr(self, name, getattr(self, name) + 1)
+      return listener
+    event.listen(engine, 'connect', count('connects'))
+    event.listen(engine, 'close', count('closes'))
+    event.listen(engine, 'close_detached', count('closes'))
+    event.listen(engine, 'invalidate', count('invalidated'))
+    event.listen(engine, 'checkout', count('checkouts'))
+
+  def waited(self, seconds, timed_out=False):
+    with self._lock:
+      if timed_out:
+        self.timeouts += 1
+      for i, bound in enumerate(POOL_WAIT_BUCKETS):
+        if seconds <= bound:
+          self.wait_buckets[i] += 1
+      self.wait_count += 1
+      self.wait_sum += seconds
+      self.wait_max = max(self.wait_max, seconds)
+
+  def read(self):
+    with self._lock:
+      return {
+        'connects': self.connects,
+        'closes': self.closes,
+        'invalidated': self.invalidated,
+        'checkouts': self.checkouts,
+        'timeouts': self.timeouts,
+        'wait': {
+          'buckets': dict(zip(POOL_WAIT_BUCKETS, self.wait_buckets)),
+          'count': self.wait_count,
+          'sum': self.wait_sum,
+          'max': self.wait_max
+        }
+      }
+
+
+'''
+TimedQueuePool
+    QueuePool that tells its PoolStats how long every checkout waited for a connection
+'''
+class TimedQueuePool(QueuePool):
+  stats = None
+
+  def _do_get(self):
+    stats = self.stats
+    if stats is None:
+      return super()._do_get()
+    start = time.perf_counter()
+    try:
+      connection = super()._do_get()
+    except PoolTimeoutError:
+      stats.waited(time.perf_counter() - start, timed_out=True)
+      raise
+    stats.waited(time.perf_counter() - start)
+    return connection
+
+  def recreate(self):
+    pool = super().recreate()
+    pool.stats = self.stats
+    return pool
+
+
+# {name: value} of what is in the connection pool now, the methods it has (NullPool has none)
+def pool_state(pool):
+  state = {}
+  for name, method in (('size', 'size'), ('checked_in', 'checkedin'),
+      ('checked_out', 'checkedout'), ('overflow', 'overflow')):
+    if hasattr(pool, method):
+      state[name] = getattr(pool, method)()
+  return state
+
+
+'''
+RoutingSession
+    session that sends its queries to the bind named in info['read_bind']
+    (a read replica) when it's set, for requests that only read.
+    Only SELECTs are sent there, flushes and everything else go to the primary database
+'''
+class RoutingSession(SignallingSession):
+
+  def get_bind(self, mapper=None, clause=None):
+    read_bind = self.info.get('read_bind')
+    if read_bind is not None and not self._flushing and isinstance(clause, SelectBase):
+      return get_state(self.app).db.get_engine(self.app, bind=read_bind)
+    return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+  # the pool options of setup_db, SQLALCHEMY_ENGINE_OPTIONS still have the last word
+  def apply_driver_hacks(self, app, sa_url, options):
+    # Flask-SQLAlchemy 2.5 returns them, 2.4 changes the ones it was given and returns None
+    hacked = super().apply_driver_hacks(app, sa_url, options)
+    if hacked is not None:
+      sa_url, options = hacked
+    pool = app.config.get('DB_POOL_OPTIONS', POOL_OPTIONS)
+    if sa_url.drivername.startswith('sqlite'):
+      options.update(pool_recycle=pool['pool_recycle'], pool_pre_ping=pool['pool_pre_ping'])
+    else:
+      options.update(pool, poolclass=TimedQueuePool)
+    if sa_url.drivername.startswith('postgres'):
+      options.update(EXECUTEMANY_OPTIONS)
+    return sa_url, options
+
+db = RoutingSQLAlchemy(query_class=TimedQuery)
+
+# how long (in seconds) a cached question count is trusted before it's counted again,
+# writes made by other workers can't reset our cache so it has to expire on its own
+QUESTION_COUNT_TTL = int(os.getenv('QUESTION_COUNT_TTL', 30))
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service,
+    pool has the connection pool options to change (see POOL_OPTIONS)
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, pool=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    pool_options = dict(POOL_OPTIONS)
+    pool_options.update(app.config.get('DB_POOL', {}))
+    pool_options.update(pool or {})
+    app.config["DB_POOL_OPTIONS"] = pool_options
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # the primary database and the read replicas count their connections
+    for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+        engine = db.get_engine(app, bind=bind)
+        if getattr(engine, 'pool_stats', None) is None:
+            PoolStats().attach(engine)
+    # only in the primary database, the other binds are its read replicas
+    db.create_all(bind=None)
+    DataVersion.ensure('questions', 'categories', 'changes', 'changes_compacted',
+      *[category_version(category_id) for (category_id, ) in db.session.query(Category.id)])
+    # the session is bound to the engine it was made with, the next one uses this database
+    db.session.remove()
+
+# name of the version of one category's questions
+def category_version(category_id):
+  return 'category:{}'.format(category_id)
+
+'''
+DataVersion
+    version counter of a table, kept in the database so all workers see it.
+    Writes bump it in the same transaction, caches poll it to know when they are stale
+'''
+class DataVersion(db.Model):
+  __tablename__ = 'data_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+
+  # bumps the version as part of the current transaction, commit is up to the caller
+  @classmethod
+  def bump(cls, name):
+    updated = cls.query.filter(cls.name == name).update(
+      {cls.version: cls.version + 1}, synchronize_session=False)
+    if not updated:
+      db.session.add(cls(name=name, version=1))
+
+  @classmethod
+  def current(cls, name):
+    return db.session.query(cls.version).filter(cls.name == name).scalar() or 0
+
+  # versions of more tables with one query
+  @classmethod
+  def current_many(cls, *names):
+    versions = dict(db.session.query(cls.name, cls.version).filter(cls.name.in_(names)))
+    return [versions.get(name, 0) for name in names]
+
+  # creates the rows that don't exist yet, so bump doesn't have to insert them
+  # (two workers inserting the same row at once would fail)
+  @classmethod
+  def ensure(cls, *names):
+    existing = set(name for (name, ) in db.session.query(cls.name).filter(cls.name.in_(names)))
+    try:
+      for name in names:
+        if name not in existing:
+          db.session.add(cls(name=name, version=0))
+      db.session.commit()
+    except IntegrityError:
+      # another worker created them first
+      db.session.rollback()
+
+'''
+QuestionChange
+    log of writes to questions and categories, added in the same transaction as the write.
+    Readers remember the last id they have seen and ask only for the newer ones.
+    question_id is null when many questions changed at once (import, deleted category),
+    category_id is set for writes to categories
+'''
+class QuestionChange(db.Model):
+  __tablename__ = 'question_changes'
+  # changes of many questions, readers load all of them again
+  BULK_ACTIONS = ('import', 'category delete')
+
+  id = Column(Integer, primary_key=True)
+  # not foreign keys, deleted questions and categories stay in the log
+  question_id = Column(Integer)
+  category_id = Column(Integer)
+  action = Column(String, nullable=False)
+  changed_at = Column(Float, nullable=False)
+
+  # the newest change of a question is found fast when the log is compacted.
+  # sqlite would use the ids of deleted rows again, they have to keep growing
+  __table_args__ = (
+    Index('ix_question_changes_question_id', 'question_id', 'id'),
+    {'sqlite_autoincrement': True},
+  )
+
+  # adds the change to the current transaction, commit is up to the caller.
+  # The 'changes' version is bumped first and its row stays locked until commit,
+  # so changes get their ids in the order they are committed and no reader skips one
+  @classmethod
+  def log(cls, action, question_id=None, category_id=None):
+    DataVersion.bump('changes')
+    db.session.add(cls(question_id=question_id, category_id=category_id, action=action,
+      changed_at=time.time()))
+
+  # the same change of many questions, with one statement
+  @classmethod
+  def log_many(cls, action, question_ids):
+    DataVersion.bump('changes')
+    now = time.time()
+    db.session.execute(cls.__table__.insert(),
+      [{'question_id': question_id, 'action': action, 'changed_at': now} for question_id in question_ids])
 
 '''
 Question
@@ -31,25 +323,92 @@ class Question(db.Model):
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
+  # (category, id) serves the category pages in id order, (difficulty, category) the quiz filters.
+  # Databases made before these existed are upgraded by migrations/category_foreign_key.py
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+    Index('ix_questions_difficulty', 'difficulty', 'category'),
+  )
+
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
     self.category = category
     self.difficulty = difficulty
 
+  # bumped on every write through insert/update/delete so the caches
+  # built on top of questions (like the quiz pool) know they are stale
+  version = 0
+  # (count, time it was counted), reset on every write
+  _count_cache = None
+  # objects with question_changed(action, old, new) method, called after every write
+  # with formatted question before and after it. Held weakly so they go away with their app
+  observers = weakref.WeakSet()
+
   def insert(self):
     db.session.add(self)
+    # flush gets us the id, so we don't need to load the question again after commit
+    db.session.flush()
+    new = self.format()
+    Question.bump_versions(self.category)
+    QuestionChange.log('insert', self.id)
     db.session.commit()
+    Question.changed('insert', None, new)
   
   def update(self):
+    old = self.saved_values()
+    new = self.format()
+    Question.bump_versions(old['category'], new['category'])
+    QuestionChange.log('update', self.id)
     db.session.commit()
+    Question.changed('update', old, new)
 
   def delete(self):
+    old = self.saved_values()
     db.session.delete(self)
+    Question.bump_versions(old['category'])
+    QuestionChange.log('delete', self.id)
     db.session.commit()
+    Question.changed('delete', old, None)
+
+  # bumps the version of all questions and of the categories that were written to,
+  # so responses of the other categories stay valid
+  @staticmethod
+  def bump_versions(*categories):
+    DataVersion.bump('questions')
+    for category_id in set(categories):
+      if category_id is not None:
+        DataVersion.bump(category_version(category_id))
+
+  # Called without arguments when questions were changed in bulk
+  @classmethod
+  def changed(cls, action=None, old=None, new=None):
+    cls.version += 1
+    cls._count_cache = None
+    for observer in list(cls.observers):
+      observer.question_changed(action, old, new)
+
+  # formatted question as it is saved in the database, without the changes not committed yet
+  def saved_values(self):
+    values = self.format()
+    for attr in inspect(self).attrs:
+      if attr.key in values and attr.history.deleted:
+        values[attr.key] = attr.history.deleted[0]
+    return values
+
+  # Returns the number of all questions without running COUNT on every request
+  @classmethod
+  def count(cls):
+    cached = cls._count_cache
+    if cached is not None and time.time() - cached[1] < QUESTION_COUNT_TTL:
+      return cached[0]
+
+    total = cls.query.count()
+    cls._count_cache = (total, time.time())
+    return total
 
   def format(self):
     return {
@@ -70,16 +429,34 @@ class Category(db.Model):
   id = Column(Integer, primary_key=True)
   type = Column(String)
 
+  # bumped on every write of this process, so its own caches don't wait for polling
+  version = 0
+
   def __init__(self, type):
     self.type = type
 
   def insert(self):
     db.session.add(self)
+    db.session.flush()
+    DataVersion.bump('categories')
+    DataVersion.bump(category_version(self.id))
+    QuestionChange.log('category insert', category_id=self.id)
     db.session.commit()
+    Category.version += 1
 
+  # its questions stay, without a category (the foreign key sets it to null)
   def delete(self):
-    db.session.delete(self)
+    self.delete_without_commit()
     db.session.commit()
+    Category.version += 1
+    Question.changed()
+
+  # deletes it as part of the current transaction, commit is up to the caller
+  def delete_without_commit(self):
+    db.session.delete(self)
+    DataVersion.bump('categories')
+    Question.bump_versions(self.id)
+    QuestionChange.log('category delete', category_id=self.id)
     
   def format(self):
     return {
@@ -90,4 +467,69 @@ class Category(db.Model):
   def formatDict(self):
     return {
       self.id: self.type
-    }
\ No newline at end of file
+    }
+
+'''
+QuizResult
+    score of one played quiz, written in batches by flaskr.results.ResultWriter.
+    The id is made by the app, so the answers can be inserted in the same batch
+'''
+class QuizResult(db.Model):
+  __tablename__ = 'quiz_results'
+
+  id = Column(String, primary_key=True)
+  # id of the quiz category, 0 for quizzes of all categories.
+  # Not a foreign key, results of deleted categories stay
+  category = Column(Integer, nullable=False)
+  player = Column(String)
+  score = Column(Integer, nullable=False)
+  total = Column(Integer, nullable=False)
+  played_at = Column(Float, nullable=False)
+
+  # a leaderboard is the first rows of its category in this index
+  __table_args__ = (
+    Index('ix_quiz_results_leaderboard', category, score.desc(), played_at, id),
+  )
+
+  def format(self):
+    return {
+      'id': self.id,
+      'category': self.category,
+      'player': self.player,
+      'score': self.score,
+      'total': self.total,
+      'played_at': self.played_at
+    }
+
+'''
+QuizAnswer
+    one answer of a quiz result
+'''
+class QuizAnswer(db.Model):
+  __tablename__ = 'quiz_answers'
+
+  id = Column(Integer, primary_key=True)
+  result_id = Column(String, ForeignKey('quiz_results.id', ondelete='CASCADE'), nullable=False, index=True)
+  # not a foreign key, answers of deleted questions stay
+  question_id = Column(Integer, nullable=False)
+  correct = Column(Boolean, nullable=False)
+
+'''
+QuestionStats
+    how many times a question was answered and how many answers were correct,
+    counters incremented by every batch of quiz results
+'''
+class QuestionStats(db.Model):
+  __tablename__ = 'question_stats'
+
+  question_id = Column(Integer, primary_key=True, autoincrement=False)
+  answered = Column(Integer, nullable=False, default=0)
+  correct = Column(Integer, nullable=False, default=0)
+
+  def format(self):
+    return {
+      'question_id': self.question_id,
+      'answered': self.answered,
+      'correct': self.correct,
+      'correct_rate': round(self.correct / self.answered, 3) if self.answered else None
+    }
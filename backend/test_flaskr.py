@@ -1,10 +1,23 @@
 import os
+import gzip
+import math
+import time
 import unittest
 import json
+import tempfile
+import threading
+from sqlalchemy import create_engine
 from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import AsyncApp
+from flaskr.changes import compact_changes
+from flaskr.singleflight import SingleFlight
+from flaskr.quiz import QuestionPool
+from flaskr.results import ResultWriter, Leaderboards, quiz_result
+from flaskr.search import SearchIndex
+from flaskr import serialize
+from models import setup_db, db, Question, Category
 
 # change this variable on each test
 delete_question_id = 4
@@ -27,6 +40,12 @@ class TriviaTestCase(unittest.TestCase):
             'localhost:5432', 
             self.database_name)
         setup_db(self.app, self.database_path)
+
+        # TEST_MODE=asgi runs the tests against the ASGI entry point
+        self.asgi_app = None
+        if os.getenv('TEST_MODE') == 'asgi':
+            self.asgi_app = AsyncApp(self.app)
+            self.client = self.asgi_app.test_client
         
         """ variables used in testing routes 
             If the database is meddled with tests can fail!
@@ -62,7 +81,8 @@ class TriviaTestCase(unittest.TestCase):
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        if self.asgi_app is not None:
+            self.asgi_app.shutdown()
 
     """
     TODO
@@ -86,6 +106,17 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['category'], self.new_category['category'])
 
+    # cached categories see the new category right away
+    def test_create_category_is_listed(self):
+        self.client().get('/categories')
+        res = self.client().post('/categories', json={'category': 'cached'})
+        categories = json.loads(self.client().get('/categories').data)['categories']
+        again = self.client().post('/categories', json={'category': 'cached'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('cached', categories.values())
+        self.assertEqual(again.status_code, 409)
+
     def test_409_category_already_exists(self):
         res = self.client().post('/categories', json=self.science_category)
         data = json.loads(res.data)
@@ -145,6 +176,18 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not found')
 
+    # keyset pagination gives the same page as page=2
+    def test_get_questions_after(self):
+        first_page = json.loads(self.client().get('/questions').data)
+        res = self.client().get('/questions?after=' + str(first_page['next_after']))
+        data = json.loads(res.data)
+        second_page = json.loads(self.client().get('/questions?page=2').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions'], second_page['questions'])
+        self.assertEqual(data['total_questions'], first_page['total_questions'])
+
     # create_question() tests
     # create question success
     def test_create_new_question(self):
@@ -153,6 +196,8 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        # duplicates are only looked for with ?duplicates= or DUPLICATE_CHECK
+        self.assertNotIn('duplicates', data)
     # posting empty object
     def test_422_creating_new_questions_without_values(self):
         res = self.client().post('/questions', json={})
@@ -162,6 +207,105 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable')
 
+    # duplicate tests, question 5 is "Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?"
+    # the same text without punctuation and case is an exact duplicate
+    def test_create_question_duplicate_flagged(self):
+        res = self.client().post('/questions?duplicates=flag', json=dict(self.new_question,
+            question='whose autobiography is entitled I know why the caged bird sings'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn({'id': 5, 'question': "Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?",
+            'similarity': 1.0}, data['duplicates'])
+    # a near duplicate isn't saved
+    def test_409_create_question_duplicate_rejected(self):
+        question = "Whose autobiography is entitled 'I Know Why the Caged Bird Sing'?"
+        res = self.client().post('/questions?duplicates=reject', json=dict(self.new_question,
+            question=question))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Duplicate question')
+        self.assertIn(5, [duplicate['id'] for duplicate in data['duplicates']])
+        self.assertTrue(0.8 < data['duplicates'][-1]['similarity'] < 1)
+        self.assertEqual(Question.query.filter(Question.question == question).count(), 0)
+
+    def test_question_duplicates_report(self):
+        question = dict(self.new_question, question='How many duplicates are too many?')
+        for _ in range(2):
+            self.client().post('/questions?duplicates=allow', json=question)
+        res = self.client().get('/questions/duplicates')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['total_duplicates'] >= 1)
+        self.assertIn([question['question']] * 2, [[duplicate['question'] for duplicate in cluster]
+            for cluster in data['clusters']])
+
+    # bulk import tests
+    def test_import_questions(self):
+        lines = [json.dumps(self.new_question), '{"question": "No answer?"}']
+        res = self.client().post('/questions/import', data='\n'.join(lines),
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['line'], 2)
+
+    def test_import_questions_unknown_category(self):
+        lines = [json.dumps(dict(self.new_question, question='Mixed import {}?'.format(number),
+            category=category)) for number, category in ((1, 1), (2, 999), (3, 2))]
+        res = self.client().post('/questions/import', data='\n'.join(lines),
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['errors'], [{'line': 2, 'message': 'category does not exist'}])
+        self.assertEqual(Question.query.filter(
+            Question.question.like('Mixed import %')).count(), 2)
+
+    def test_import_questions_duplicates_rejected(self):
+        lines = [json.dumps(dict(self.new_question, question=question)) for question in (
+            "Whose autobiography is entitled 'I know why the caged bird sings'", 'Imported once?', 'Imported once?')]
+        res = self.client().post('/questions/import?duplicates=reject', data='\n'.join(lines),
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual([error['message'] for error in data['errors']],
+            ['duplicate of question 5', 'duplicate of line 2'])
+
+    def test_import_questions_csv_dry_run(self):
+        res = self.client().post('/questions/import?dry_run=true',
+            data='question,answer,difficulty,category\nCSV?,Yes,1,1\n',
+            content_type='text/csv')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['dry_run'], True)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(Question.query.filter(
+            Question.question == 'CSV?').count(), 0)
+
+    # export test
+    def test_export_questions(self):
+        res = self.client().get('/questions/export?category=2')
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(rows))
+        for row in rows:
+            self.assertEqual(str(row['category']), '2')
+
     # delete_question(question_id) tests
     # delete success
     def test_delete_question(self):
@@ -207,6 +351,66 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Bad request')
 
+    # conditional requests tests
+    def test_304_categories_not_modified(self):
+        res = self.client().get('/categories')
+        res_again = self.client().get('/categories',
+            headers={'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res_again.status_code, 304)
+        self.assertEqual(res_again.data, b'')
+
+    def test_questions_etag_changes_after_create(self):
+        res = self.client().get('/questions')
+        self.client().post('/questions', json=self.new_question)
+        res_again = self.client().get('/questions',
+            headers={'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(res_again.status_code, 200)
+        self.assertNotEqual(res_again.headers['ETag'], res.headers['ETag'])
+
+    def test_412_update_question_changed(self):
+        res = self.client().get('/questions/5')
+        etag = res.headers['ETag']
+        self.client().put('/questions/5',
+            json={'answer': 'First'}, headers={'If-Match': etag})
+        res = self.client().put('/questions/5',
+            json={'answer': 'Second'}, headers={'If-Match': etag})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Precondition failed')
+
+    # two updates with the same ETag at once, only the first one is saved
+    def test_412_concurrent_updates_with_same_etag(self):
+        with self.app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                self.skipTest('row locks need Postgres')
+        etag = self.client().get('/questions/5').headers['ETag']
+        engine = create_engine(self.database_path.replace('postgres://', 'postgresql://', 1))
+        statuses = []
+
+        def update(answer):
+            res = self.client().put('/questions/5', json={'answer': answer}, headers={'If-Match': etag})
+            statuses.append(res.status_code)
+
+        # both updates wait for the lock held here, then run one after the other
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute('SELECT id FROM questions WHERE id = 5 FOR UPDATE')
+            threads = [threading.Thread(target=update, args=(answer, )) for answer in ('Locked 1', 'Locked 2')]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.3)
+            transaction.commit()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+
+        self.assertEqual(sorted(statuses), [200, 412])
+
     # search_question() test
     # search success
     def test_search_question(self):
@@ -227,6 +431,70 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable')
 
+    # indexed search test
+    def test_search_question_index(self):
+        res = self.client().get('/questions/search?q=Soccer%20cup')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']))
+        self.assertTrue(data['total_questions'] > 0)
+        for question in data['questions']:
+            self.assertIn('soccer', question['question'].lower())
+    # searching answers too
+    def test_search_question_index_answers(self):
+        res = self.client().get('/questions/search?q=escher&answers=true')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['answer'], 'Escher')
+    # no match
+    def test_404_search_question_index_not_found(self):
+        res = self.client().get('/questions/search?q=hdkerefdsgsd')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Not found')
+
+    # rarity of the words counts the questions in the index, not the highest id
+    def test_search_index_counts_questions(self):
+        rows = [(1, 'Which river is longest?', 'Nile'), (500, 'Which river is widest?', 'Amazon')]
+        index = SearchIndex(self.app, rows=lambda: rows)
+        index.build()
+        idf = index._idf(index._questions, 'longest')
+
+        self.assertAlmostEqual(idf, math.log(1 + 2 / 2))
+        index.question_changed('delete', {'id': 500, 'question': rows[1][1], 'answer': rows[1][2]}, None)
+        self.assertAlmostEqual(index._idf(index._questions, 'longest'), math.log(1 + 1 / 2))
+
+    # autocomplete tests
+    def test_suggest_questions(self):
+        res = self.client().get('/questions/suggest?q=Which%20country')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions'][0]['prefix'], 'which country won the first ever')
+        self.assertEqual(data['words'][0]['word'], 'country')
+    # the index built by the first request is updated by the write
+    def test_suggest_questions_after_write(self):
+        client = self.client()
+        client.get('/questions/suggest?q=zebra')
+        client.post('/questions', json=dict(self.new_question, question='Zebras have how many stripes?'))
+        data = json.loads(client.get('/questions/suggest?q=zebr').data)
+
+        self.assertEqual(data['questions'], [{'prefix': 'zebras have how many stripes?', 'count': 1}])
+        self.assertEqual(data['words'], [{'word': 'zebras', 'count': 1}])
+
+    def test_422_suggest_questions_empty(self):
+        res = self.client().get('/questions/suggest?q=%20')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     # category_questions(category_id) test
     def test_get_category_questions(self):
         res = self.client().get('/categories/1/questions')
@@ -236,6 +504,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['questions']))
         self.assertTrue(data['total_questions'] > 0)
+        self.assertEqual(set(question['category'] for question in data['questions']), {1})
+        question_ids = [question['id'] for question in data['questions']]
+        self.assertEqual(question_ids, sorted(question_ids))
     # error not valid category
     def test_404_category_not_found(self):
         res = self.client().get('/categories/1000/questions')
@@ -270,6 +541,595 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['status'], 'no more questions')
     
+    def test_get_quizzes_batch(self):
+        res = self.client().post('/quizzes', json={
+            "quiz_category": self.test_quiz_category,
+            "previous_questions": self.test_previous_questions[:1],
+            "count": 10
+        })
+        data = json.loads(res.data)
+        question_ids = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(sorted(question_ids), [17, 18, 19])
+
+    def test_get_quizzes_categories_and_difficulty(self):
+        res = self.client().post('/quizzes', json={
+            "categories": [2, 3],
+            "difficulty": 2,
+            "previous_questions": [],
+            "count": 5
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(question['id'] for question in data['questions']), [13, 15, 19])
+
+    def test_422_get_quizzes_invalid_count(self):
+        res = self.client().post('/quizzes', json={
+            "quiz_category": self.test_quiz_category,
+            "previous_questions": [],
+            "count": 0
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # question pool tests
+    def test_question_pool_sample(self):
+        pool = QuestionPool()
+        with self.app.app_context():
+            picked = pool.sample([1], self.test_previous_questions, 100)
+            by_difficulty = pool.sample([0], [], 100, difficulty=4)
+            questions = {question.id: question for question in Question.query.all()}
+
+        self.assertEqual(len(picked), len(set(picked)))
+        self.assertTrue(all(questions[question_id].category == 1 for question_id in picked))
+        self.assertEqual(len(picked), len([question for question in questions.values()
+            if question.category == 1 and str(question.id) not in self.test_previous_questions]))
+        self.assertTrue(all(questions[question_id].difficulty == 4 for question_id in by_difficulty))
+
+    def test_question_pool_loaded_once_when_stale(self):
+        pool = QuestionPool()
+        loads = []
+        load = pool._load
+
+        def counted_load():
+            loads.append(1)
+            time.sleep(0.05)
+            return load()
+        pool._load = counted_load
+
+        def pick():
+            with self.app.app_context():
+                pool.ids(0)
+        threads = [threading.Thread(target=pick) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loads), 1)
+
+        Question.changed()
+        self.assertTrue(pool.stale())
+        with self.app.app_context():
+            pool.ids(0)
+        self.assertEqual(len(loads), 2)
+
+        # invalidating keeps the old ids until the next load replaces them
+        pool.invalidate()
+        self.assertTrue(pool.stale())
+        self.assertIsNotNone(pool._pool)
+        with self.app.app_context():
+            self.assertTrue(len(pool.ids(0)))
+        self.assertEqual(len(loads), 3)
+        self.assertFalse(pool.stale())
+        self.assertFalse(pool.stale())
+
+    # quiz sessions tests
+    # play the whole category through a session
+    def test_quiz_session(self):
+        res = self.client().post('/quizzes/sessions', json={
+            "quiz_category": self.test_quiz_category, "seed": 1})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['total_questions'] > 0)
+
+        question_ids = []
+        while True:
+            res = self.client().post(
+                '/quizzes/sessions/' + data['session_id'] + '/next')
+            next_data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            if 'status' in next_data:
+                break
+            question_ids.append(next_data['question']['id'])
+
+        self.assertEqual(next_data['status'], 'no more questions')
+        self.assertEqual(len(question_ids), len(set(question_ids)))
+        self.assertIn(self.test_unanswered_question_id, question_ids)
+
+    def test_404_quiz_session_does_not_exist(self):
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Not found')
+    
+    # quiz results tests
+    def test_record_quiz_result(self):
+        stats = json.loads(self.client().get('/questions/5/stats').data)
+        res = self.client().post('/quizzes/results', json={
+            "quiz_category": {"type": "Entertainment", "id": "5"},
+            "player": "Tester",
+            "answers": [{"question": 5, "correct": True}, {"question": 6, "correct": True},
+                {"question": 9, "correct": False}]})
+        data = json.loads(res.data)
+        leaderboard = json.loads(self.client().get('/quizzes/leaderboards/5').data)['leaderboard']
+        new_stats = json.loads(self.client().get('/questions/5/stats').data)
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['success'], True)
+        self.assertEqual((data['score'], data['total']), (2, 3))
+        self.assertIn(data['result_id'], [result['id'] for result in leaderboard])
+        self.assertEqual(new_stats['answered'], stats['answered'] + 1)
+        self.assertEqual(new_stats['correct'], stats['correct'] + 1)
+
+    def test_quiz_results_group_commit(self):
+        app = create_app({'METRICS_ENABLED': True, 'RESULTS_FLUSH_INTERVAL': 0.5})
+        setup_db(app, self.database_path)
+        barrier = threading.Barrier(10)
+        statuses = []
+        # answers have to be of questions that exist, other tests delete some
+        question_ids = [question.id for question in Question.query.order_by(Question.id).limit(5)]
+
+        def play(score):
+            client = app.test_client()
+            barrier.wait()
+            res = client.post('/quizzes/results', json={"quiz_category": {"id": 0},
+                "answers": [{"question": question_id, "correct": i < score}
+                    for i, question_id in enumerate(question_ids)]})
+            statuses.append(res.status_code)
+
+        threads = [threading.Thread(target=play, args=(i % 5, )) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = app.test_client().get('/metrics').data.decode()
+        leaderboard = json.loads(app.test_client().get('/quizzes/leaderboards/0').data)['leaderboard']
+
+        self.assertEqual(statuses, [201] * 10)
+        self.assertIn('trivia_quiz_results_total 10', metrics)
+        self.assertIn('trivia_quiz_result_batches_total 1', metrics)
+        self.assertEqual([result['rank'] for result in leaderboard], list(range(1, len(leaderboard) + 1)))
+        self.assertEqual(leaderboard[0]['score'], 4)
+
+    def test_422_record_quiz_result_invalid_answers(self):
+        res = self.client().post('/quizzes/results', json={
+            "quiz_category": {"id": 0},
+            "answers": [{"question": 5, "correct": True}, {"question": 5, "correct": True}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_422_record_quiz_result_unknown_question(self):
+        res = self.client().post('/quizzes/results', json={
+            "quiz_category": {"id": 0},
+            "answers": [{"question": 5, "correct": True}, {"question": 12345, "correct": True}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # a listener that fails doesn't stop the writer thread
+    def test_quiz_results_listener_error(self):
+        writer = ResultWriter(self.app, interval=0.01, timeout=5)
+        written = []
+
+        def failing_listener(results):
+            raise RuntimeError('leaderboard is broken')
+        writer.listeners.extend([failing_listener, written.extend])
+
+        results = [quiz_result(0, 'Listener', [(5, True)]) for _ in range(2)]
+        for result in results:
+            writer.submit(result)
+
+        self.assertEqual(writer.stats()['results'], 2)
+        self.assertEqual(written, results)
+
+    # results added while a leaderboard loads don't wait for the query and aren't lost
+    def test_leaderboard_add_while_loading(self):
+        leaderboards = Leaderboards(size=3)
+        loading = threading.Event()
+        release = threading.Event()
+        boards = []
+
+        def result(result_id, score):
+            return {'id': result_id, 'category': 1, 'score': score, 'total': 5,
+                'player': 'Loading', 'played_at': '2026-10-18T12:00:0{}'.format(result_id)}
+
+        def load(category_id):
+            loading.set()
+            release.wait(5)
+            return [Leaderboards.entry(result(1, 2))]
+        leaderboards._load = load
+
+        thread = threading.Thread(target=lambda: boards.append(leaderboards.top(1)))
+        thread.start()
+        loading.wait(5)
+        start = time.perf_counter()
+        # the first result was committed before the load read it
+        leaderboards.add([result(1, 2), result(2, 5)])
+        seconds = time.perf_counter() - start
+        release.set()
+        thread.join()
+
+        self.assertLess(seconds, 1)
+        self.assertEqual([entry['id'] for entry in boards[0]], [2, 1])
+        self.assertEqual([entry['id'] for entry in leaderboards.top(1)], [2, 1])
+
+    # response cache tests
+    def test_category_questions_cached_until_category_changes(self):
+        self.client().get('/categories/2/questions')
+        cached = self.client().get('/categories/2/questions')
+        self.client().post('/questions', json=self.new_question)
+        still_cached = self.client().get('/categories/2/questions')
+        res = self.client().get('/categories/1/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(still_cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['questions'][-1]['question'], self.new_question['question'])
+
+    # compression tests
+    def test_compress_large_response(self):
+        plain = self.client().get('/questions')
+        res = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        again = self.client().get('/questions', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        # another body, so another tag
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(again.status_code, 304)
+
+    # the ETag of a compressed question is the one If-Match needs to update it
+    def test_update_question_with_compressed_etag(self):
+        self.client().put('/questions/23', json={'answer': 'Scarab ' * 200})
+        res = self.client().get('/questions/23', headers={'Accept-Encoding': 'gzip'})
+        again = self.client().get('/questions/23', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': res.headers['ETag']})
+        update = self.client().put('/questions/23', json={'answer': 'Scarab'},
+            headers={'If-Match': res.headers['ETag']})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.headers['ETag'], res.headers['ETag'])
+        self.assertEqual(update.status_code, 200)
+
+    def test_small_response_not_compressed(self):
+        res = self.client().get('/categories', headers={'Accept-Encoding': 'gzip, br'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(data['success'], True)
+
+    def test_cached_response_compressed_once(self):
+        responses = self.app.extensions['trivia']['responses']
+        first = self.client().get('/questions?page=1', headers={'Accept-Encoding': 'gzip'})
+        second = self.client().get('/questions?page=1', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(responses.stats()['compressed_hits'], 1)
+
+    # metrics tests
+    def test_server_timing_and_metrics(self):
+        app = create_app({'METRICS_ENABLED': True})
+        setup_db(app, self.database_path)
+        res = app.test_client().get('/questions')
+        metrics = app.test_client().get('/metrics').data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertIn('trivia_request_duration_seconds_count{method="GET",route="/questions"} 1',
+            metrics)
+        self.assertIn('trivia_response_cache_misses_total 1', metrics)
+
+    # the timers belong to the app with metrics, other apps and the models aren't changed
+    def test_metrics_timers_per_app(self):
+        timed_app = create_app({'METRICS_ENABLED': True})
+        setup_db(timed_app, self.database_path)
+        res = timed_app.test_client().get('/questions')
+
+        self.assertIn('format;dur=', res.headers['Server-Timing'])
+        self.assertIn('query_timer', timed_app.extensions)
+        self.assertNotIn('query_timer', self.app.extensions)
+        self.assertFalse(hasattr(Question.format, 'timed'))
+        self.assertNotIn('Server-Timing', self.client().get('/questions').headers)
+
+    def test_status_connection_pools(self):
+        app = create_app({'METRICS_ENABLED': True, 'DB_POOL': {'pool_size': 2, 'max_overflow': 1}})
+        setup_db(app, self.database_path)
+        app.test_client().get('/questions')
+        res = app.test_client().get('/status')
+        data = json.loads(res.data)
+        metrics = app.test_client().get('/metrics').data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['pool_options']['pool_size'], 2)
+        self.assertEqual(data['connections_per_worker'], 3)
+        self.assertTrue(data['pools']['primary']['checkouts'])
+        self.assertIn('trivia_db_pool_wait_seconds_count{bind="primary"}', metrics)
+
+    def test_404_metrics_disabled(self):
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 404)
+
+    # serialization tests
+    def test_same_response_without_fast_json(self):
+        app = create_app({'FAST_JSON': False})
+        setup_db(app, self.database_path)
+        res = self.client().get('/questions?page=1')
+        standard_res = app.test_client().get('/questions?page=1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, standard_res.data)
+
+    # orjson versions that write big floats without the + of the exponent fall back to json
+    def test_fast_json_big_floats(self):
+        if serialize.orjson is None:
+            self.skipTest('orjson is not installed')
+        big_floats_differ = serialize.BIG_FLOATS_DIFFER
+        serialize.BIG_FLOATS_DIFFER = True
+        try:
+            self.assertFalse(serialize.same_as_json(b'{"rate":1e16}'))
+            self.assertTrue(serialize.same_as_json(b'{"rate":1e+16}'))
+        finally:
+            serialize.BIG_FLOATS_DIFFER = big_floats_differ
+
+        value = {'big': 1e16, 'bigger': -1.5e300, 'small': 1e-05}
+        with self.app.app_context():
+            encoded = serialize.FastJSONEncoder(sort_keys=True, separators=(',', ':')).encode(value)
+        self.assertEqual(encoded, json.dumps(value, sort_keys=True, separators=(',', ':')))
+
+    # bulk update and delete tests
+    def test_bulk_delete_questions(self):
+        res = self.client().post('/questions/bulk-delete?batch_size=1', json={'ids': [12, 14]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(data['batches'], 2)
+        self.assertEqual(self.client().get('/questions/12').status_code, 404)
+
+    def test_bulk_update_questions(self):
+        category_questions = Question.query.filter(Question.category == 4).count()
+        res = self.client().patch('/questions/bulk', json={
+            'filter': {'category': 4}, 'set': {'difficulty': 1}})
+        data = json.loads(res.data)
+        category = json.loads(self.client().get('/categories/4/questions').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], category_questions)
+        self.assertEqual(set(question['difficulty'] for question in category['questions']), {1})
+
+    def test_422_bulk_delete_without_selection(self):
+        res = self.client().post('/questions/bulk-delete', json={'filter': {}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_delete_category_move_questions(self):
+        self.client().post('/categories', json={'category': 'Moved'})
+        category_id = Category.query.filter(Category.type == 'Moved').one().id
+        self.client().post('/questions', json=dict(self.new_question, category=category_id))
+        res = self.client().delete('/categories/%d?questions=move&to=1' % category_id)
+        data = json.loads(res.data)
+        moved = json.loads(self.client().get('/categories/1/questions').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changed_questions'], 1)
+        self.assertEqual(Category.query.get(category_id), None)
+        self.assertEqual(moved['questions'][-1]['question'], self.new_question['question'])
+
+    # change feed tests
+    def test_get_changes(self):
+        version = json.loads(self.client().get('/changes').data)['version']
+        self.client().post('/questions', json=self.new_question)
+        self.client().put('/questions/2', json=self.updated_question)
+        res = self.client().get('/changes?since=%d' % version)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['reset'], False)
+        self.assertEqual(data['has_more'], False)
+        self.assertEqual(data['version'], version + 2)
+        self.assertEqual([question['question'] for question in data['questions']],
+            [self.updated_question['question'], self.new_question['question']])
+
+    def test_get_changes_paginated(self):
+        version = json.loads(self.client().get('/changes').data)['version']
+        self.client().post('/questions', json=self.new_question)
+        self.client().post('/questions', json=self.new_question)
+        data = json.loads(self.client().get('/changes?since=%d&limit=1' % version).data)
+        next_data = json.loads(self.client().get('/changes?since=%d&limit=1' % data['version']).data)
+
+        self.assertEqual(data['has_more'], True)
+        self.assertEqual(len(data['questions']), 1)
+        self.assertEqual(next_data['has_more'], False)
+        self.assertEqual(next_data['questions'][0]['id'], data['questions'][0]['id'] + 1)
+
+    def test_changes_reset_after_compaction(self):
+        version = json.loads(self.client().get('/changes').data)['version']
+        self.client().post('/questions', json=self.new_question)
+        self.client().post('/questions', json=self.new_question)
+        with self.app.app_context():
+            compact_changes(retention=0)
+        data = json.loads(self.client().get('/changes?since=%d' % version).data)
+
+        self.assertEqual(data['reset'], True)
+        self.assertEqual(data['version'], version + 2)
+        self.assertEqual(data['questions'], [])
+
+    def test_422_changes_invalid_since(self):
+        res = self.client().get('/changes?since=abc')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # snapshot mode tests
+    def snapshot_app(self, **config):
+        return create_app(dict(config, SNAPSHOT_MODE=True, SQLALCHEMY_DATABASE_URI=self.database_path))
+
+    def test_snapshot_same_responses(self):
+        client = self.snapshot_app().test_client()
+
+        for path in ('/questions?page=2', '/questions?after=5', '/categories',
+                '/categories/1/questions', '/questions/2', '/questions/search?q=title',
+                '/questions/duplicates'):
+            res = client.get(path)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, self.client().get(path).data)
+
+    def test_405_snapshot_mode_read_only(self):
+        client = self.snapshot_app().test_client()
+        res = client.post('/questions', json=self.new_question)
+        data = json.loads(res.data)
+        quiz = client.post('/quizzes', json={
+            'quiz_category': self.test_quiz_category,
+            'previous_questions': []})
+
+        self.assertEqual(res.status_code, 405)
+        self.assertEqual(data['message'], 'Method not allowed')
+        self.assertEqual(quiz.status_code, 200)
+        self.assertEqual(json.loads(quiz.data)['question']['category'], 2)
+
+    # quiz results are written in snapshot mode, they don't change the question bank
+    def test_snapshot_records_quiz_result(self):
+        client = self.snapshot_app().test_client()
+        res = client.post('/quizzes/results', json={
+            "quiz_category": {"id": 1},
+            "player": "Snapshot",
+            "answers": [{"question": 20, "correct": True}]})
+        leaderboard = json.loads(client.get('/quizzes/leaderboards/1').data)['leaderboard']
+
+        self.assertEqual(res.status_code, 201)
+        self.assertIn(json.loads(res.data)['result_id'], [result['id'] for result in leaderboard])
+
+    def test_snapshot_refreshes_after_write(self):
+        client = self.snapshot_app(SNAPSHOT_REFRESH=0).test_client()
+        total = json.loads(client.get('/questions').data)['total_questions']
+        self.client().post('/questions', json=self.new_question)
+
+        # the refresh runs in the background after a request
+        for _ in range(50):
+            data = json.loads(client.get('/questions').data)
+            if data['total_questions'] > total:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(data['total_questions'], total + 1)
+        res = client.get('/categories/1/questions')
+        self.assertEqual(json.loads(res.data)['questions'][-1]['question'], self.new_question['question'])
+
+    # read replica tests, the replica is an sqlite file with one category only it has
+    def replica_app(self, replicas, **config):
+        return create_app(dict(config, SQLALCHEMY_DATABASE_URI=self.database_path,
+            SQLALCHEMY_REPLICAS=replicas))
+
+    def replica_database(self):
+        path = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')
+        engine = create_engine(path)
+        db.Model.metadata.create_all(engine)
+        engine.execute(Category.__table__.insert(), type='Replica only')
+        engine.dispose()
+        return path
+
+    def test_replica_serves_reads(self):
+        client = self.replica_app([self.replica_database()]).test_client()
+        res = client.get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(data['categories'].values()), ['Replica only'])
+
+    def test_replica_primary_reads_after_write(self):
+        client = self.replica_app([self.replica_database()]).test_client()
+        res = client.post('/questions', json=self.new_question)
+        data = json.loads(client.get('/categories').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_primary_until=', res.headers['Set-Cookie'])
+        self.assertNotIn('Replica only', data['categories'].values())
+
+    def test_replica_down_reads_from_primary(self):
+        client = self.replica_app(['sqlite:////nonexistent/replica.db']).test_client()
+        res = client.get('/categories')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, self.client().get('/categories').data)
+
+    # single-flight tests, the leader runs until release is set
+    def start_flight(self, flights, results):
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'leader response'
+        leader = threading.Thread(target=lambda: results.append(flights.do('/questions?', slow)))
+        leader.start()
+        started.wait(5)
+        return leader, release
+
+    def test_single_flight_shares_response(self):
+        flights = SingleFlight(timeout=5)
+        results = []
+        leader, release = self.start_flight(flights, results)
+        follower = threading.Thread(
+            target=lambda: results.append(flights.do('/questions?', lambda: 'own response')))
+        follower.start()
+        time.sleep(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(sorted(results), [('leader response', False), ('leader response', True)])
+        self.assertEqual(flights.stats(), {'leaders': 1, 'shared': 1, 'fallbacks': 0})
+
+    def test_single_flight_timeout_runs_on_its_own(self):
+        flights = SingleFlight(timeout=0.05)
+        results = []
+        leader, release = self.start_flight(flights, results)
+        result = flights.do('/questions?', lambda: 'own response')
+        release.set()
+        leader.join()
+
+        self.assertEqual(result, ('own response', False))
+        self.assertEqual(flights.stats()['fallbacks'], 1)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -14,7 +14,9 @@ class QuizView extends Component {
         showAnswer: false,
         categories: {},
         numCorrect: 0,
+        answers: [],
         currentQuestion: {},
+        upcomingQuestions: [],
         guess: '',
         forceEnd: false
     }
@@ -36,38 +38,31 @@ class QuizView extends Component {
   }
 
   selectCategory = ({type, id=0}) => {
-    this.setState({quizCategory: {type, id}}, this.getNextQuestion)
+    this.setState({quizCategory: {type, id}}, this.getQuestions)
   }
 
   handleChange = (event) => {
     this.setState({[event.target.name]: event.target.value})
   }
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions]
-    if(this.state.currentQuestion.id) { previousQuestions.push(this.state.currentQuestion.id) }
-
+  // all questions of the round are fetched with one request
+  getQuestions = () => {
     $.ajax({
       url: '/quizzes', //TODO: update request URL
       type: "POST",
       dataType: 'json',
       contentType: 'application/json',
       data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory
+        previous_questions: [],
+        quiz_category: this.state.quizCategory,
+        count: questionsPerPlay
       }),
       xhrFields: {
         withCredentials: true
       },
       crossDomain: true,
       success: (result) => {
-        this.setState({
-          showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
-          guess: '',
-          forceEnd: result.question ? false : true
-        })
+        this.setState({ upcomingQuestions: result.questions || [] }, this.getNextQuestion)
         return;
       },
       error: (error) => {
@@ -77,23 +72,66 @@ class QuizView extends Component {
     })
   }
 
+  getNextQuestion = () => {
+    const previousQuestions = [...this.state.previousQuestions]
+    if(this.state.currentQuestion.id) { previousQuestions.push(this.state.currentQuestion.id) }
+    const [nextQuestion, ...upcomingQuestions] = this.state.upcomingQuestions
+    if((previousQuestions.length === questionsPerPlay || !nextQuestion) && this.state.answers.length) {
+      this.saveResult()
+    }
+
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      currentQuestion: nextQuestion || {},
+      upcomingQuestions: upcomingQuestions,
+      guess: '',
+      forceEnd: nextQuestion ? false : true
+    })
+  }
+
   submitGuess = (event) => {
     event.preventDefault();
     const formatGuess = this.state.guess.replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g,"").toLowerCase()
     let evaluate =  this.evaluateAnswer()
     this.setState({
       numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
+      answers: [...this.state.answers, {question: this.state.currentQuestion.id, correct: evaluate}],
       showAnswer: true,
     })
   }
 
+  // the score is saved once, when the last question was answered
+  saveResult = () => {
+    $.ajax({
+      url: '/quizzes/results',
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        quiz_category: this.state.quizCategory,
+        answers: this.state.answers
+      }),
+      xhrFields: {
+        withCredentials: true
+      },
+      crossDomain: true,
+      error: (error) => {
+        alert('Unable to save your score')
+        return;
+      }
+    })
+  }
+
   restartGame = () => {
     this.setState({
       quizCategory: null,
       previousQuestions: [], 
       showAnswer: false,
       numCorrect: 0,
+      answers: [],
       currentQuestion: {},
+      upcomingQuestions: [],
       guess: '',
       forceEnd: false
     })
@@ -1,8 +1,10 @@
 import React, { Component } from 'react'
+import $ from 'jquery';
 
 class Search extends Component {
   state = {
     query: '',
+    suggestions: [],
   }
 
   getInfo = (event) => {
@@ -11,8 +13,38 @@ class Search extends Component {
   }
 
   handleInputChange = () => {
+    const query = this.search.value
     this.setState({
-      query: this.search.value
+      query: query
+    })
+    this.getSuggestions(query)
+  }
+
+  // beginnings of questions and completed last word, from the in-memory index
+  getSuggestions = (query) => {
+    if (!query.trim()) {
+      this.setState({ suggestions: [] })
+      return;
+    }
+    $.ajax({
+      url: `/questions/suggest?q=${encodeURIComponent(query)}&limit=5`,
+      type: "GET",
+      success: (result) => {
+        // an older answer can come after the newer one
+        if (query !== this.state.query) {
+          return;
+        }
+        const typed = query.replace(/\w+$/, '')
+        this.setState({
+          suggestions: Array.from(new Set(result.questions.map(question => question.prefix)
+            .concat(result.words.map(word => typed + word.word))))
+        })
+        return;
+      },
+      error: (error) => {
+        this.setState({ suggestions: [] })
+        return;
+      }
     })
   }
 
@@ -23,7 +55,13 @@ class Search extends Component {
           placeholder="Search questions..."
           ref={input => this.search = input}
           onChange={this.handleInputChange}
+          list="search-suggestions"
         />
+        <datalist id="search-suggestions">
+          {this.state.suggestions.map(suggestion => (
+            <option key={suggestion} value={suggestion}/>
+          ))}
+        </datalist>
         <input type="submit" value="Submit" className="button"/>
       </form>
     )